@@ -178,6 +178,24 @@ def parse():
     # optimization
     parser.add_argument('--batch_size', type=int, default=50,
                         help='mini-batch size')
+    parser.add_argument('--max_batch_frames', type=int, default=0,
+                        help='maximum number of padded input frames in a mini-batch (bucketing is enabled if positive)')
+    parser.add_argument('--max_batch_tokens', type=int, default=0,
+                        help='maximum number of padded tokens in a mini-batch (bucketing is enabled if positive)')
+    parser.add_argument('--n_buckets', type=int, default=10,
+                        help='number of buckets of input lengths for bucketing')
+    parser.add_argument('--n_workers', type=int, default=0,
+                        help='number of worker processes for loading mini-batches (0 means loading in the main process)')
+    parser.add_argument('--feat_store', type=strtobool, default=False,
+                        help='load features from the feature stores packed by utils/pack_features.py')
+    parser.add_argument('--n_ark_handles', type=int, default=0,
+                        help='number of ark files kept open for reading features of a mini-batch in the order of offsets (0 means disabled)')
+    parser.add_argument('--feat_cache_dir', type=str, default='/dev/shm/neural_sp_feat_cache',
+                        help='directory of the feature cache shared by training jobs on the same node')
+    parser.add_argument('--feat_cache_size', type=float, default=0,
+                        help='maximum size of the shared feature cache in MB (0 means disabled)')
+    parser.add_argument('--collate_in_loader', type=strtobool, default=False,
+                        help='stack, splice and pad input features in the loader (pinned for GPU, single GPU only)')
     parser.add_argument('--optimizer', type=str, default='adam',
                         choices=['adam', 'adadelta', 'adagrad', 'sgd', 'momentum', 'nesterov'],
                         help='type of optimizer')
@@ -193,6 +211,8 @@ def parse():
                         help='epoch to converto to SGD fine-tuning')
     parser.add_argument('--print_step', type=int, default=200,
                         help='print log per this value')
+    parser.add_argument('--save_n_steps', type=int, default=0,
+                        help='save a checkpoint resumable in the middle of an epoch per this value (0 means only at the end of each epoch)')
     parser.add_argument('--metric', type=str, default='edit_distance',
                         choices=['edit_distance', 'loss', 'acc', 'ppl', 'bleu', 'mse'],
                         help='metric for evaluation during training')
@@ -257,6 +277,14 @@ def parse():
                         help='probability of label smoothing')
     parser.add_argument('--ctc_lsm_prob', type=float, default=0.0,
                         help='probability of label smoothing for CTC')
+    parser.add_argument('--ctc_loss_impl', type=str, default='warpctc',
+                        choices=['warpctc', 'pytorch'],
+                        help='implementation of CTC loss (pytorch runs on the device of logits without extensions)')
+    parser.add_argument('--transducer_loss_impl', type=str, default='warprnnt',
+                        choices=['warprnnt', 'pytorch'],
+                        help='implementation of Transducer loss (pytorch runs without extensions)')
+    parser.add_argument('--transducer_chunk_size', type=int, default=16,
+                        help='number of frames per chunk of the joint network in the pytorch Transducer loss')
     parser.add_argument('--focal_loss_weight', type=float, default=0.0,
                         help='')
     parser.add_argument('--focal_loss_gamma', type=float, default=2.0,
@@ -274,6 +302,12 @@ def parse():
                         help='')
     parser.add_argument('--time_width_upper', type=float, default=0.2,
                         help='')
+    parser.add_argument('--time_warp_width', type=int, default=0,
+                        help='parameter W for time warping (0 means no time warping)')
+    parser.add_argument('--specaug_policy', type=str, default='', nargs='?',
+                        choices=['', 'librispeech_basic', 'librispeech_double',
+                                 'switchboard_mild', 'switchboard_strong'],
+                        help='SpecAugment policy (overrides the above parameters)')
     # MTL
     parser.add_argument('--ctc_weight', type=float, default=0.0,
                         help='CTC loss weight for the main task')
@@ -349,6 +383,8 @@ def parse():
                         help='recognize by teacher-forcing')
     parser.add_argument('--recog_batch_size', type=int, default=1,
                         help='size of mini-batch in evaluation')
+    parser.add_argument('--recog_feat_store', type=strtobool, default=False,
+                        help='load features from the feature stores packed by utils/pack_features.py')
     parser.add_argument('--recog_beam_width', type=int, default=1,
                         help='size of beam')
     parser.add_argument('--recog_max_len_ratio', type=float, default=1,
@@ -369,6 +405,18 @@ def parse():
                         help='weight of LM score')
     parser.add_argument('--recog_ctc_weight', type=float, default=0.0,
                         help='weight of CTC score')
+    parser.add_argument('--recog_ctc_window', type=int, default=0,
+                        help='number of frames on each side of the window for CTC prefix scores (0 means all frames)')
+    parser.add_argument('--recog_ctc_window_center', type=str, default='attention',
+                        choices=['attention', 'ctc'],
+                        help='center of the window for CTC prefix scores')
+    parser.add_argument('--recog_ctc_prune_mass', type=float, default=0.999,
+                        help='cumulative probability mass of labels extended at each frame in CTC beam search')
+    parser.add_argument('--recog_max_symbols_per_frame', type=int, default=1,
+                        help='maximum number of labels emitted per frame in RNN-T decoding. '
+                        'In beam search, each frame is always closed by a blank after the labels '
+                        'and hypotheses with the same labels are merged, so n-best lists and scores '
+                        'differ from the previous search emitting either a blank or a label per frame')
     parser.add_argument('--recog_lm', type=str, default=False, nargs='?',
                         help='LM path')
     parser.add_argument('--recog_lm_bwd', type=str, default=False, nargs='?',
@@ -376,6 +424,8 @@ def parse():
     parser.add_argument('--recog_lm_usage', type=str, default='shallow_fusion', nargs='?',
                         choices=['shallow_fusion', 'rescoring'],
                         help='usage of the external LM')
+    parser.add_argument('--recog_lm_cache_size', type=float, default=0,
+                        help='maximum size in MB of the cache of LM scores keyed by prefixes (0 disables the cache)')
     parser.add_argument('--recog_resolving_unk', type=strtobool, default=False,
                         help='resolving UNK for the word-based model')
     parser.add_argument('--recog_fwd_bwd_attention', type=strtobool, default=False,
@@ -390,6 +440,8 @@ def parse():
                         help='carry over LM state')
     parser.add_argument('--recog_wordlm', type=strtobool, default=False,
                         help='')
+    parser.add_argument('--recog_keep_attention', type=strtobool, default=False,
+                        help='keep attention weights of all hypotheses during beam search')
     # cache
     parser.add_argument('--recog_n_caches', type=int, default=0,
                         help='number of tokens for cache')
@@ -71,6 +71,7 @@ def main():
                           unit_sub1=args.unit_sub1,
                           unit_sub2=args.unit_sub2,
                           batch_size=args.recog_batch_size,
+                          feat_store=args.recog_feat_store,
                           skip_thought=skip_thought,
                           is_test=True)
 
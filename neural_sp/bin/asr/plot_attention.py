@@ -41,6 +41,7 @@ def main():
         if 'recog' not in k:
             setattr(args, k, v)
     recog_params = vars(args)
+    recog_params['recog_keep_attention'] = True
 
     # Setting for logging
     if os.path.isfile(os.path.join(args.recog_dir, 'plot.log')):
@@ -113,6 +113,19 @@ def main():
                         short2long=True,
                         sort_stop_epoch=args.sort_stop_epoch,
                         dynamic_batching=args.dynamic_batching,
+                        n_workers=args.n_workers,
+                        max_batch_frames=args.max_batch_frames * max(args.n_gpus, 1),
+                        max_batch_tokens=args.max_batch_tokens * max(args.n_gpus, 1),
+                        n_buckets=args.n_buckets,
+                        feat_store=args.feat_store,
+                        n_ark_handles=args.n_ark_handles,
+                        feat_cache_dir=args.feat_cache_dir,
+                        feat_cache_size=args.feat_cache_size,
+                        collate=args.collate_in_loader and args.n_gpus <= 1,
+                        pin_memory=args.n_gpus >= 1,
+                        n_stacks=args.n_stacks,
+                        n_skips=args.n_skips,
+                        n_splices=args.n_splices,
                         ctc=args.ctc_weight > 0,
                         ctc_sub1=args.ctc_weight_sub1 > 0,
                         ctc_sub2=args.ctc_weight_sub2 > 0,
@@ -139,6 +152,8 @@ def main():
                       min_n_frames=args.min_n_frames,
                       max_n_frames=args.max_n_frames,
                       shuffle=True if args.discourse_aware else False,
+                      feat_store=args.feat_store,
+                      n_ark_handles=args.n_ark_handles,
                       ctc=args.ctc_weight > 0,
                       ctc_sub1=args.ctc_weight_sub1 > 0,
                       ctc_sub2=args.ctc_weight_sub2 > 0,
@@ -156,6 +171,7 @@ def main():
                               unit=args.unit,
                               wp_model=args.wp_model,
                               batch_size=1,
+                              feat_store=args.feat_store,
                               discourse_aware=args.discourse_aware,
                               skip_thought=skip_thought,
                               is_test=True)]
@@ -284,7 +300,11 @@ def main():
                                    lr_factor=args.learning_rate_factor,
                                    transformer=transformer)
 
-    train_set.epoch = epoch - 1  # start from index:0
+    if args.resume and checkpoint['data_state'] is not None:
+        # Continue from the saved position of the training set iterator
+        train_set.load_state_dict(checkpoint['data_state'])
+    else:
+        train_set.epoch = epoch - 1  # start from index:0
 
     # Load the teacher ASR model
     teacher = None
@@ -414,7 +434,7 @@ def main():
 
             duration_step = time.time() - start_time_step
             if args.input_type == 'speech':
-                xlen = max(len(x) for x in batch_train['xs'])
+                xlen = max(batch_train['xlens'])
                 ylen = max(len(y) for y in batch_train['ys'])
             elif args.input_type == 'text':
                 xlen = max(len(x) for x in batch_train['ys'])
@@ -433,6 +453,12 @@ def main():
             reporter.snapshot()
             model.module.plot_attention()
 
+        # Save checkpoint in the middle of an epoch
+        if args.save_n_steps > 0 and step % args.save_n_steps == 0 and not is_new_epoch:
+            save_checkpoint(model.module, model.module.save_path, lr_controller,
+                            epoch - 1, step - 1, metric_dev_best,
+                            data_state=train_set.state_dict(), mid_epoch=True)
+
         # Save checkpoint and evaluate model per epoch
         if is_new_epoch:
             duration_epoch = time.time() - start_time_epoch
@@ -442,7 +468,8 @@ def main():
                 # Save the model
                 save_checkpoint(model.module, model.module.save_path, lr_controller,
                                 epoch, step - 1, metric_dev_best,
-                                remove_old_checkpoints=True)
+                                remove_old_checkpoints=True,
+                                data_state=train_set.state_dict())
                 reporter._epoch += 1
                 # TODO(hirofumi): fix later
             else:
@@ -489,7 +516,8 @@ def main():
                     # Save the model
                     save_checkpoint(model.module, model.module.save_path, lr_controller,
                                     epoch, step - 1, metric_dev_best,
-                                    remove_old_checkpoints=True)
+                                    remove_old_checkpoints=True,
+                                    data_state=train_set.state_dict())
 
                     # test
                     for s in eval_sets:
@@ -561,6 +589,7 @@ def main():
     if reporter.tensorboard:
         reporter.tf_writer.close()
     pbar_epoch.close()
+    train_set.close()
 
     return model.module.save_path
 
@@ -685,6 +714,10 @@ def make_model_name(args, subsample_factor):
         dir_name += '_' + str(args.freq_width) + 'FM' + str(args.n_freq_masks)
     if args.n_time_masks > 0:
         dir_name += '_' + str(args.time_width) + 'TM' + str(args.n_time_masks)
+    if args.time_warp_width > 0:
+        dir_name += '_' + str(args.time_warp_width) + 'TW'
+    if args.specaug_policy:
+        dir_name += '_' + args.specaug_policy
 
     # contextualization
     if args.discourse_aware:
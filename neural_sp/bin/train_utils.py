@@ -122,6 +122,7 @@ def load_checkpoint(model, checkpoint_path, resume=False):
             epoch (int): the currnet epoch
             step (int): the current step
             metric_dev_best (float): the current best performance
+            data_state (dict): the state of the training set iterator (None for old checkpoints)
 
     """
     if not os.path.isfile(checkpoint_path):
@@ -160,31 +161,41 @@ def load_checkpoint(model, checkpoint_path, resume=False):
         'lr_controller': checkpoint['lr_controller'],
         'epoch': epoch + 1,
         'step': checkpoint['step'] + 1,
-        'metric_dev_best': checkpoint['metric_dev_best']
+        'metric_dev_best': checkpoint['metric_dev_best'],
+        'data_state': checkpoint.get('data_state', None)
     }
     return model, return_values
 
 
 def save_checkpoint(model, save_path, lr_controller, epoch, step, metric_dev_best,
-                    remove_old_checkpoints=False):
+                    remove_old_checkpoints=False, data_state=None, mid_epoch=False):
     """Save checkpoint.
 
     Args:
         model (torch.nn.Module):
         save_path (str): path to the directory to save a model
         lr_controller ():
-        epoch (int): the currnet epoch
+        epoch (int): the currnet epoch (the last finished epoch if mid_epoch is True)
         step (int): the current step
         metric_dev_best (float):
         remove_old_checkpoints (bool): if True, all checkpoints
             other than the best one will be deleted
+        data_state (dict): the state of the training set iterator
+        mid_epoch (bool): if True, save a checkpoint in the middle of an epoch
+            as model.step-*.epoch-*, which replaces the previous one
 
     """
-    model_path = os.path.join(save_path, 'model.epoch-' + str(epoch))
+    if mid_epoch:
+        # NOTE: the suffix is the last finished epoch as in model.epoch-*
+        model_path = os.path.join(save_path, 'model.step-' + str(step) + '.epoch-' + str(epoch))
+        for path in glob(os.path.join(save_path, 'model.step-*')):
+            os.remove(path)
+    else:
+        model_path = os.path.join(save_path, 'model.epoch-' + str(epoch))
 
     # Remove old checkpoints
     if remove_old_checkpoints:
-        for path in glob(os.path.join(save_path, 'model.epoch-*')):
+        for path in glob(os.path.join(save_path, 'model.epoch-*')) + glob(os.path.join(save_path, 'model.step-*')):
             os.remove(path)
 
     # Save parameters, optimizer, step index etc.
@@ -194,8 +205,9 @@ def save_checkpoint(model, save_path, lr_controller, epoch, step, metric_dev_bes
         "lr_controller": lr_controller,
         "epoch": epoch,
         "step": step,
-        "metric_dev_best": metric_dev_best
+        "metric_dev_best": metric_dev_best,
+        "data_state": data_state
     }
     torch.save(checkpoint, model_path)
 
-    logger.info("=> Saved checkpoint (epoch:%d): %s" % (epoch, model_path))
+    logger.info("=> Saved checkpoint (epoch:%d, step:%d): %s" % (epoch, step, model_path))
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Locality-aware reader of features in Kaldi ark files."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import io
+import kaldiio
+from kaldiio.matio import read_kaldi
+import os
+
+
+def parse_feat_path(feat_path):
+    """Split a feature path into the ark path and the byte offset.
+
+    Args:
+        feat_path (str): path in the form of `path.ark:offset`
+    Returns:
+        ark_path (str): None if feat_path is not in the above form
+            (e.g. pipes and slices), which is read by kaldiio
+        offset (int):
+
+    """
+    ark_path, _, offset = feat_path.rpartition(':')
+    if ark_path == '' or not offset.isdigit() or ark_path.strip()[-1] == '|' or ark_path.strip()[0] == '|':
+        return None, None
+    return ark_path, int(offset)
+
+
+class ArkReader(object):
+
+    def __init__(self, n_handles=16, max_gap=1048576, max_chunk=67108864):
+        """Read features of a mini-batch in the order of files and offsets.
+
+        Reads in the same ark file are sorted by offsets, and neighbouring reads
+        are coalesced into a single sequential read of the byte range between them.
+
+        Args:
+            n_handles (int): maximum number of ark files kept open (LRU)
+            max_gap (int): maximum distance in bytes between offsets of coalesced reads
+            max_chunk (int): maximum size in bytes of a coalesced read
+
+        """
+        self.n_handles = n_handles
+        self.max_gap = max_gap
+        self.max_chunk = max_chunk
+        self.handles = OrderedDict()  # ark path -> file object
+        self.pid = os.getpid()
+
+    def open(self, ark_path):
+        """Return an open handle of the ark file from the LRU pool."""
+        if self.pid != os.getpid():
+            # NOTE: handles inherited from the parent process share file positions
+            self.handles = OrderedDict()
+            self.pid = os.getpid()
+        if ark_path in self.handles:
+            self.handles.move_to_end(ark_path)
+        else:
+            if len(self.handles) >= self.n_handles:
+                self.handles.popitem(last=False)[1].close()
+            self.handles[ark_path] = open(ark_path, 'rb')
+        return self.handles[ark_path]
+
+    def read(self, feat_paths):
+        """Read features.
+
+        Args:
+            feat_paths (list): paths to features in the form of `path.ark:offset`
+        Returns:
+            feats (list): A list of np.ndarray in the order of feat_paths
+
+        """
+        feats = [None] * len(feat_paths)
+        indices = {}  # (ark path, offset) -> indices in feat_paths
+        for i, feat_path in enumerate(feat_paths):
+            ark_path, offset = parse_feat_path(feat_path)
+            if ark_path is None:
+                feats[i] = kaldiio.load_mat(feat_path)
+            else:
+                indices.setdefault((ark_path, offset), []).append(i)
+        reads = sorted([(ark_path, offset, idx[0]) for (ark_path, offset), idx in indices.items()])
+
+        # Split into runs of neighbouring reads in the same file
+        runs = []
+        for ark_path, offset, i in reads:
+            if len(runs) > 0:
+                ark_path_prev, offset_begin, _ = runs[-1][0]
+                offset_prev = runs[-1][-1][1]
+                if ark_path_prev == ark_path and offset - offset_prev <= self.max_gap and \
+                        offset - offset_begin <= self.max_chunk:
+                    runs[-1].append((ark_path, offset, i))
+                    continue
+            runs.append([(ark_path, offset, i)])
+
+        for run in runs:
+            f = self.open(run[0][0])
+            offset_begin = run[0][1]
+            f.seek(offset_begin)
+            if len(run) > 1:
+                # NOTE: all but the last matrix end before the offset of the last one
+                chunk = io.BytesIO(f.read(run[-1][1] - offset_begin))
+                for _, offset, i in run[:-1]:
+                    chunk.seek(offset - offset_begin)
+                    feats[i] = read_kaldi(chunk)
+            # The last matrix is read from the current position
+            feats[run[-1][2]] = read_kaldi(f)
+
+        # Duplicated reads
+        for idx in indices.values():
+            for i in idx[1:]:
+                feats[i] = feats[idx[0]]
+        return feats
+
+    def close(self):
+        """Close all handles."""
+        for f in self.handles.values():
+            f.close()
+        self.handles = OrderedDict()
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Feature cache shared by all processes on a node."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fcntl
+import hashlib
+import logging
+import numpy as np
+import os
+import time
+
+logger = logging.getLogger('training')
+
+
+class SharedFeatureCache(object):
+
+    def __init__(self, cache_dir='/dev/shm/neural_sp_feat_cache', max_mb=1024):
+        """Cache features as .npy files in a memory-backed directory.
+
+        Each feature is saved in a file keyed by the hash of its feat_path and
+        memory-mapped when hit, so every process (e.g. training jobs of different
+        hyper-parameters on the same data) attaches to the same copy.
+        Files are written atomically by renaming, and the least recently used ones
+        are evicted when the total size exceeds max_mb. Reads and writes require no
+        lock because a reader keeps an unlinked file alive until it is closed.
+
+        The total size is checked before every write including files written by the
+        other processes. Growth of the used space of the filesystem since the last
+        scan of the directory bounds it from above, so the directory is scanned only
+        when the bound exceeds max_mb. Scans are serialized with a lock file so that
+        no file is removed by another process during a scan. The limit can be
+        exceeded only by features being written by concurrent processes at the same time.
+
+        Args:
+            cache_dir (str): directory on a memory-backed filesystem (e.g. /dev/shm)
+            max_mb (float): maximum total size of cached features in MB
+
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass  # made by another process
+        self.lock_path = os.path.join(cache_dir, 'lock')
+        self.n_bytes_cached = None  # total size at the last scan (scan at the first write)
+        self.fs_used_bytes = 0  # used space of the filesystem at the last scan
+
+    def _fs_used_bytes(self):
+        st = os.statvfs(self.cache_dir)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+    def _path(self, feat_path):
+        return os.path.join(self.cache_dir, hashlib.sha1(feat_path.encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, feat_path):
+        """Return the cached feature or None.
+
+        Args:
+            feat_path (str):
+        Returns:
+            feat (np.ndarray): A read-only memory-mapped array of size `[T, input_dim]`
+
+        """
+        path = self._path(feat_path)
+        try:
+            feat = np.load(path, mmap_mode='r')
+            os.utime(path, None)  # for LRU eviction
+        except (IOError, OSError, ValueError):
+            # NOTE: evicted or being written by another process
+            return None
+        return feat
+
+    def put(self, feat_path, feat):
+        """Cache the feature.
+
+        Args:
+            feat_path (str):
+            feat (np.ndarray):
+
+        """
+        path = self._path(feat_path)
+        if feat.nbytes > self.max_bytes or os.path.isfile(path):
+            return
+        n_bytes_growth = max(self._fs_used_bytes() - self.fs_used_bytes, 0)
+        if self.n_bytes_cached is None or self.n_bytes_cached + n_bytes_growth + feat.nbytes > self.max_bytes:
+            with open(self.lock_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)  # released by closing
+                # NOTE: measure before the scan not to miss files written by others during the scan
+                fs_used_bytes = self._fs_used_bytes()
+                self.n_bytes_cached, n_bytes_removed = self.evict(feat.nbytes)
+                self.fs_used_bytes = fs_used_bytes - n_bytes_removed
+        path_tmp = path + '.tmp' + str(os.getpid())
+        try:
+            with open(path_tmp, 'wb') as f:
+                np.save(f, feat)
+            os.rename(path_tmp, path)
+        except (IOError, OSError):
+            # NOTE: out of space or removed by eviction in another process
+            if os.path.isfile(path_tmp):
+                os.remove(path_tmp)
+            return
+
+    def evict(self, n_bytes_new=0):
+        """Remove the least recently used files until the total size is below 90% of the limit.
+
+        Args:
+            n_bytes_new (int): size of the feature to be written
+        Returns:
+            total (int): total size of the remaining files
+            n_bytes_removed (int): total size of the removed files
+
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.npy'):
+                entries.append((st.st_mtime, st.st_size, path))
+            elif path != self.lock_path and now - st.st_mtime > 3600:
+                # Temporary file left by a killed process
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        total = sum([size for _, size, _ in entries])
+        if total + n_bytes_new <= self.max_bytes:
+            return total, 0
+        n_removed = 0
+        n_bytes_removed = 0
+        for _, size, path in sorted(entries):
+            if total + n_bytes_new <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # removed by another process
+            total -= size
+            n_removed += 1
+            n_bytes_removed += size
+        logger.debug('Evicted %d features from %s' % (n_removed, self.cache_dir))
+        return total, n_bytes_removed
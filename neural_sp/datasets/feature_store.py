@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Packed feature store.
+   Features of all utterances in a dataset are saved in a single contiguous file,
+   which is memory-mapped and sliced without copy when loaded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import kaldiio
+import numpy as np
+import os
+
+FEATURE_STORE_VERSION = 1
+
+
+def feature_store_path(tsv_path):
+    """Return the default path to the feature store of the dataset tsv file (or manifest)."""
+    return tsv_path.rstrip('/') + '.feats'
+
+
+def pack_features(feat_paths, store_dir, dtype='float32'):
+    """Pack features into a feature store.
+
+    Args:
+        feat_paths (list): paths to features readable with kaldiio (e.g. ark:offset)
+            in the order of rows in the dataset tsv file
+        store_dir (str): path to the output directory
+        dtype (str): float32 or float16
+    Returns:
+        n_frames (int): total number of frames
+
+    """
+    if dtype not in ['float32', 'float16']:
+        raise ValueError(dtype)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    offsets = np.zeros(len(feat_paths) + 1, dtype=np.int64)
+    dim = None
+    with open(os.path.join(store_dir, 'feats.bin'), 'wb') as f:
+        for i, feat_path in enumerate(feat_paths):
+            feat = kaldiio.load_mat(feat_path)
+            if dim is None:
+                dim = feat.shape[-1]
+            elif feat.shape[-1] != dim:
+                raise ValueError('Feature dimension mismatch in %s: %d vs. %d' % (feat_path, feat.shape[-1], dim))
+            f.write(np.ascontiguousarray(feat, dtype=dtype).tobytes())
+            offsets[i + 1] = offsets[i] + len(feat)
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': FEATURE_STORE_VERSION, 'n_utts': len(feat_paths),
+                   'dim': dim, 'dtype': dtype}, f)
+    return int(offsets[-1])
+
+
+class FeatureStore(object):
+
+    def __init__(self, store_dir):
+        """A memory-mapped feature store made by pack_features().
+
+        Args:
+            store_dir (str): path to the directory of the feature store
+
+        """
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != FEATURE_STORE_VERSION:
+            raise ValueError('Unsupported feature store version: %d (repack %s)' % (meta['version'], store_dir))
+        self.n_utts = meta['n_utts']
+        self.dim = meta['dim']
+        self.dtype = meta['dtype']
+
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+        self.feats = np.memmap(os.path.join(store_dir, 'feats.bin'), dtype=self.dtype, mode='r',
+                               shape=(int(self.offsets[-1]), self.dim))
+
+    def __len__(self):
+        return self.n_utts
+
+    def __getitem__(self, i):
+        """Return features of the i-th utterance.
+
+        Args:
+            i (int): row id in the dataset tsv file
+        Returns:
+            feat (np.ndarray): A read-only view of size `[T, dim]`
+                (float16 features are converted to float32 in the model)
+
+        """
+        return self.feats[self.offsets[i]:self.offsets[i + 1]]
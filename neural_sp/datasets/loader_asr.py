@@ -17,8 +17,15 @@ import numpy as np
 import os
 import pandas as pd
 import kaldiio
+import torch
 
+from neural_sp.datasets.ark_reader import ArkReader
+from neural_sp.datasets.feature_cache import SharedFeatureCache
+from neural_sp.datasets.feature_store import feature_store_path
+from neural_sp.datasets.feature_store import FeatureStore
 from neural_sp.datasets.loader_base import Base
+from neural_sp.datasets.manifest import is_manifest
+from neural_sp.datasets.manifest import Manifest
 # from neural_sp.datasets.parallel import multiprocess
 from neural_sp.datasets.token_converter.character import Char2idx
 from neural_sp.datasets.token_converter.character import Idx2char
@@ -28,6 +35,8 @@ from neural_sp.datasets.token_converter.word import Idx2word
 from neural_sp.datasets.token_converter.word import Word2idx
 from neural_sp.datasets.token_converter.wordpiece import Idx2wp
 from neural_sp.datasets.token_converter.wordpiece import Wp2idx
+from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame
+from neural_sp.models.seq2seq.frontends.splicing import splice
 
 np.random.seed(1)
 
@@ -39,7 +48,11 @@ class Dataset(Base):
                  is_test=False, min_n_frames=40, max_n_frames=2000,
                  shuffle=False, sort_by_input_length=False,
                  short2long=False, sort_stop_epoch=None,
-                 n_ques=None, dynamic_batching=False,
+                 n_ques=None, n_workers=0, dynamic_batching=False,
+                 max_batch_frames=0, max_batch_tokens=0, n_buckets=10,
+                 feat_store=False, n_ark_handles=0,
+                 feat_cache_dir='/dev/shm/neural_sp_feat_cache', feat_cache_size=0,
+                 collate=False, pin_memory=False, n_stacks=1, n_skips=1, n_splices=1,
                  ctc=False, subsample_factor=1,
                  wp_model=False, corpus='',
                  tsv_path_sub1=False, dict_path_sub1=False, unit_sub1=False,
@@ -52,7 +65,8 @@ class Dataset(Base):
         """A class for loading dataset.
 
         Args:
-            tsv_path (str): path to the dataset tsv file
+            tsv_path (str): path to the dataset tsv file,
+                or the manifest directory compiled from it (see utils/make_manifest.py)
             dict_path (str): path to the dictionary
             unit (str): word or wp or char or phone or word_char
             batch_size (int): size of mini-batch
@@ -67,8 +81,26 @@ class Dataset(Base):
             short2long (bool): sort utterances in the descending order
             sort_stop_epoch (int): After sort_stop_epoch, training will revert
                 back to a random order
-            n_ques (int): number of elements to enqueue
+            n_ques (int): number of mini-batches loaded in advance
+            n_workers (int): number of worker processes for loading mini-batches
+                (0 means loading in the main process unless n_ques is set)
             dynamic_batching (bool): change batch size dynamically in training
+            max_batch_frames (int): maximum number of padded input frames in mini-batch
+                (bucketing is enabled if either max_batch_frames or max_batch_tokens is positive)
+            max_batch_tokens (int): maximum number of padded tokens in mini-batch
+            n_buckets (int): number of buckets of input lengths for bucketing
+            feat_store (bool): load features from the feature store packed next to
+                tsv_path (see utils/pack_features.py) instead of reading ark files
+            n_ark_handles (int): number of ark files kept open for reading features
+                in the order of files and offsets (0 means reading each utterance by kaldiio)
+            feat_cache_dir (str): directory of the feature cache shared by processes on the node
+            feat_cache_size (float): maximum size of the feature cache in MB (0 means disabled)
+            collate (bool): return input features as a padded FloatTensor with frame stacking
+                and splicing applied, which is made by workers when n_workers > 0
+            pin_memory (bool): pin the padded FloatTensor for asynchronous transfer to GPU
+            n_stacks (int): number of frames to stack (only for collate)
+            n_skips (int): number of frames to skip (only for collate)
+            n_splices (int): frames to splice (only for collate)
             ctc (bool):
             subsample_factor (int):
             wp_model (): path to the word-piece model for sentencepiece
@@ -89,10 +121,20 @@ class Dataset(Base):
         self.sort_stop_epoch = sort_stop_epoch
         self.sort_by_input_length = sort_by_input_length
         self.n_ques = n_ques
+        self.n_workers = n_workers
         self.dynamic_batching = dynamic_batching
+        self.short2long = short2long
+        self.max_batch_frames = max_batch_frames
+        self.max_batch_tokens = max_batch_tokens
+        self.n_buckets = n_buckets
         self.corpus = corpus
         self.contextualize = contextualize
         self.skip_thought = skip_thought
+        self.collate = collate and not skip_thought
+        self.pin_memory = pin_memory and self.collate and torch.cuda.is_available()
+        self.n_stacks = n_stacks
+        self.n_skips = n_skips
+        self.n_splices = n_splices
 
         self.vocab = self.count_vocab_size(dict_path)
         self.eos = 2
@@ -142,20 +184,48 @@ class Dataset(Base):
                 setattr(self, 'vocab_sub' + str(i), -1)
 
         # Load dataset tsv file
-        self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
-        self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
-                                  'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
+        # NOTE: only numeric columns are kept in self.df when the manifest is used
+        self.manifest = None
+        if is_manifest(tsv_path):
+            if contextualize or skip_thought:
+                raise ValueError('Use the tsv file for contextualize and skip_thought.')
+            self.manifest = Manifest(tsv_path)
+            self.df = self.manifest.to_frame()
+        else:
+            self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
+            self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
+                                      'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
         for i in range(1, 3):
-            if locals()['tsv_path_sub' + str(i)]:
-                df_sub = pd.read_csv(locals()['tsv_path_sub' + str(i)], encoding='utf-8', delimiter='\t')
+            tsv_path_sub = locals()['tsv_path_sub' + str(i)]
+            manifest_sub, df_sub = None, None
+            if tsv_path_sub and is_manifest(tsv_path_sub):
+                manifest_sub = Manifest(tsv_path_sub)
+                df_sub = manifest_sub.to_frame()
+            elif tsv_path_sub:
+                df_sub = pd.read_csv(tsv_path_sub, encoding='utf-8', delimiter='\t')
                 df_sub = df_sub.loc[:, ['utt_id', 'speaker', 'feat_path',
                                         'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
-                setattr(self, 'df_sub' + str(i), df_sub)
-            else:
-                setattr(self, 'df_sub' + str(i), None)
-        self.input_dim = kaldiio.load_mat(self.df['feat_path'][0]).shape[-1]
+            setattr(self, 'manifest_sub' + str(i), manifest_sub)
+            setattr(self, 'df_sub' + str(i), df_sub)
+        self.ark_reader = ArkReader(n_ark_handles) if n_ark_handles > 0 else None
+        self.feat_cache = SharedFeatureCache(feat_cache_dir, feat_cache_size) if feat_cache_size > 0 else None
+        self.feat_store = None
+        if feat_store:
+            self.feat_store = FeatureStore(feature_store_path(tsv_path))
+            if len(self.feat_store) != len(self.df):
+                raise ValueError('The feature store has %d utterances while %s has %d utterances.' %
+                                 (len(self.feat_store), tsv_path, len(self.df)))
+            self.input_dim = self.feat_store.dim
+        else:
+            self.input_dim = kaldiio.load_mat(self._get('feat_path', self.df.index[0])).shape[-1]
 
-        if corpus == 'swbd':
+        if self.manifest is not None:
+            # Sessions of the interned speakers
+            if corpus == 'swbd':
+                self.sessions = [spk.split('-')[0] for spk in self.manifest.speakers]
+            else:
+                self.sessions = self.manifest.speakers
+        elif corpus == 'swbd':
             self.df['session'] = self.df['speaker'].apply(lambda x: str(x).split('-')[0])
             # self.df['session'] = self.df['speaker'].apply(lambda x: str(x))
         else:
@@ -187,6 +257,9 @@ class Dataset(Base):
                 self.df['n_prev_utt'] = self.df.apply(lambda x: len(x['prev_utt']), axis=1)
 
         elif is_test and corpus == 'swbd':
+            if self.manifest is not None:
+                self.df['utt_id'] = [self._get('utt_id', i) for i in self.df.index]
+                self.df['session'] = [self._get('session', i) for i in self.df.index]
             # Sort by onset
             self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[-1].split('-')[0]))
             self.df = self.df.sort_values(by=['session', 'onset'], ascending=True)
@@ -195,19 +268,18 @@ class Dataset(Base):
         if is_test:
             print('Original utterance num: %d' % len(self.df))
             n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
+            self.df = self.df[self.df['ylen'] > 0]
             print('Removed %d empty utterances' % (n_utts - len(self.df)))
         else:
             print('Original utterance num: %d' % len(self.df))
             n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: min_n_frames <= x[
-                                            'xlen'] <= max_n_frames, axis=1)]
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
+            self.df = self.df[(min_n_frames <= self.df['xlen']) & (self.df['xlen'] <= max_n_frames)]
+            self.df = self.df[self.df['ylen'] > 0]
             print('Removed %d utterances (threshold)' % (n_utts - len(self.df)))
 
             if ctc and subsample_factor > 1:
                 n_utts = len(self.df)
-                self.df = self.df[self.df.apply(lambda x: x['ylen'] <= (x['xlen'] // subsample_factor), axis=1)]
+                self.df = self.df[self.df['ylen'] <= (self.df['xlen'] // subsample_factor)]
                 print('Removed %d utterances (for CTC)' % (n_utts - len(self.df)))
 
             for i in range(1, 3):
@@ -216,8 +288,7 @@ class Dataset(Base):
                 subsample_factor_sub = locals()['subsample_factor_sub' + str(i)]
                 if df_sub is not None:
                     if ctc_sub and subsample_factor_sub > 1:
-                        df_sub = df_sub[df_sub.apply(
-                            lambda x: x['ylen'] <= (x['xlen'] // subsample_factor_sub), axis=1)]
+                        df_sub = df_sub[df_sub['ylen'] <= (df_sub['xlen'] // subsample_factor_sub)]
 
                     if len(self.df) != len(df_sub):
                         n_utts = len(self.df)
@@ -236,7 +307,66 @@ class Dataset(Base):
             elif shuffle:
                 self.df = self.df.reindex(np.random.permutation(self.df.index))
 
-        self.rest = set(list(self.df.index))
+    def _get(self, key, i):
+        """Look up a value of the i-th utterance without pandas if the manifest is used."""
+        if self.manifest is None:
+            return self.df[key][i]
+        if key == 'session':
+            return self.sessions[self.manifest.columns['speaker_id'][i]]
+        return self.manifest.get(key, i)
+
+    def _token_ids(self, i, sub=''):
+        """Return token ids of the i-th utterance in the main task or an auxiliary task (_sub1/_sub2)."""
+        manifest = getattr(self, 'manifest' + sub)
+        if manifest is not None:
+            return manifest.token_ids(i)
+        return list(map(int, str(getattr(self, 'df' + sub)['token_id'][i]).split()))
+
+    def load_feats(self, feat_paths):
+        """Load features from the shared cache or ark files.
+
+        Args:
+            feat_paths (list):
+        Returns:
+            xs (list): A list of np.ndarray in the order of feat_paths
+
+        """
+        if self.feat_cache is None:
+            xs = [None] * len(feat_paths)
+        else:
+            xs = [self.feat_cache.get(feat_path) for feat_path in feat_paths]
+
+        misses = [j for j, x in enumerate(xs) if x is None]
+        if len(misses) > 0:
+            if self.ark_reader is not None:
+                feats = self.ark_reader.read([feat_paths[j] for j in misses])
+            else:
+                feats = [kaldiio.load_mat(feat_paths[j]) for j in misses]
+            for j, feat in zip(misses, feats):
+                xs[j] = feat
+                if self.feat_cache is not None:
+                    self.feat_cache.put(feat_paths[j], feat)
+        return xs
+
+    def collate_feats(self, xs):
+        """Apply frame stacking and splicing, and pad input features.
+
+        Args:
+            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+        Returns:
+            xs_pad (FloatTensor): `[B, T', input_dim']`
+            xlens (list): lengths of each element in xs_pad
+
+        """
+        if self.n_stacks > 1:
+            xs = [stack_frame(x, self.n_stacks, self.n_skips) for x in xs]
+        if self.n_splices > 1:
+            xs = [splice(x, self.n_splices, self.n_stacks) for x in xs]
+        xlens = [len(x) for x in xs]
+        xs_pad = np.zeros((len(xs), max(xlens), xs[0].shape[-1]), dtype=np.float32)
+        for b, x in enumerate(xs):
+            xs_pad[b, :len(x)] = x
+        return torch.from_numpy(xs_pad), xlens
 
     def make_batch(self, df_indices):
         """Create mini-batch per step.
@@ -246,6 +376,7 @@ class Dataset(Base):
         Returns:
             batch (dict):
                 xs (list): input data of size `[T, input_dim]`
+                    (FloatTensor of size `[B, T', input_dim']` if collate is True)
                 xlens (list): lengths of each element in xs
                 ys (list): reference labels in the main task of size `[L]`
                 ys_sub1 (list): reference labels in the 1st auxiliary task of size `[L_sub1]`
@@ -258,15 +389,21 @@ class Dataset(Base):
         # inputs
         if self.skip_thought:
             xs = []
+        elif self.feat_store is not None:
+            xs = [self.feat_store[i] for i in df_indices]
         else:
-            xs = [kaldiio.load_mat(self.df['feat_path'][i]) for i in df_indices]
+            xs = self.load_feats([self._get('feat_path', i) for i in df_indices])
             # xs = multiprocess(kaldiio.load_mat, self.df['feat_path'][df_indices], core=4)
 
+        xlens = [self._get('xlen', i) for i in df_indices]
+        if self.collate:
+            xs, xlens = self.collate_feats(xs)
+
         # outputs
         if self.is_test:
-            ys = [self.token2idx[0](self.df['text'][i]) for i in df_indices]
+            ys = [self.token2idx[0](self._get('text', i)) for i in df_indices]
         else:
-            ys = [list(map(int, str(self.df['token_id'][i]).split())) for i in df_indices]
+            ys = [self._token_ids(i) for i in df_indices]
 
         ys_hist = [[] for _ in range(len(df_indices))]
         if self.contextualize:
@@ -293,28 +430,28 @@ class Dataset(Base):
 
         ys_sub1 = []
         if self.df_sub1 is not None:
-            ys_sub1 = [list(map(int, str(self.df_sub1['token_id'][i]).split())) for i in df_indices]
+            ys_sub1 = [self._token_ids(i, '_sub1') for i in df_indices]
         elif self.vocab_sub1 > 0 and not self.is_test:
-            ys_sub1 = [self.token2idx[1](self.df['text'][i]) for i in df_indices]
+            ys_sub1 = [self.token2idx[1](self._get('text', i)) for i in df_indices]
 
         ys_sub2 = []
         if self.df_sub2 is not None:
-            ys_sub2 = [list(map(int, str(self.df_sub2['token_id'][i]).split())) for i in df_indices]
+            ys_sub2 = [self._token_ids(i, '_sub2') for i in df_indices]
         elif self.vocab_sub2 > 0 and not self.is_test:
-            ys_sub2 = [self.token2idx[2](self.df['text'][i]) for i in df_indices]
+            ys_sub2 = [self.token2idx[2](self._get('text', i)) for i in df_indices]
 
         batch_dict = {
             'xs': xs,
-            'xlens': [self.df['xlen'][i] for i in df_indices],
+            'xlens': xlens,
             'ys': ys,
             'ys_hist': ys_hist,
             'ys_sub1': ys_sub1,
             'ys_sub2': ys_sub2,
-            'utt_ids': [self.df['utt_id'][i] for i in df_indices],
-            'speakers': [self.df['speaker'][i] for i in df_indices],
-            'sessions': [self.df['session'][i] for i in df_indices],
-            'text': [self.df['text'][i] for i in df_indices],
-            'feat_path': [self.df['feat_path'][i] for i in df_indices],  # for plot
+            'utt_ids': [self._get('utt_id', i) for i in df_indices],
+            'speakers': [self._get('speaker', i) for i in df_indices],
+            'sessions': [self._get('session', i) for i in df_indices],
+            'text': [self._get('text', i) for i in df_indices],
+            'feat_path': [self._get('feat_path', i) for i in df_indices],  # for plot
             'ys_prev': ys_prev,
             'text_prev': text_prev,
             'ys_next': ys_next,
@@ -11,32 +11,75 @@ from __future__ import division
 from __future__ import print_function
 
 import codecs
+from collections import deque
 import logging
-import random
-import six
+import numpy as np
+import queue
 import time
+import torch
+import traceback
 from torch.multiprocessing import Process
 from torch.multiprocessing import Queue
 
-random.seed(1)
-
 logger = logging.getLogger('training')
 
 
+def _loader_worker(dataset, index_queue, batch_queue):
+    """Load mini-batches of the requested indices until None is received.
+
+    Args:
+        dataset (Base):
+        index_queue (Queue): requests of (generation, sequence id, data indices)
+        batch_queue (Queue): results of (generation, sequence id, batch, error message)
+
+    """
+    while True:
+        request = index_queue.get()
+        if request is None:
+            break
+        generation, seq_id, data_indices = request
+        try:
+            batch_queue.put((generation, seq_id, dataset.make_batch(data_indices), None))
+        except Exception:
+            batch_queue.put((generation, seq_id, None, traceback.format_exc()))
+
+
 class Base(object):
 
     def __init__(self):
         self.epoch = 0
         self.iteration = 0
-        self.offset = 0
+        self.offset = 0  # cursor in the order of the current epoch
+        self.order = None  # data indices in the sampled order of the current epoch
+        self.n_consumed = 0  # number of utterances returned by next() in the current epoch
+        self.rng = np.random.RandomState(1)  # for sampling only, saved in checkpoints
 
         # for multiprocessing
         self._epoch = 0
 
         # Setting for multiprocessing
-        self.preloading_process = None
-        self.queue = Queue()
-        self.queue_size = 0
+        self.n_ques = None
+        self.n_workers = 0
+        self.workers = None
+        self.index_queue = None
+        self.batch_queue = None
+        self.requests = deque()  # (sequence id, data indices, is_new_epoch, sampler state) in the sampled order
+        self.sampler_state = None  # sampler state right after sampling the last mini-batch returned by next()
+        self.received = {}  # sequence id -> batch loaded ahead of its turn
+        self.seq_id = 0
+        self.generation = 0  # incremented when requests in flight are discarded
+
+        # Setting for bucketing
+        self.max_batch_frames = 0
+        self.max_batch_tokens = 0
+        self.n_buckets = 1
+        self.short2long = True
+        self.bucket_batches = []  # mini-batches in the current epoch
+        self.bucket_offset = 0  # cursor in bucket_batches
+        self.padding_efficiency = None
+
+        # Setting for collation
+        self.pin_memory = False  # pin tensors in mini-batches in the main process
 
     def count_vocab_size(self, dict_path):
         vocab_count = 1  # for <blank>
@@ -59,7 +102,8 @@ class Base(object):
     @property
     def epoch_detail(self):
         # Floating point version of epoch
-        return self.epoch + (self.offset / len(self))
+        # NOTE: offset runs ahead of the training loop when mini-batches are prefetched
+        return self.epoch + (self.n_consumed / len(self))
 
     def next(self, batch_size=None):
         """Generate each mini-batch.
@@ -74,48 +118,34 @@ class Base(object):
         if batch_size is None:
             batch_size = self.batch_size
 
-        if self.n_ques is None:
-            if self.max_epoch is not None and self.epoch >= self.max_epoch:
-                raise StopIteration
-            # NOTE: max_epoch == None means infinite loop
+        if self.max_epoch is not None and self.epoch >= self.max_epoch:
+            raise StopIteration
+        # NOTE: max_epoch == None means infinite loop
 
+        if self.n_ques is None and self.n_workers == 0:
             data_indices, is_new_epoch = self.sample_index(batch_size)
             batch = self.make_batch(data_indices)
-            self.iteration += len(data_indices)
         else:
-            # Clean up multiprocessing
-            if self.preloading_process is not None and self.queue_size == 0:
-                self.preloading_process.terminate()
-                self.preloading_process.join()
-
-            if self.max_epoch is not None and self.epoch >= self.max_epoch:
-                # Clean up multiprocessing
-                self.preloading_process.terminate()
-                self.preloading_process.join()
-                raise StopIteration
-            # NOTE: max_epoch == None means infinite loop
-
-            # Enqueue mini-batches
-            if self.queue_size == 0:
-                self.df_indices_list = []
-                self.is_new_epoch_list = []
-                for _ in six.moves.range(self.n_ques):
-                    data_indices, is_new_epoch = self.sample_index(batch_size)
-                    self.df_indices_list.append(data_indices)
-                    self.is_new_epoch_list.append(is_new_epoch)
-                self.preloading_process = Process(self.preloading_loop,
-                                                  args=(self.queue, self.df_indices_list))
-                self.preloading_process.start()
-                self.queue_size += self.n_ques
-                time.sleep(3)
-
-            self.iteration += len(self.df_indices_list[self.n_ques - self.queue_size])
-            self.queue_size -= 1
-            batch = self.queue.get()
-            is_new_epoch = self.is_new_epoch_list.pop(0)
+            if self.workers is None:
+                self.start_workers()
+
+            # Keep n_ques mini-batches in flight
+            self.enqueue(batch_size)
+            seq_id, data_indices, is_new_epoch, self.sampler_state = self.requests.popleft()
+            batch = self.dequeue(seq_id)
+        self.iteration += len(data_indices)
+
+        if self.pin_memory:
+            # NOTE: tensors sent from workers are in shared memory, so they are pinned here
+            for k, v in batch.items():
+                if torch.is_tensor(v):
+                    batch[k] = v.pin_memory()
 
         if is_new_epoch:
             self.epoch += 1
+            self.n_consumed = 0
+        else:
+            self.n_consumed += len(data_indices)
 
         return batch, is_new_epoch
 
@@ -129,51 +159,138 @@ class Base(object):
             is_new_epoch (bool):
 
         """
-        is_new_epoch = False
-
-        if self.sort_by_input_length or not self.shuffle:
-            if self.sort_by_input_length:
-                # Change batch size dynamically
-                min_xlen = self.df[self.offset:self.offset + 1]['xlen'].values[0]
-                min_ylen = self.df[self.offset:self.offset + 1]['ylen'].values[0]
-                batch_size_tmp = self.select_batch_size(batch_size, min_xlen, min_ylen)
-            else:
-                batch_size_tmp = batch_size
-
-            if len(self.rest) > batch_size_tmp:
-                data_indices = list(self.df[self.offset:self.offset + batch_size_tmp].index)
-                self.rest -= set(data_indices)
-                # NOTE: rest is in uttrance length order when sort_by_input_length == True
-                # NOTE: otherwise in name length order when shuffle == False
-                self.offset += len(data_indices)
-            else:
-                # Last mini-batch
-                data_indices = list(self.df[self.offset: self.offset + len(self.rest)].index)
-                self._reset()
-                is_new_epoch = True
-                self._epoch += 1
-                if self._epoch == self.sort_stop_epoch:
-                    self.sort_by_input_length = False
-                    self.shuffle = True
+        if self.max_batch_frames > 0 or self.max_batch_tokens > 0:
+            return self.sample_index_bucket(batch_size)
 
+        is_new_epoch = False
+        if self.order is None:
+            self.order = self.make_order()
+        sort = self.sort_by_input_length or not self.shuffle
+
+        if self.sort_by_input_length:
+            # Change batch size dynamically
+            min_xlen = self.df.at[self.order[self.offset], 'xlen']
+            min_ylen = self.df.at[self.order[self.offset], 'ylen']
+            batch_size_tmp = self.select_batch_size(batch_size, min_xlen, min_ylen)
+        else:
+            batch_size_tmp = batch_size
+
+        data_indices = self.order[self.offset:self.offset + batch_size_tmp].tolist()
+        self.offset += len(data_indices)
+        if self.offset >= len(self.order):
+            # Last mini-batch
+            self._reset()
+            is_new_epoch = True
+            self._epoch += 1
+            if sort and self._epoch == self.sort_stop_epoch:
+                self.sort_by_input_length = False
+                self.shuffle = True
+
+        if sort:
             # Sort in the descending order for pytorch
             data_indices = data_indices[::-1]
-        else:
-            # Randomly sample uttrances
-            if len(self.rest) > batch_size:
-                data_indices = random.sample(list(self.rest), batch_size)
-                self.rest -= set(data_indices)
-            else:
-                # Last mini-batch
-                data_indices = list(self.rest)
-                self._reset()
-                is_new_epoch = True
-                self._epoch += 1
-
-            self.offset += len(data_indices)
 
         return data_indices, is_new_epoch
 
+    def make_order(self):
+        """Make the order of data indices sampled in an epoch.
+
+        Returns:
+            order (np.ndarray): data indices in the order of self.df (sorted by utterance
+                length when sort_by_input_length is True), or randomly permutated
+                every epoch when shuffle is True
+
+        """
+        order = self.df.index.values
+        if not self.sort_by_input_length and self.shuffle:
+            order = order[self.rng.permutation(len(order))]
+        return order
+
+    def sample_index_bucket(self, batch_size):
+        """Sample data indices of mini-batch made by bucketing.
+
+        Args:
+            batch_size (int): the maximum number of utterances in mini-batch
+        Returns:
+            data_indices (list):
+            is_new_epoch (bool):
+
+        """
+        if len(self.bucket_batches) == 0:
+            self.bucket_batches = self.make_bucket_batches(batch_size)
+
+        data_indices = self.bucket_batches[self.bucket_offset]
+        self.bucket_offset += 1
+        self.offset += len(data_indices)
+
+        is_new_epoch = self.bucket_offset == len(self.bucket_batches)
+        if is_new_epoch:
+            self._reset()
+            self._epoch += 1
+            if self._epoch == self.sort_stop_epoch:
+                self.sort_by_input_length = False
+                self.shuffle = True
+
+        return data_indices, is_new_epoch
+
+    def make_bucket_batches(self, batch_size):
+        """Make mini-batches of all utterances within budgets of padded frames and tokens.
+
+        Utterances are grouped into buckets of similar input lengths, and each bucket
+        is packed into mini-batches greedily. Utterances in each bucket and the order
+        of mini-batches are shuffled every epoch unless sort_by_input_length is True.
+
+        Args:
+            batch_size (int): the maximum number of utterances in mini-batch
+        Returns:
+            batches (list): A list of mini-batches, which contain data indices
+                in the descending order of input lengths
+
+        """
+        df = self.df.sort_values(by=['xlen', 'ylen'], kind='mergesort')
+        indices = list(df.index)
+        xlens = dict(zip(indices, df['xlen'].values))
+        ylens = dict(zip(indices, df['ylen'].values))
+        shuffle = not self.sort_by_input_length and self.shuffle
+
+        n_buckets = max(1, min(self.n_buckets, len(indices)))
+        bucket_size = -(-len(indices) // n_buckets)
+        batches = []
+        for i in range(0, len(indices), bucket_size):
+            bucket = indices[i:i + bucket_size]
+            if shuffle:
+                self.rng.shuffle(bucket)
+            batch, xmax, ymax = [], 0, 0
+            for idx in bucket:
+                xmax_next = max(xmax, xlens[idx])
+                ymax_next = max(ymax, ylens[idx])
+                n = len(batch) + 1
+                if len(batch) > 0 and (n > batch_size or
+                                       (self.max_batch_frames > 0 and n * xmax_next > self.max_batch_frames) or
+                                       (self.max_batch_tokens > 0 and n * ymax_next > self.max_batch_tokens)):
+                    batches.append(batch)
+                    batch, xmax_next, ymax_next = [], xlens[idx], ylens[idx]
+                batch.append(idx)
+                xmax, ymax = xmax_next, ymax_next
+            if len(batch) > 0:
+                batches.append(batch)
+
+        if shuffle:
+            self.rng.shuffle(batches)
+        elif self.sort_by_input_length and not self.short2long:
+            batches = batches[::-1]
+        # Sort in the descending order for pytorch
+        batches = [sorted(batch, key=lambda idx: (xlens[idx], ylens[idx]), reverse=True) for batch in batches]
+
+        n_frames = sum([xlens[idx] for idx in indices])
+        n_tokens = sum([ylens[idx] for idx in indices])
+        n_padded_frames = sum([len(batch) * xlens[batch[0]] for batch in batches])
+        n_padded_tokens = sum([len(batch) * max([ylens[idx] for idx in batch]) for batch in batches])
+        self.padding_efficiency = (n_frames / n_padded_frames, n_tokens / n_padded_tokens)
+        logger.info('%d mini-batches (%d utterances) in %d buckets, padding efficiency: %.3f (frames) / %.3f (tokens)' %
+                    (len(batches), len(indices), n_buckets, self.padding_efficiency[0], self.padding_efficiency[1]))
+        return batches
+
     def select_batch_size(self, batch_size, min_xlen, min_ylen):
         if not self.dynamic_batching:
             return batch_size
@@ -193,28 +310,139 @@ class Base(object):
     def reset(self):
         self._reset()
 
-        self.queue = Queue()
-        self.queue_size = 0
-
-        # Clean up multiprocessing
-        if self.preloading_process is not None:
-            self.preloading_process.terminate()
-            self.preloading_process.join()
+        # Discard mini-batches in flight (workers are kept alive)
+        self._epoch = self.epoch
+        self.n_consumed = 0
+        self.requests = deque()
+        self.received = {}
+        self.generation += 1
 
     def _reset(self):
-        """Reset data counter and offset."""
-        self.rest = set(list(self.df.index))
+        """Reset the order and offset."""
+        self.order = None
         self.offset = 0
+        self.bucket_batches = []
+        self.bucket_offset = 0
+
+    def _sampler_state(self):
+        # NOTE: order and bucket_batches are not modified in place, so they are not copied
+        return {'order': self.order,
+                'offset': self.offset,
+                'bucket_batches': self.bucket_batches,
+                'bucket_offset': self.bucket_offset,
+                '_epoch': self._epoch,
+                'sort_by_input_length': self.sort_by_input_length,
+                'shuffle': self.shuffle,
+                'rng_state': self.rng.get_state()}
+
+    def state_dict(self):
+        """Return the state of the iterator to resume training in the middle of an epoch.
+
+        Mini-batches sampled in advance but not returned by next() yet are excluded.
+
+        Returns:
+            state (dict):
+
+        """
+        if len(self.requests) > 0:
+            state = dict(self.sampler_state)
+        else:
+            state = self._sampler_state()
+        state['epoch'] = self.epoch
+        state['iteration'] = self.iteration
+        state['n_consumed'] = self.n_consumed
+        return state
+
+    def load_state_dict(self, state):
+        """Restore the state of the iterator saved by state_dict().
+
+        Args:
+            state (dict):
 
-    def preloading_loop(self, queue, df_indices_list):
-        """.
+        """
+        if state['order'] is not None and len(state['order']) != len(self):
+            raise ValueError('The number of utterances does not match the saved state: %d vs. %d' %
+                             (len(self), len(state['order'])))
+        for k in ['order', 'offset', 'bucket_batches', 'bucket_offset', '_epoch',
+                  'sort_by_input_length', 'shuffle', 'epoch', 'iteration', 'n_consumed']:
+            setattr(self, k, state[k])
+        self.rng.set_state(state['rng_state'])
+
+        # Discard mini-batches in flight (workers are kept alive)
+        self.requests = deque()
+        self.received = {}
+        self.generation += 1
+
+    def start_workers(self):
+        """Start persistent worker processes for loading mini-batches."""
+        n_workers = max(self.n_workers, 1)
+        if self.n_ques is None:
+            self.n_ques = n_workers * 2
+        self.index_queue = Queue()
+        self.batch_queue = Queue(maxsize=self.n_ques)
+        workers = []
+        for _ in range(n_workers):
+            worker = Process(target=_loader_worker, args=(self, self.index_queue, self.batch_queue))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.workers = workers
+
+    def enqueue(self, batch_size):
+        """Sample mini-batches in advance and send them to workers.
+
+        Indices are sampled in the main process, so the order of mini-batches
+        does not depend on the number of workers.
 
         Args:
-            queue ():
-            df_indices_list (np.ndarray):
+            batch_size (int): size of mini-batch
+
+        """
+        while len(self.requests) < self.n_ques and (self.max_epoch is None or self._epoch < self.max_epoch):
+            data_indices, is_new_epoch = self.sample_index(batch_size)
+            self.index_queue.put((self.generation, self.seq_id, data_indices))
+            self.requests.append((self.seq_id, data_indices, is_new_epoch, self._sampler_state()))
+            self.seq_id += 1
+
+    def dequeue(self, seq_id):
+        """Receive the mini-batch of the given sequence id.
+
+        Args:
+            seq_id (int):
+        Returns:
+            batch (dict):
 
         """
-        # print("Pre-loading started.")
-        for i in six.moves.range(len(df_indices_list)):
-            queue.put(self.make_batch(df_indices_list[i]))
-        # print("Pre-loading done.")
+        while seq_id not in self.received:
+            generation, seq_id_recv, batch, error = self.batch_queue.get()
+            if generation != self.generation:
+                continue  # NOTE: requested before reset, including errors
+            if error is not None:
+                raise RuntimeError('Error in a loader worker:\n' + error)
+            self.received[seq_id_recv] = batch
+        return self.received.pop(seq_id)
+
+    def close(self):
+        """Shut down worker processes."""
+        if self.workers is None:
+            return
+        for _ in self.workers:
+            self.index_queue.put(None)
+        # Drain the batch queue so that workers blocked on putting batches can receive None
+        tbegin = time.time()
+        while any([worker.is_alive() for worker in self.workers]) and time.time() - tbegin < 10:
+            try:
+                while True:
+                    self.batch_queue.get_nowait()
+            except queue.Empty:
+                pass
+            for worker in self.workers:
+                worker.join(timeout=0.01)
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = None
+        self.requests = deque()
+        self.received = {}
+        self.generation += 1
@@ -19,6 +19,8 @@ import random
 import os
 
 from neural_sp.datasets.loader_base import Base
+from neural_sp.datasets.manifest import is_manifest
+from neural_sp.datasets.manifest import Manifest
 from neural_sp.datasets.token_converter.character import Char2idx
 from neural_sp.datasets.token_converter.character import Idx2char
 from neural_sp.datasets.token_converter.phone import Idx2phone
@@ -42,7 +44,8 @@ class Dataset(Base):
         """A class for loading dataset.
 
         Args:
-            tsv_path (str): path to the dataset tsv file
+            tsv_path (str): path to the dataset tsv file,
+                or the manifest directory compiled from it (see utils/make_manifest.py)
             dict_path (str): path to the dictionary
             unit (str): word or wp or char or phone or word_char
             batch_size (int): size of mini-batch
@@ -94,20 +97,26 @@ class Dataset(Base):
             raise ValueError(unit)
 
         # Load dataset tsv file
-        self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
-        self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
-                                  'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
+        # NOTE: only numeric columns are kept in self.df when the manifest is used
+        self.manifest = None
+        if is_manifest(tsv_path):
+            self.manifest = Manifest(tsv_path)
+            self.df = self.manifest.to_frame()
+        else:
+            self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
+            self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
+                                      'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
 
         # Remove inappropriate utterances
         if is_test:
             print('Original utterance num: %d' % len(self.df))
             n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
+            self.df = self.df[self.df['ylen'] > 0]
             print('Removed %d empty utterances' % (n_utts - len(self.df)))
         else:
             print('Original utterance num: %d' % len(self.df))
             n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] >= min_n_tokens, axis=1)]
+            self.df = self.df[self.df['ylen'] >= min_n_tokens]
             print('Removed %d utterances (threshold)' % (n_utts - len(self.df)))
 
         # Sort tsv records
@@ -115,22 +124,22 @@ class Dataset(Base):
             self.df = self.df.reindex(np.random.permutation(self.df.index))
         elif serialize:
             assert corpus == 'swbd'
+            if self.manifest is not None:
+                self.df['utt_id'] = [self.manifest.get('utt_id', i) for i in self.df.index]
+                self.df['speaker'] = [self.manifest.get('speaker', i) for i in self.df.index]
             self.df['session'] = self.df['speaker'].apply(lambda x: str(x).split('-')[0])
             self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[-1].split('-')[0]))
             self.df = self.df.sort_values(by=['session', 'onset'], ascending=True)
+        elif self.manifest is not None:
+            self.df = self.df.sort_values(by='utt_id_rank', ascending=True)
         else:
             self.df = self.df.sort_values(by='utt_id', ascending=True)
 
         # Concatenate into a single sentence
-        concat_ids = []
         indices = list(self.df.index)
         if backward:
             indices = indices[::-1]
-        for i in indices:
-            assert self.df['token_id'][i] != ''
-            concat_ids += [self.eos] + list(map(int, self.df['token_id'][i].split()))
-        concat_ids += [self.eos]
-        # NOTE: <sos> and <eos> have the same index
+        concat_ids = self.concat_token_ids(indices)
 
         # Reshape
         n_utts = len(concat_ids)
@@ -141,6 +150,26 @@ class Dataset(Base):
     def __len__(self):
         return len(self.concat_ids.reshape((-1,)))
 
+    def concat_token_ids(self, indices):
+        """Concatenate token ids of utterances into a single sentence.
+
+        Args:
+            indices (list): data indices in the concatenated order
+        Returns:
+            concat_ids (np.ndarray or list):
+
+        """
+        if self.manifest is not None:
+            return self.manifest.concat_token_ids(indices, self.eos)
+
+        concat_ids = []
+        for i in indices:
+            assert self.df['token_id'][i] != ''
+            concat_ids += [self.eos] + list(map(int, self.df['token_id'][i].split()))
+        concat_ids += [self.eos]
+        # NOTE: <sos> and <eos> have the same index
+        return concat_ids
+
     @property
     def epoch_detail(self):
         # Floating point version of epoch
@@ -190,12 +219,7 @@ class Dataset(Base):
                 self.df = self.df.reindex(np.random.permutation(self.df.index))
 
                 # Concatenate into a single sentence
-                concat_ids = []
-                for i in list(self.df.index):
-                    assert self.df['token_id'][i] != ''
-                    concat_ids += [self.eos] + list(map(int, self.df['token_id'][i].split()))
-                concat_ids += [self.eos]
-                # NOTE: <sos> and <eos> have the same index
+                concat_ids = self.concat_token_ids(list(self.df.index))
 
                 # Reshape
                 concat_ids = concat_ids[:len(concat_ids) // self.batch_size * self.batch_size]
@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Columnar binary manifest compiled from a dataset tsv file.
+   All columns are saved as .npy files in a directory and memory-mapped when loaded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import numpy as np
+import os
+import pandas as pd
+
+MANIFEST_VERSION = 1
+
+NUMERIC_COLUMNS = ['xlen', 'xdim', 'ylen', 'ydim']
+STRING_COLUMNS = ['utt_id', 'feat_path', 'text']
+
+
+def is_manifest(path):
+    """Check whether the given path is a compiled manifest directory."""
+    return os.path.isfile(os.path.join(path, 'manifest.json'))
+
+
+def _save_strings(manifest_dir, name, strings):
+    """Save a list of strings as concatenated utf-8 bytes and offsets."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    np.save(os.path.join(manifest_dir, name + '.data.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(manifest_dir, name + '.offsets.npy'), offsets)
+
+
+def compile_manifest(tsv_path, manifest_dir):
+    """Compile a dataset tsv file into a manifest directory.
+
+    Args:
+        tsv_path (str): path to the dataset tsv file
+        manifest_dir (str): path to the output directory
+    Returns:
+        n_utts (int): number of utterances
+
+    """
+    df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
+    if not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    # Typed columns
+    for k in NUMERIC_COLUMNS:
+        np.save(os.path.join(manifest_dir, k + '.npy'), df[k].values.astype(np.int32))
+    for k in STRING_COLUMNS:
+        _save_strings(manifest_dir, k, df[k].fillna('').astype(str).tolist())
+    np.save(os.path.join(manifest_dir, 'utt_id_rank.npy'),
+            np.argsort(np.argsort(df['utt_id'].astype(str).values, kind='mergesort')).astype(np.int64))
+
+    # Ragged token ids
+    token_ids = [s.split() for s in df['token_id'].fillna('').astype(str).tolist()]
+    offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in token_ids])
+    np.save(os.path.join(manifest_dir, 'token_id.data.npy'),
+            np.array([int(i) for ids in token_ids for i in ids], dtype=np.int32))
+    np.save(os.path.join(manifest_dir, 'token_id.offsets.npy'), offsets)
+
+    # Interned speaker ids
+    speakers, speaker_ids = np.unique(df['speaker'].astype(str).values, return_inverse=True)
+    np.save(os.path.join(manifest_dir, 'speaker_id.npy'), speaker_ids.astype(np.int32))
+    _save_strings(manifest_dir, 'speaker', speakers.tolist())
+
+    with open(os.path.join(manifest_dir, 'manifest.json'), 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'n_utts': len(df),
+                   'tsv_path': os.path.abspath(tsv_path)}, f)
+    return len(df)
+
+
+class Manifest(object):
+
+    def __init__(self, manifest_dir):
+        """A memory-mapped dataset manifest.
+
+        Args:
+            manifest_dir (str): path to the directory made by compile_manifest()
+
+        """
+        with open(os.path.join(manifest_dir, 'manifest.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != MANIFEST_VERSION:
+            raise ValueError('Unsupported manifest version: %d (recompile %s)' % (meta['version'], manifest_dir))
+        self.n_utts = meta['n_utts']
+
+        def load(name):
+            return np.load(os.path.join(manifest_dir, name + '.npy'), mmap_mode='r')
+
+        self.columns = {k: load(k) for k in NUMERIC_COLUMNS + ['utt_id_rank', 'speaker_id']}
+        self.strings = {k: (load(k + '.data'), load(k + '.offsets')) for k in STRING_COLUMNS}
+        self.token_id_data = load('token_id.data')
+        self.token_id_offsets = load('token_id.offsets')
+
+        # NOTE: the speaker vocabulary is small enough to decode in advance
+        data, offsets = load('speaker.data'), load('speaker.offsets')
+        self.speakers = [data[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+                         for i in range(len(offsets) - 1)]
+
+    def __len__(self):
+        return self.n_utts
+
+    def to_frame(self):
+        """Make a data frame of numeric columns indexed by row ids.
+
+        Returns:
+            df (pd.DataFrame):
+
+        """
+        return pd.DataFrame({k: np.asarray(v) for k, v in self.columns.items()})
+
+    def get(self, key, i):
+        """Look up a value of the i-th utterance.
+
+        Args:
+            key (str): name of the column
+            i (int): row id
+        Returns:
+            value (int or str):
+
+        """
+        if key == 'speaker':
+            return self.speakers[self.columns['speaker_id'][i]]
+        if key in self.strings:
+            data, offsets = self.strings[key]
+            return data[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+        return int(self.columns[key][i])
+
+    def token_ids(self, i):
+        """Return token ids of the i-th utterance.
+
+        Args:
+            i (int): row id
+        Returns:
+            token_ids (list):
+
+        """
+        return self.token_id_data[self.token_id_offsets[i]:self.token_id_offsets[i + 1]].tolist()
+
+    def concat_token_ids(self, indices, eos):
+        """Concatenate token ids of utterances into a single sequence separated by eos.
+
+        Args:
+            indices (np.ndarray): row ids in the concatenated order
+            eos (int): index for <eos>, which is also inserted at both ends
+        Returns:
+            concat_ids (np.ndarray): of size `[n_tokens + n_utts + 1]`
+
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = np.asarray(self.token_id_offsets[indices])
+        lens = np.asarray(self.token_id_offsets[indices + 1]) - starts
+        n_tokens = int(lens.sum())
+        concat_ids = np.full(n_tokens + len(indices) + 1, eos, dtype=np.int64)
+        # position of each token within its utterance
+        pos = np.arange(n_tokens) - np.repeat(np.cumsum(lens) - lens, lens)
+        concat_ids[pos + np.repeat(np.cumsum(lens + 1) - lens, lens)] = \
+            np.asarray(self.token_id_data)[pos + np.repeat(starts, lens)]
+        return concat_ids
@@ -126,3 +126,48 @@ def focal_loss(logits, ys, ylens, alpha, gamma, size_average=False):
     if size_average:
         loss /= bs
     return loss
+
+
+def transducer_loss(log_probs_blank, log_probs_label, elens, ylens, size_average=False):
+    """Compute Transducer loss from log probabilities of blank and reference labels.
+
+    Forward variables are computed along the anti-diagonals of the `[T, L + 1]`
+    lattice, so the full `[B, T, L + 1, vocab]` distribution is not required.
+
+    Args:
+        log_probs_blank (FloatTensor): `[B, T, L + 1]`
+        log_probs_label (FloatTensor): `[B, T, L]`, log probabilities of the (u+1)-th label at (t, u)
+        elens (IntTensor): `[B]`
+        ylens (IntTensor): `[B]`
+        size_average (bool):
+    Returns:
+        loss (FloatTensor): `[1]`
+
+    """
+    bs, xmax, lmax = log_probs_blank.size()
+    elens = [int(elens[b]) for b in range(bs)]
+    ylens = [int(ylens[b]) for b in range(bs)]
+    ends = [elens[b] - 1 + ylens[b] for b in range(bs)]
+    logzero = -1e10
+
+    us = torch.arange(lmax, device=log_probs_blank.device)
+    alpha = log_probs_blank.new_full((bs, lmax), logzero)
+    alpha[:, 0] = 0
+    log_likelihood = [None] * bs
+    for n in range(max(ends) + 1):
+        if n > 0:
+            ts = n - us
+            from_blank = alpha + log_probs_blank[:, (ts - 1).clamp(0, xmax - 1), us]
+            from_blank = from_blank.masked_fill(((ts < 1) | (ts >= xmax)).unsqueeze(0), logzero)
+            from_label = alpha[:, :-1] + log_probs_label[:, ts[1:].clamp(0, xmax - 1), us[:-1]]
+            from_label = from_label.masked_fill(((ts[1:] < 0) | (ts[1:] >= xmax)).unsqueeze(0), logzero)
+            from_label = torch.cat([from_label.new_full((bs, 1), logzero), from_label], dim=1)
+            alpha = torch.logsumexp(torch.stack([from_blank, from_label], dim=0), dim=0)
+        for b in range(bs):
+            if ends[b] == n:
+                log_likelihood[b] = alpha[b, ylens[b]] + log_probs_blank[b, elens[b] - 1, ylens[b]]
+
+    loss = -torch.stack(log_likelihood).sum()
+    if size_average:
+        loss /= bs
+    return loss
@@ -200,11 +200,12 @@ class GatedConvLM(LMBase):
 
         Args:
             ys (LongTensor): `[B, L]`
-            state: dummy
-            is_asr (bool):
+            state (list): A list of length `[n_blocks]`, which contains the last
+                (kernel_size - 1) input frames of each block. `[B, in_ch, kernel_size - 1, 1]`
+            is_asr (bool): decode incrementally from the state
         Returns:
             ys_emb (FloatTensor): `[B, L, n_units]`
-            state: dummy
+            state (list): A list of length `[n_blocks]`
 
         """
         ys_emb = self.embed(ys.long())
@@ -212,7 +213,18 @@ class GatedConvLM(LMBase):
 
         # NOTE: consider embed_dim as in_ch
         ys_emb = ys_emb.unsqueeze(3)
-        ys_emb = self.blocks(ys_emb.transpose(2, 1))  # [B, out_ch, T, 1]
+        if is_asr:
+            # Feed only new tokens by keeping the last input frames of each block
+            ys_emb = ys_emb.transpose(2, 1)
+            if state is None:
+                state = [None] * len(self.blocks)
+            new_state = []
+            for block, buf in zip(self.blocks, state):
+                ys_emb, buf = block.forward_incremental(ys_emb, buf)
+                new_state.append(buf)
+            state = new_state
+        else:
+            ys_emb = self.blocks(ys_emb.transpose(2, 1))  # [B, out_ch, T, 1]
         ys_emb = ys_emb.transpose(2, 1).contiguous()  # `[B, T, out_ch, 1]`
         ys_emb = ys_emb.squeeze(3)
 
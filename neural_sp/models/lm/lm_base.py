@@ -150,14 +150,20 @@ class LMBase(ModelBase):
                 - RNNLM: dict
                     hxs (FloatTensor): `[n_layers, B, n_units]`
                     cxs (FloatTensor): `[n_layers, B, n_units]`
-                - TransformerLM: FloatTensor `[B, T', n_units]`
+                - TransformerLM: dict
+                    key (FloatTensor): `[n_layers, B, n_heads, T', d_k]`
+                    value (FloatTensor): `[n_layers, B, n_heads, T', d_k]`
+                - GatedConvLM: list of FloatTensor `[B, in_ch, kernel_size - 1, 1]`
         Returns:
             out (FloatTensor): `[B, T, vocab]`
             state:
                 - RNNLM: dict
                     hxs (FloatTensor): `[n_layers, B, n_units]`
                     cxs (FloatTensor): `[n_layers, B, n_units]`
-                - TransformerLM: FloatTensor `[B, T', n_units]`
+                - TransformerLM: dict
+                    key (FloatTensor): `[n_layers, B, n_heads, T', d_k]`
+                    value (FloatTensor): `[n_layers, B, n_heads, T', d_k]`
+                - GatedConvLM: list of FloatTensor `[B, in_ch, kernel_size - 1, 1]`
             log_probs (FloatTensor): `[B, T, vocab]`
 
         """
@@ -124,17 +124,17 @@ class TransformerLM(LMBase):
 
         Args:
             ys (FloatTensor): `[B, L]`
-            state: previous tokens
-            is_asr (bool):
+            state (dict): keys and values of self-attention of the previous tokens
+                key (FloatTensor): `[n_layers, B, n_heads, L', d_k]`
+                value (FloatTensor): `[n_layers, B, n_heads, L', d_k]`
+            is_asr (bool): decode incrementally from the state
         Returns:
             ys_emb (FloatTensor): `[B, L, n_units]`
-            state: previous tokens
+            state (dict): keys and values of self-attention of all tokens
 
         """
-        # Concatenate previous tokens
-        if is_asr and state is not None:
-            ys = torch.cat([state, ys], dim=1)
-            # NOTE: this is used for ASR decoding
+        if is_asr:
+            return self._decode_incremental(ys, state)
 
         ys_emb = self.embed(ys.long())
 
@@ -154,9 +154,41 @@ class TransformerLM(LMBase):
                 setattr(self, 'yy_aws_layer%d' % l, tensor2np(yy_aws))
         ys_emb = self.norm_out(ys_emb)
 
-        if is_asr:
-            state = ys
+        return ys_emb, state
+
+    def _decode_incremental(self, ys, state=None):
+        """Decode only new tokens by reusing keys and values of the previous tokens.
+
+        Args:
+            ys (FloatTensor): `[B, L]`
+            state (dict): keys and values of self-attention of the previous tokens
+        Returns:
+            ys_emb (FloatTensor): `[B, L, n_units]`
+            state (dict): keys and values of self-attention of all tokens
+
+        """
+        bs, ymax = ys.size()[:2]
+        offset = 0 if state is None else state['key'].size(3)
+        caches = [{} if state is None else {'key': state['key'][l], 'value': state['value'][l]}
+                  for l in range(self.n_layers)]
+
+        # Create the self-attention mask (not necessary for a single token)
+        yy_mask = None
+        if ymax > 1:
+            pos_k = torch.arange(0, offset + ymax, dtype=torch.int64)
+            pos_q = torch.arange(offset, offset + ymax, dtype=torch.int64)
+            yy_mask = (pos_k.unsqueeze(0) <= pos_q.unsqueeze(1)).unsqueeze(0).unsqueeze(1)
+            if self.device_id >= 0:
+                yy_mask = yy_mask.cuda(self.device_id)
+            yy_mask = yy_mask.expand(bs, self.n_heads, ymax, offset + ymax)
+
+        ys_emb = self.pos_enc(self.embed(ys.long()), offset)
+        for l in range(self.n_layers):
+            ys_emb, _, _ = self.layers[l](ys_emb, yy_mask, cache=caches[l])
+        ys_emb = self.norm_out(ys_emb)
 
+        state = {'key': torch.stack([c['key'] for c in caches], dim=0),
+                 'value': torch.stack([c['value'] for c in caches], dim=0)}
         return ys_emb, state
 
     def plot_attention(self, n_cols=4):
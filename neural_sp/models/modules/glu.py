@@ -11,6 +11,7 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import OrderedDict
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -30,6 +31,8 @@ class GLUBlock(nn.Module):
     def __init__(self, kernel_size, in_ch, out_ch, bottlececk_dim=0, dropout=0.0):
         super().__init__()
 
+        self.kernel_size = kernel_size
+
         self.conv_residual = None
         if in_ch != out_ch:
             self.conv_residual = nn.utils.weight_norm(
@@ -82,3 +85,28 @@ class GLUBlock(nn.Module):
         xs = F.glu(xs, dim=1)
         xs = xs + residual
         return xs
+
+    def forward_incremental(self, xs, state=None):
+        """Forward computation for new frames only.
+
+        Args:
+            xs (FloatTensor): `[B, in_ch, T, feat_dim]`
+            state (FloatTensor): last (kernel_size - 1) input frames. `[B, in_ch, kernel_size - 1, feat_dim]`
+        Returns:
+            out (FloatTensor): `[B, out_ch, T, feat_dim]`
+            state (FloatTensor): `[B, in_ch, kernel_size - 1, feat_dim]`
+
+        """
+        residual = xs
+        if self.conv_residual is not None:
+            residual = self.dropout_residual(self.conv_residual(residual))
+        if self.kernel_size > 1:
+            if state is None:
+                # NOTE: equivalent to the left padding in forward()
+                state = xs.new_zeros(xs.size(0), xs.size(1), self.kernel_size - 1, xs.size(3))
+            xs = torch.cat([state, xs], dim=2)  # `[B, in_ch, kernel-1+T, feat_dim]`
+            state = xs[:, :, -(self.kernel_size - 1):]
+        xs = self.layers(xs)  # `[B, out_ch * 2, T ,1]`
+        xs = F.glu(xs, dim=1)
+        xs = xs + residual
+        return xs, state
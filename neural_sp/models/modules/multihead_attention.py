@@ -82,7 +82,7 @@ class MultiheadAttentionMechanism(nn.Module):
         self.value = None
         self.mask = None
 
-    def forward(self, key, value, query, mask, aw=None):
+    def forward(self, key, value, query, mask, aw=None, cache=None):
         """Forward computation.
 
         Args:
@@ -92,12 +92,16 @@ class MultiheadAttentionMechanism(nn.Module):
             query (FloatTensor): `[B, qlen, query_dim]`
             mask (): `[B, n_heads, key, query]`
             aw: dummy
+            cache (dict): projected keys and values of the previous positions
+                for incremental decoding, which is updated in place
+                key (FloatTensor): `[B, n_heads, klen', d_k]`
+                value (FloatTensor): `[B, n_heads, klen', d_k]`
         Returns:
             cv (FloatTensor): `[B, qlen, value_dim]`
-            aw (FloatTensor): `[B, n_heads, qlen, klen]`
+            aw (FloatTensor): `[B, n_heads, qlen, klen' + klen]`
 
         """
-        bs, klen = key.size()[: 2]
+        bs = key.size(0)
         qlen = query.size(1)
 
         if self.key is None:
@@ -106,6 +110,13 @@ class MultiheadAttentionMechanism(nn.Module):
             self.key = key.transpose(2, 1).contiguous()      # `[B, n_heads, klen, d_k]`
             self.value = value.transpose(2, 1).contiguous()  # `[B, n_heads, klen, d_k]`
             self.mask = mask
+            if cache is not None:
+                if 'key' in cache:
+                    self.key = torch.cat([cache['key'], self.key], dim=2)
+                    self.value = torch.cat([cache['value'], self.value], dim=2)
+                cache['key'] = self.key
+                cache['value'] = self.value
+        klen = self.key.size(2)
 
         query = self.w_query(query).view(bs, -1, self.n_heads, self.d_k)
         query = query.transpose(2, 1).contiguous()  # `[B, n_heads, qlen, d_k]`
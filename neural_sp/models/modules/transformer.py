@@ -47,16 +47,26 @@ class PositionalEncoding(nn.Module):
 
             self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, xs):
+    def forward(self, xs, offset=0):
+        """Add positional encodings.
+
+        Args:
+            xs (FloatTensor): `[B, L, d_model]`
+            offset (int): position of the first element (used for incremental decoding)
+        Returns:
+            xs (FloatTensor): `[B, L, d_model]`
+
+        """
         xs = xs * math.sqrt(self.d_model)
 
         if not self.pe_type:
             return xs
 
         if self.pe_type == 'add':
-            xs = xs + self.pe[:, :xs.size(1)]
+            xs = xs + self.pe[:, offset:offset + xs.size(1)]
         elif self.pe_type == 'concat':
-            xs = torch.cat([xs, self.pe[:, :xs.size(1)]], dim=-1)
+            pe = self.pe[:, offset:offset + xs.size(1)].expand(xs.size(0), xs.size(1), self.pe.size(2))
+            xs = torch.cat([xs, pe], dim=-1)
         else:
             raise NotImplementedError(self.pe_type)
         return self.dropout(xs)
@@ -215,7 +225,7 @@ class TransformerDecoderBlock(nn.Module):
         self.feed_forward = PositionwiseFeedForward(d_model, d_ff, dropout)
         self.dropout3 = nn.Dropout(dropout)
 
-    def forward(self, ys, yy_mask=None, xs=None, xy_mask=None):
+    def forward(self, ys, yy_mask=None, xs=None, xy_mask=None, cache=None):
         """Transformer decoder layer definition.
 
         Args:
@@ -223,6 +233,10 @@ class TransformerDecoderBlock(nn.Module):
             yy_mask ():
             xs (FloatTensor): encoder outputs. `[B, T, d_model]`
             xy_mask ():
+            cache (dict): keys and values of self-attention of the previous positions
+                for incremental decoding, which is updated in place.
+                Keys and values of source-target attention are also kept
+                until `reset()` is called.
         Returns:
             ys (FloatTensor): `[B, L, d_model]`
             yy_aw (FloatTensor)`[B, L, L]`
@@ -235,13 +249,14 @@ class TransformerDecoderBlock(nn.Module):
         else:
             self.self_attn.reset()
             _ys = self.norm1(ys)
-            _ys, yy_aw = self.self_attn(_ys, _ys, _ys, mask=yy_mask)
+            _ys, yy_aw = self.self_attn(_ys, _ys, _ys, mask=yy_mask, cache=cache)
             ys = self.dropout1(_ys) + ys
 
         # attention for encoder stacks
         xy_aw = None
         if self.src_attention:
-            self.src_attn.reset()
+            if cache is None:
+                self.src_attn.reset()
             _ys = self.norm2(ys)
             _ys, xy_aw = self.src_attn(key=xs, value=xs, query=_ys, mask=xy_mask)
             ys = self.dropout2(_ys) + ys
@@ -252,3 +267,8 @@ class TransformerDecoderBlock(nn.Module):
         ys = self.dropout3(_ys) + ys
 
         return ys, yy_aw, xy_aw
+
+    def reset(self):
+        """Reset keys and values of source-target attention kept for incremental decoding."""
+        if self.src_attention:
+            self.src_attn.reset()
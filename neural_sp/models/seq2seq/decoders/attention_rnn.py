@@ -27,8 +27,21 @@ from neural_sp.models.modules.linear import LinearND
 from neural_sp.models.modules.multihead_attention import MultiheadAttentionMechanism
 from neural_sp.models.modules.singlehead_attention import AttentionMechanism
 from neural_sp.models.modules.zoneout import zoneout_wrapper
+from neural_sp.models.seq2seq.decoders.beam_search import add_coverage_penalty
+from neural_sp.models.seq2seq.decoders.beam_search import add_ctc_scores
+from neural_sp.models.seq2seq.decoders.beam_search import add_length_penalty
+from neural_sp.models.seq2seq.decoders.beam_search import BeamHistory
+from neural_sp.models.seq2seq.decoders.beam_search import EndedHypotheses
+from neural_sp.models.seq2seq.decoders.beam_search import extend_prefixes
+from neural_sp.models.seq2seq.decoders.beam_search import get_lm_score_cache
+from neural_sp.models.seq2seq.decoders.beam_search import log_hyps
+from neural_sp.models.seq2seq.decoders.beam_search import mask_candidates
+from neural_sp.models.seq2seq.decoders.beam_search import predict_lm_cache
+from neural_sp.models.seq2seq.decoders.beam_search import select_lmstate
+from neural_sp.models.seq2seq.decoders.beam_search import select_topk
 from neural_sp.models.seq2seq.decoders.ctc import CTC
 from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScore
+from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScoreTH
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.torch_utils import compute_accuracy
 from neural_sp.models.torch_utils import np2tensor
@@ -38,6 +51,8 @@ from neural_sp.models.torch_utils import tensor2np
 
 random.seed(1)
 
+NEG_INF = float(np.finfo(np.float32).min)
+
 
 class RNNDecoder(DecoderBase):
     """RNN decoder.
@@ -77,6 +92,7 @@ class RNNDecoder(DecoderBase):
         ctc_weight (float):
         ctc_lsm_prob (float): label smoothing probability for CTC
         ctc_fc_list (list):
+        ctc_loss_impl (str): implementation of CTC loss (warpctc or pytorch)
         input_feeding (bool):
         backward (bool): decode in the backward order
         lm_fusion (RNNLM):
@@ -128,6 +144,7 @@ class RNNDecoder(DecoderBase):
                  ctc_weight=0.0,
                  ctc_lsm_prob=0.0,
                  ctc_fc_list=[],
+                 ctc_loss_impl='warpctc',
                  input_feeding=False,
                  backward=False,
                  lm_fusion=None,
@@ -209,6 +226,7 @@ class RNNDecoder(DecoderBase):
                            dropout=dropout,
                            lsm_prob=ctc_lsm_prob,
                            fc_list=ctc_fc_list,
+                           loss_impl=ctc_loss_impl,
                            param_init=param_init)
 
         if ctc_weight < global_weight:
@@ -926,21 +944,34 @@ class RNNDecoder(DecoderBase):
         cache_lambda_lm = params['recog_cache_lambda_lm']
         cache_type = params['recog_cache_type']
 
+        # Decode all utterances in the mini-batch at once unless per-utterance
+        # features (ensemble, cache, oracle, state carry over, reverse LM) are required
+        if n_models == 1 and n_caches == 0 and not oracle and lm_rev is None \
+                and not asr_state_carry_over and not lm_state_carry_over:
+            return self.batch_beam_search(eouts, elens, params, idx2token, lm, ctc_log_probs,
+                                          nbest, exclude_eos, refs_id, utt_ids, speakers)
+
+        if n_caches > 0:
+            assert bs == 1  # NOTE: caches are updated with the first hypothesis of the last utterance
+
         if lm is not None:
             lm.eval()
         if lm_rev is not None:
             lm_rev.eval()
-
-        # For joint CTC-Attention decoding
-        if ctc_weight > 0 and ctc_log_probs is not None:
-            if self.bwd:
-                ctc_prefix_score = CTCPrefixScore(tensor2np(ctc_log_probs)[0][::-1], self.blank, self.eos)
-            else:
-                ctc_prefix_score = CTCPrefixScore(tensor2np(ctc_log_probs)[0], self.blank, self.eos)
+        lm_cache = get_lm_score_cache(lm, params) if self.lm is None and lm_weight > 0 else None
 
         nbest_hyps_idx, aws, scores = [], [], []
         eos_flags = []
         for b in range(bs):
+            # For joint CTC-Attention decoding
+            if ctc_weight > 0 and ctc_log_probs is not None:
+                if self.bwd:
+                    ctc_prefix_score = CTCPrefixScore(
+                        tensor2np(ctc_log_probs)[b, :elens[b]][::-1], self.blank, self.eos)
+                else:
+                    ctc_prefix_score = CTCPrefixScore(
+                        tensor2np(ctc_log_probs)[b, :elens[b]], self.blank, self.eos)
+
             # Initialization per utterance
             dstates = self.zero_state(1)
             cv = eouts.new_zeros(1, 1, self.dec_n_units if self.input_feeding else self.enc_n_units)
@@ -1005,6 +1036,12 @@ class RNNDecoder(DecoderBase):
                         # Update LM states for LM fusion
                         lmout, lmstate, lm_log_probs = self.lm.predict(
                             eouts.new_zeros(1, 1).fill_(prev_idx), beam['lmstate'])
+                    elif lm_weight > 0 and lm is not None and lm_cache is not None:
+                        # Look up LM scores of the prefix for shallow fusion
+                        prefix = tuple(([self.eos] + refs_id[b])[1:t + 1]) if oracle else tuple(beam['hyp'][1:])
+                        prefix = (refs_id[0][0] if self.replace_sos else self.eos,) + prefix
+                        lmout, lmstate = None, None
+                        lm_log_probs = lm_cache.predict([prefix]).unsqueeze(1)
                     elif lm_weight > 0 and lm is not None:
                         # Update LM states for shallow fusion
                         lmout, lmstate, lm_log_probs = lm.predict(
@@ -1186,7 +1223,7 @@ class RNNDecoder(DecoderBase):
                     cp = 0.0
                     aw_mat = None
                     if cp_weight > 0:
-                        aw_mat = torch.stack(beam['aws'][1:] + [aw], dim=-1)  # `[B, T, len(hyp), n_heads]`
+                        aw_mat = torch.stack(beam['aws'][1:] + [aw], dim=2)  # `[B, T, len(hyp), n_heads]`
                         aw_mat = aw_mat[:, :, :, 0]
                         if gnmt_decoding:
                             aw_mat = torch.log(aw_mat.sum(-1))
@@ -1206,7 +1243,7 @@ class RNNDecoder(DecoderBase):
                     if ctc_weight > 0 and ctc_log_probs is not None:
                         ctc_scores, ctc_states = ctc_prefix_score(
                             beam['hyp'], tensor2np(topk_ids[0]), beam['ctc_state'])
-                        total_scores_ctc = torch.from_numpy(ctc_scores).cuda(self.device_id)
+                        total_scores_ctc = np2tensor(ctc_scores, self.device_id)
                         total_scores_topk += total_scores_ctc * ctc_weight
                         # Sort again
                         total_scores_topk, joint_ids_topk = torch.topk(
@@ -1345,6 +1382,10 @@ class RNNDecoder(DecoderBase):
                 if n_caches > 0:
                     logger.info('Cache: %d' % (len(self.fifo_cache_ids) + len(end_hyps[k]['cache_ids'])))
 
+            # Store ASR/LM state for the next utterance
+            self.dstates_final = end_hyps[0]['dstates']
+            self.lmstate_final = end_hyps[0]['lmstate']
+
         # Concatenate in L dimension
         for b in range(len(aws)):
             for n in range(nbest):
@@ -1469,15 +1510,225 @@ class RNNDecoder(DecoderBase):
                             self.dict_cache_lm.pop(oldest_id)
                 self.total_step += len(end_hyps[0]['hyp'][1:])
 
-        # Store ASR/LM state
-        self.dstates_final = end_hyps[0]['dstates']
-        self.lmstate_final = end_hyps[0]['lmstate']
+        if lm_cache is not None:
+            logger.info(lm_cache.stats())
 
         if 'speech' in cache_type:
             return nbest_hyps_idx, aws, scores, (cache_sp_attn_hist, cache_idx_hist)
         else:
             return nbest_hyps_idx, aws, scores, (cache_lm_attn_hist, cache_idx_hist)
 
+    def batch_beam_search(self, eouts, elens, params, idx2token,
+                          lm=None, ctc_log_probs=None, nbest=1, exclude_eos=False,
+                          refs_id=None, utt_ids=None, speakers=None):
+        """Batched beam search decoding.
+
+        All hypotheses in the mini-batch are stacked as `[B * beam]` and advanced by
+        a single recurrency/attention/softmax call per output step.
+
+        Args:
+            eouts (FloatTensor): `[B, T, dec_n_units]`
+            elens (IntTensor): `[B]`
+            params (dict): same as in beam_search
+            idx2token (): converter from index to token
+            lm (RNNLM or GatedConvLM or TransformerLM):
+            ctc_log_probs (FloatTensor): `[B, T, vocab]`
+            nbest (int):
+            exclude_eos (bool):
+            refs_id (list):
+            utt_ids (list):
+            speakers (list):
+        Returns:
+            nbest_hyps_idx (list): A list of length `[B]`, which contains list of N hypotheses
+            aws (list): A list of length `[B]`, which contains arrays of size `[L, T]`
+            scores (list):
+            cache_info (tuple): dummy
+
+        """
+        logger = logging.getLogger("decoding")
+
+        bs = eouts.size(0)
+        elens = [int(elens[b]) for b in range(bs)]
+        xmax = max(elens)
+
+        beam_width = params['recog_beam_width']
+        ctc_weight = params['recog_ctc_weight']
+        max_len_ratio = params['recog_max_len_ratio']
+        min_len_ratio = params['recog_min_len_ratio']
+        lp_weight = params['recog_length_penalty']
+        cp_weight = params['recog_coverage_penalty']
+        cp_threshold = params['recog_coverage_threshold']
+        lm_weight = params['recog_lm_weight']
+        gnmt_decoding = params['recog_gnmt_decoding']
+        eos_threshold = params['recog_eos_threshold']
+
+        if lm is not None:
+            lm.eval()
+        lm_cache = get_lm_score_cache(lm, params) if self.lm is None and lm_weight > 0 else None
+
+        # Expand encoder outputs for all hypotheses
+        n_hyps = bs * beam_width
+        eouts = eouts[:, :xmax].unsqueeze(1).expand(
+            bs, beam_width, xmax, eouts.size(2)).contiguous().view(n_hyps, xmax, -1)
+        elens_hyp = torch.IntTensor([elens[i // beam_width] for i in range(n_hyps)])
+        xmask = make_pad_mask(elens_hyp, self.device_id)  # `[B * beam, T]`
+        mask = xmask.unsqueeze(1).unsqueeze(2) if self.score.n_heads > 1 else xmask
+
+        # For joint CTC-Attention decoding
+        ctc_prefix_score = None
+        ctc_state = None
+        if ctc_weight > 0 and ctc_log_probs is not None:
+            ctc_log_probs = ctc_log_probs[:, :xmax]
+            if self.bwd:
+                ctc_log_probs = ctc_log_probs.clone()
+                for b in range(bs):
+                    ctc_log_probs[b, :elens[b]] = ctc_log_probs[b, :elens[b]].flip(0)
+            ctc_prefix_score = CTCPrefixScoreTH(ctc_log_probs, elens, self.blank, self.eos, beam_width,
+                                                window=params['recog_ctc_window'])
+            ctc_state = ctc_prefix_score.initial_state()
+
+        # Initialization
+        dstates = self.zero_state(n_hyps)
+        cv = eouts.new_zeros(n_hyps, 1, self.dec_n_units if self.input_feeding else self.enc_n_units)
+        self.score.reset()
+        aw = None
+        lmstate = None
+        y = eouts.new_zeros(n_hyps, 1, dtype=torch.int64).fill_(
+            refs_id[0][0] if self.replace_sos else self.eos)
+        prefixes = [(refs_id[0][0] if self.replace_sos else self.eos,)] * n_hyps  # for LM score cache
+
+        # NOTE: only the first hypothesis of each utterance is alive at the first step
+        hyp_scores = eouts.new_zeros(bs, beam_width)
+        hyp_scores[:, 1:] = NEG_INF
+        hyp_scores = hyp_scores.view(-1)
+        scores_attn = eouts.new_zeros(n_hyps)
+        scores_lm = eouts.new_zeros(n_hyps)
+        scores_ctc = eouts.new_zeros(n_hyps)
+        cps = eouts.new_zeros(n_hyps)
+        aw_sum = eouts.new_zeros(n_hyps, xmax)  # accumulated attention weights for coverage penalty
+        offset = torch.arange(0, n_hyps, beam_width, dtype=torch.int64).unsqueeze(1)
+        if self.device_id >= 0:
+            offset = offset.cuda(self.device_id)
+        min_lens = eouts.new_tensor([elens[i // beam_width] * min_len_ratio for i in range(n_hyps)])
+
+        ymax = [int(math.floor(elens[b] * max_len_ratio)) + 1 for b in range(bs)]
+        ended = EndedHypotheses(bs, beam_width, self.eos, ymax)
+        keep_aws = params['recog_keep_attention'] or params['recog_fwd_bwd_attention'] or \
+            params['recog_resolving_unk']
+        history = BeamHistory(n_hyps, max(ymax), self.device_id, keep_aws)
+        for t in range(max(ymax)):
+            if self.lm is not None:
+                # Update LM states for LM fusion
+                lmout, lmstate, lm_log_probs = self.lm.predict(y, lmstate)
+            elif lm_weight > 0 and lm is not None and lm_cache is not None:
+                # Look up LM scores of alive hypotheses for shallow fusion
+                lmout, lmstate = None, None
+                lm_log_probs = predict_lm_cache(lm_cache, prefixes, hyp_scores)
+            elif lm_weight > 0 and lm is not None:
+                # Update LM states for shallow fusion
+                lmout, lmstate, lm_log_probs = lm.predict(y, lmstate)
+            else:
+                lmout, lmstate, lm_log_probs = None, None, None
+
+            # Recurrency -> Score -> Generate
+            dstates = self.recurrency(self.embed(y), cv, dstates['dstate'])
+            cv, aw = self.score(eouts, eouts, dstates['dout_score'], mask, aw)
+            attn_v, _ = self.generate(cv, dstates['dout_gen'], lmout)
+            if self.adaptive_softmax is None:
+                local_scores_attn = F.log_softmax(self.output(attn_v).squeeze(1), dim=-1)
+            else:
+                local_scores_attn = self.adaptive_softmax.log_prob(attn_v.view(-1, attn_v.size(2)))
+
+            # Attention scores
+            scores_attn_all = scores_attn.unsqueeze(1) + local_scores_attn  # `[B * beam, vocab]`
+            total_scores, topk_ids = torch.topk(
+                scores_attn_all * (1 - ctc_weight), k=beam_width, dim=1, largest=True, sorted=True)
+
+            # Add LM score <after> top-K selection
+            if lm_weight > 0 and lm is not None:
+                total_scores_lm = scores_lm.unsqueeze(1) + lm_log_probs[:, -1].gather(1, topk_ids)
+                total_scores += total_scores_lm * lm_weight
+            else:
+                total_scores_lm = total_scores.new_zeros(total_scores.size())
+
+            # Add length penalty
+            total_scores = add_length_penalty(total_scores, t, lp_weight, gnmt_decoding)
+
+            # Add coverage penalty
+            aw_h0 = aw[:, 0, 0] if self.score.n_heads > 1 else aw[:, :, 0]  # `[B * beam, T]` (the first head)
+            total_scores, cp, aw_sum = add_coverage_penalty(total_scores, aw_h0, aw_sum, xmask, cp_weight, cp_threshold,
+                                                            gnmt_decoding, self.score.n_heads)
+
+            # CTC score
+            peaks = None
+            if ctc_prefix_score is not None and params['recog_ctc_window'] > 0 and \
+                    params['recog_ctc_window_center'] == 'attention':
+                peaks = aw_h0.max(1)[1]
+                if self.bwd:
+                    peaks = ctc_prefix_score.last_frames - peaks
+            total_scores, topk_ids, total_scores_lm, total_scores_ctc, ctc_states_all, joint_ids_topk = add_ctc_scores(
+                ctc_prefix_score, total_scores, topk_ids, total_scores_lm,
+                t, y[:, 0], ctc_state, hyp_scores, ctc_weight, beam_width, peaks)
+
+            # Exclude short hypotheses, apply the EOS threshold and exclude completed hypotheses
+            total_scores = mask_candidates(total_scores, topk_ids, local_scores_attn, hyp_scores,
+                                           self.eos, eos_threshold, min_lens, t)
+
+            # Pick up the top-K hypotheses among beam * beam candidates per utterance
+            hyp_scores, best_ids, parent_ids, tokens = select_topk(total_scores, topk_ids, beam_width, offset)
+            scores_attn = scores_attn_all[parent_ids, tokens]
+            scores_lm = total_scores_lm.view(bs, -1).gather(1, best_ids).view(-1)
+            scores_ctc = total_scores_ctc.view(bs, -1).gather(1, best_ids).view(-1)
+            cps = cp.index_select(0, parent_ids)
+            if ctc_prefix_score is not None:
+                cand_ids = joint_ids_topk.view(bs, -1).gather(1, best_ids).view(-1)
+                ctc_state = ctc_prefix_score.select_state(ctc_states_all, parent_ids, cand_ids)
+
+            # Reorder states by the parent hypotheses
+            hxs, cxs = dstates['dstate']
+            dstates['dstate'] = ([h.index_select(0, parent_ids) for h in hxs],
+                                 [c.index_select(0, parent_ids) for c in cxs])
+            cv = (attn_v if self.input_feeding else cv).index_select(0, parent_ids)
+            aw = aw.index_select(0, parent_ids)
+            if cp_weight > 0:
+                aw_sum = aw_sum.index_select(0, parent_ids)
+            lmstate = select_lmstate(lmstate, parent_ids)
+            history.append(tokens, parent_ids, hyp_scores, aw)
+            y = tokens.unsqueeze(1)
+            if lm_cache is not None:
+                prefixes = extend_prefixes(prefixes, parent_ids, tokens)
+
+            # Remove complete hypotheses
+            hyp_scores = ended.update(t, tokens, hyp_scores, {'score': hyp_scores,
+                                                              'score_attn': scores_attn,
+                                                              'score_cp': cps,
+                                                              'score_ctc': scores_ctc,
+                                                              'score_lm': scores_lm})
+            if ended.all_finished:
+                break
+
+        if self.score.n_heads > 1:
+            nbest_hyps_idx, aws, scores, sorted_hyps = ended.nbest(
+                history, nbest, elens, self.bwd, exclude_eos)
+        else:
+            nbest_hyps_idx, aws, scores, sorted_hyps = ended.nbest(
+                history, nbest, elens, self.bwd, exclude_eos, trim_aws=lambda aw, xlen: aw[:, :xlen])
+
+        weights = [('att', 'score_attn', 1 - ctc_weight), ('cp', 'score_cp', cp_weight)]
+        if ctc_weight > 0 and ctc_log_probs is not None:
+            weights.append(('ctc', 'score_ctc', ctc_weight))
+        if lm_weight > 0 and lm is not None:
+            weights.append(('lm', 'score_lm', lm_weight))
+        for b in range(bs):
+            log_hyps(sorted_hyps[b], idx2token, weights, self.bwd,
+                     utt_id=utt_ids[b] if utt_ids is not None else None,
+                     ref=refs_id[b] if refs_id is not None and self.vocab == idx2token.vocab else None)
+
+        if lm_cache is not None:
+            logger.info(lm_cache.stats())
+
+        return nbest_hyps_idx, aws, scores, (None, None)
+
     def reset_global_cache(self):
         """Reset global cache when the speaker/session is changed."""
         self.fifo_cache_ids = []
@@ -0,0 +1,687 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Utilities for batched beam search."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import logging
+import math
+import numpy as np
+import torch
+
+from neural_sp.models.torch_utils import tensor2np
+
+NEG_INF = float(np.finfo(np.float32).min)
+
+
+class BeamHistory(object):
+    """History of hypotheses stacked in the batch dimension.
+
+    Token ids, scores and parent pointers of all hypotheses are kept in
+    preallocated `[max_len, n_hyps]` tensors, and each hypothesis is rebuilt
+    by backtracking the parent pointers at the end of decoding.
+
+    Args:
+        n_hyps (int): number of hypotheses (B * beam)
+        max_len (int): maximum number of steps
+        device_id (int):
+        keep_aws (bool): keep attention weights for backtracking
+
+    """
+
+    def __init__(self, n_hyps, max_len, device_id=-1, keep_aws=False):
+
+        self.n_hyps = n_hyps
+        self.max_len = max_len
+        self.keep_aws = keep_aws
+
+        self.tokens = torch.zeros((max_len, n_hyps), dtype=torch.int64)
+        self.parents = torch.zeros((max_len, n_hyps), dtype=torch.int64)
+        self.scores = torch.zeros((max_len, n_hyps), dtype=torch.float32)
+        if device_id >= 0:
+            self.tokens = self.tokens.cuda(device_id)
+            self.parents = self.parents.cuda(device_id)
+            self.scores = self.scores.cuda(device_id)
+        self.aws = []
+        self.step = 0
+
+    def append(self, tokens, parent_ids, scores, aw=None):
+        """Register hypotheses selected at the current step.
+
+        Args:
+            tokens (LongTensor): `[n_hyps]`
+            parent_ids (LongTensor): `[n_hyps]`, indices of hypotheses at the previous step
+            scores (FloatTensor): `[n_hyps]`
+            aw (FloatTensor): `[n_hyps, ...]`, already reordered by parent_ids
+
+        """
+        assert self.step < self.max_len
+        self.tokens[self.step] = tokens
+        self.parents[self.step] = parent_ids
+        self.scores[self.step] = scores
+        if self.keep_aws:
+            self.aws.append(aw)
+        self.step += 1
+
+    def backtrack(self, ends):
+        """Rebuild hypotheses by following parent pointers.
+
+        Args:
+            ends (list): A list of tuples (step, index) of the last token of each hypothesis
+        Returns:
+            ys (list): A list of length `[len(ends)]`, which contains lists of size `[L]`
+            hist_scores (list): A list of length `[len(ends)]`, which contains lists of size `[L]`
+            aws (list): A list of length `[len(ends)]`, which contains arrays of size `[L, ...]`
+                or None if attention weights are not kept
+
+        """
+        tokens = tensor2np(self.tokens[:self.step])
+        parents = tensor2np(self.parents[:self.step])
+        scores = tensor2np(self.scores[:self.step])
+
+        ys, hist_scores, paths = [], [], []
+        for t_end, i in ends:
+            path = [0] * (t_end + 1)
+            for t in range(t_end, -1, -1):
+                path[t] = i
+                i = parents[t, i]
+            ys.append([int(tokens[t, path[t]]) for t in range(t_end + 1)])
+            hist_scores.append([float(scores[t, path[t]]) for t in range(t_end + 1)])
+            paths.append(path)
+
+        if not self.keep_aws:
+            return ys, hist_scores, None
+
+        # Gather attention weights step by step to avoid per-hypothesis copies
+        aws = [[] for _ in range(len(ends))]
+        for t in range(max([t_end for t_end, _ in ends] + [-1]) + 1):
+            ids = [n for n in range(len(ends)) if t < len(paths[n])]
+            ids_t = torch.LongTensor([paths[n][t] for n in ids]).to(self.aws[t].device)
+            aws_t = tensor2np(self.aws[t].index_select(0, ids_t))
+            for j, n in enumerate(ids):
+                aws[n].append(aws_t[j])
+        return ys, hist_scores, aws
+
+
+class EndedHypotheses(object):
+    """Hypotheses finished in each utterance during batched beam search.
+
+    Hypotheses are registered with the slot of their last token in BeamHistory,
+    and token sequences are recovered by backtracking at the end of decoding.
+
+    Args:
+        bs (int): batch size
+        beam_width (int): number of hypotheses per utterance
+        eos (int): index of <eos>
+        ymax (list): A list of length `[B]`, maximum number of steps of each utterance
+
+    """
+
+    def __init__(self, bs, beam_width, eos, ymax):
+
+        self.bs = bs
+        self.beam_width = beam_width
+        self.eos = eos
+        self.ymax = ymax
+
+        self.end_hyps = [[] for _ in range(bs)]  # hypotheses ended with <eos>
+        self.hyps = [[] for _ in range(bs)]  # hypotheses alive when the utterance is finished
+        self.is_finished = [False] * bs
+
+    @property
+    def all_finished(self):
+        return all(self.is_finished)
+
+    def make_hyps(self, ids, t, scores):
+        """Register hypotheses in the given slots.
+
+        Args:
+            ids (list): slots in `[B * beam]`
+            t (int): current step
+            scores (dict): name -> FloatTensor `[B * beam]`
+        Returns:
+            hyps (list): A list of dicts
+
+        """
+        if len(ids) == 0:
+            return []
+        keys = list(scores.keys())
+        vals = tensor2np(torch.stack([scores[k] for k in keys], dim=0))
+        hyps = []
+        for i in ids:
+            hyp = {'end': (t, i)}
+            for j, k in enumerate(keys):
+                hyp[k] = float(vals[j, i])
+            hyps.append(hyp)
+        return hyps
+
+    def update(self, t, tokens, hyp_scores, scores):
+        """Register hypotheses ended at the current step and remove them from the beam.
+
+        Args:
+            t (int): current step
+            tokens (LongTensor): `[B * beam]`
+            hyp_scores (FloatTensor): `[B * beam]`
+            scores (dict): name -> FloatTensor `[B * beam]`, including 'score' (= hyp_scores)
+        Returns:
+            hyp_scores (FloatTensor): `[B * beam]`, where removed hypotheses are NEG_INF
+
+        """
+        tokens_np = tensor2np(tokens)
+        scores_np = tensor2np(hyp_scores)
+        ended_ids, removed_ids = [], []
+        for b in range(self.bs):
+            if self.is_finished[b]:
+                continue
+            ended_ids_b = [i for i in range(b * self.beam_width, (b + 1) * self.beam_width)
+                           if scores_np[i] > NEG_INF and tokens_np[i] == self.eos]
+            self.end_hyps[b] += self.make_hyps(ended_ids_b, t, scores)
+            ended_ids += ended_ids_b
+            alive_ids_b = [i for i in range(b * self.beam_width, (b + 1) * self.beam_width)
+                           if scores_np[i] > NEG_INF and tokens_np[i] != self.eos]
+            if len(self.end_hyps[b]) >= self.beam_width:
+                self.end_hyps[b] = self.end_hyps[b][:self.beam_width]
+                self.is_finished[b] = True
+            elif t == self.ymax[b] - 1 or len(alive_ids_b) == 0:
+                self.hyps[b] = self.make_hyps(alive_ids_b, t, scores)
+                self.is_finished[b] = True
+            if self.is_finished[b]:
+                removed_ids += alive_ids_b
+        if len(ended_ids + removed_ids) > 0:
+            ids_t = hyp_scores.new_tensor(ended_ids + removed_ids, dtype=torch.int64)
+            hyp_scores = hyp_scores.index_fill(0, ids_t, NEG_INF)
+        return hyp_scores
+
+    def nbest(self, history, nbest, elens, bwd=False, exclude_eos=False, trim_aws=None):
+        """Backtrack all hypotheses at once and make N-best lists.
+
+        Args:
+            history (BeamHistory):
+            nbest (int):
+            elens (list): A list of length `[B]`
+            bwd (bool): hypotheses are in the reverse order
+            exclude_eos (bool): exclude <eos> (<sos> in case of the backward decoder)
+            trim_aws (): function to trim attention weights `[L, ...]` to the length of the utterance
+        Returns:
+            nbest_hyps_idx (list): A list of length `[B]`, which contains list of N hypotheses
+            aws (list): A list of length `[B]`, which contains list of N attention weights
+                or None if attention weights are not kept
+            scores (list): A list of length `[B]`, which contains list of N histories of scores
+            sorted_hyps (list): A list of length `[B]`, which contains hypotheses sorted by scores
+
+        """
+        if trim_aws is None:
+            trim_aws = (lambda aw, xlen: aw[..., :xlen])
+        keep_aws = history.keep_aws
+
+        # Backtrack token sequences of all hypotheses at once
+        all_hyps = [hyp for b in range(self.bs) for hyp in self.end_hyps[b] + self.hyps[b]]
+        ys, hist_scores, aws_all = history.backtrack([hyp['end'] for hyp in all_hyps])
+        for n, hyp in enumerate(all_hyps):
+            hyp['hyp'] = [self.eos] + ys[n]
+            hyp['hist_score'] = [0.0] + hist_scores[n]
+            hyp['aws'] = None
+            if keep_aws:
+                xlen = elens[hyp['end'][1] // self.beam_width]
+                hyp['aws'] = trim_aws(np.stack(aws_all[n], axis=0), xlen)
+
+        nbest_hyps_idx, aws, scores, sorted_hyps = [], [], [], []
+        for b in range(self.bs):
+            # Global pruning
+            end_hyps_b = self.end_hyps[b]
+            if len(end_hyps_b) == 0:
+                end_hyps_b = self.hyps[b][:]
+            elif len(end_hyps_b) < nbest and nbest > 1:
+                end_hyps_b.extend(self.hyps[b][:nbest - len(end_hyps_b)])
+
+            # Sort by score
+            end_hyps_b = sorted(end_hyps_b, key=lambda x: x['score'], reverse=True)
+            sorted_hyps.append(end_hyps_b)
+
+            # N-best list
+            if bwd:
+                # Reverse the order
+                nbest_hyps_idx += [[np.array(end_hyps_b[n]['hyp'][1:][::-1]) for n in range(nbest)]]
+                aws += [[end_hyps_b[n]['aws'][::-1] if keep_aws else None for n in range(nbest)]]
+                scores += [[end_hyps_b[n]['hist_score'][1:][::-1] for n in range(nbest)]]
+            else:
+                nbest_hyps_idx += [[np.array(end_hyps_b[n]['hyp'][1:]) for n in range(nbest)]]
+                aws += [[end_hyps_b[n]['aws'] for n in range(nbest)]]
+                scores += [[end_hyps_b[n]['hist_score'][1:] for n in range(nbest)]]
+
+            # Exclude <eos> (<sos> in case of the backward decoder)
+            if exclude_eos:
+                for n in range(nbest):
+                    if end_hyps_b[n]['hyp'][-1] == self.eos:
+                        nbest_hyps_idx[b][n] = nbest_hyps_idx[b][n][1:] if bwd else nbest_hyps_idx[b][n][:-1]
+
+        if not keep_aws:
+            aws = None
+        return nbest_hyps_idx, aws, scores, sorted_hyps
+
+
+def log_hyps(hyps, idx2token, weights, bwd=False, utt_id=None, ref=None):
+    """Log hypotheses of an utterance and their scores.
+
+    Args:
+        hyps (list): hypotheses sorted by scores (see EndedHypotheses)
+        idx2token (): converter from index to token
+        weights (list): A list of tuples (name, key in hypotheses, weight) of scores to log
+        bwd (bool): hypotheses are in the reverse order
+        utt_id (str):
+        ref (list): reference token ids
+
+    """
+    logger = logging.getLogger("decoding")
+    if utt_id is not None:
+        logger.info('Utt-id: %s' % utt_id)
+    if ref is not None:
+        logger.info('Ref: %s' % idx2token(ref))
+    for hyp in hyps:
+        if bwd:
+            logger.info('Hyp: %s' % idx2token(hyp['hyp'][1:][::-1]))
+        else:
+            logger.info('Hyp: %s' % idx2token(hyp['hyp'][1:]))
+        logger.info('log prob (hyp): %.7f' % hyp['score'])
+        for name, key, weight in weights:
+            logger.info('log prob (hyp, %s): %.7f' % (name, hyp[key] * weight))
+
+
+def add_length_penalty(total_scores, t, lp_weight, gnmt_decoding):
+    """Add length penalty to scores of candidates at the t-th step.
+
+    Args:
+        total_scores (FloatTensor): `[B * beam, beam]`
+        t (int): current step
+        lp_weight (float): weight of length penalty
+        gnmt_decoding (bool): normalize scores as in GNMT
+    Returns:
+        total_scores (FloatTensor): `[B * beam, beam]`
+
+    """
+    if lp_weight > 0:
+        if gnmt_decoding:
+            total_scores /= math.pow(5 + (t + 1), lp_weight) / math.pow(6, lp_weight)
+        else:
+            total_scores += (t + 1) * lp_weight
+            # NOTE: all alive hypotheses have the same length
+    return total_scores
+
+
+def add_coverage_penalty(total_scores, aw, aw_sum, xmask, cp_weight, cp_threshold,
+                         gnmt_decoding, n_heads=1):
+    """Add coverage penalty to scores of candidates.
+
+    Args:
+        total_scores (FloatTensor): `[B * beam, beam]`
+        aw (FloatTensor): `[B * beam, T]`, attention weights at the current step
+        aw_sum (FloatTensor): `[B * beam, T]`, accumulated attention weights
+        xmask (ByteTensor): `[B * beam, T]`, 1 for valid frames
+        cp_weight (float): weight of coverage penalty
+        cp_threshold (float): threshold for coverage penalty
+        gnmt_decoding (bool): coverage penalty as in GNMT
+        n_heads (int): normalizer of the accumulated weights
+    Returns:
+        total_scores (FloatTensor): `[B * beam, beam]`
+        cp (FloatTensor): `[B * beam]`
+        aw_sum (FloatTensor): `[B * beam, T]`
+
+    """
+    cp = total_scores.new_zeros(total_scores.size(0))
+    if cp_weight > 0:
+        if not gnmt_decoding and cp_threshold > 0:
+            aw = torch.where(aw > cp_threshold, aw, aw.new_zeros(aw.size()))
+        aw_sum = aw_sum + aw
+        if gnmt_decoding:
+            cp = torch.log(aw_sum.masked_fill(xmask == 0, 1.0))
+            cp = torch.where(cp < 0, cp, cp.new_zeros(cp.size())).sum(-1)
+        else:
+            cp = aw_sum.sum(-1) / n_heads
+        total_scores += cp.unsqueeze(1) * cp_weight
+    return total_scores, cp, aw_sum
+
+
+def add_ctc_scores(ctc_prefix_score, total_scores, topk_ids, total_scores_lm,
+                   t, y, ctc_state, hyp_scores, ctc_weight, beam_width, peaks=None):
+    """Add CTC prefix scores to scores of candidates and sort them again.
+
+    Args:
+        ctc_prefix_score (CTCPrefixScoreTH): None if CTC scores are not used
+        total_scores (FloatTensor): `[B * beam, beam]`
+        topk_ids (LongTensor): `[B * beam, beam]`, token ids of candidates
+        total_scores_lm (FloatTensor): `[B * beam, beam]`
+        t (int): current step
+        y (LongTensor): `[B * beam]`, the last tokens of hypotheses
+        ctc_state (FloatTensor): `[T, 2, B * beam]`
+        hyp_scores (FloatTensor): `[B * beam]`, NEG_INF for dead hypotheses
+        ctc_weight (float): weight of CTC score
+        beam_width (int):
+        peaks (LongTensor): `[B * beam]`, centers of the CTC window
+    Returns:
+        total_scores (FloatTensor): `[B * beam, beam]`
+        topk_ids (LongTensor): `[B * beam, beam]`
+        total_scores_lm (FloatTensor): `[B * beam, beam]`
+        total_scores_ctc (FloatTensor): `[B * beam, beam]`
+        ctc_states_all (FloatTensor): `[T, 2, B * beam, beam]`
+        joint_ids_topk (LongTensor): `[B * beam, beam]`, indices of candidates before sorting
+
+    """
+    if ctc_prefix_score is None:
+        return total_scores, topk_ids, total_scores_lm, total_scores.new_zeros(total_scores.size()), None, None
+
+    # NOTE: all hypotheses have the same length (t) except for <sos>
+    total_scores_ctc, ctc_states_all = ctc_prefix_score(t, y, topk_ids, ctc_state, peaks,
+                                                        alive=hyp_scores > NEG_INF)
+    total_scores += total_scores_ctc * ctc_weight
+    # Sort again
+    total_scores, joint_ids_topk = torch.topk(
+        total_scores, k=beam_width, dim=1, largest=True, sorted=True)
+    topk_ids = topk_ids.gather(1, joint_ids_topk)
+    total_scores_lm = total_scores_lm.gather(1, joint_ids_topk)
+    total_scores_ctc = total_scores_ctc.gather(1, joint_ids_topk)
+    return total_scores, topk_ids, total_scores_lm, total_scores_ctc, ctc_states_all, joint_ids_topk
+
+
+def mask_candidates(total_scores, topk_ids, local_scores, hyp_scores, eos, eos_threshold, min_lens, t):
+    """Exclude <eos> of short hypotheses, <eos> below the threshold and candidates of completed hypotheses.
+
+    Args:
+        total_scores (FloatTensor): `[B * beam, beam]`
+        topk_ids (LongTensor): `[B * beam, beam]`
+        local_scores (FloatTensor): `[B * beam, vocab]`, log probabilities at the current step
+        hyp_scores (FloatTensor): `[B * beam]`
+        eos (int): index of <eos>
+        eos_threshold (float): threshold for <eos> relative to the best non-<eos> token
+        min_lens (FloatTensor): `[B * beam]`, minimum lengths of hypotheses
+        t (int): current step
+    Returns:
+        total_scores (FloatTensor): `[B * beam, beam]`
+
+    """
+    local_scores_no_eos = local_scores.clone()
+    local_scores_no_eos[:, eos] = NEG_INF
+    eos_ng = (local_scores[:, eos] <= eos_threshold * local_scores_no_eos.max(1)[0]) | (min_lens > t)
+    total_scores = total_scores.masked_fill((topk_ids == eos) & eos_ng.unsqueeze(1), NEG_INF)
+    return total_scores.masked_fill((hyp_scores == NEG_INF).unsqueeze(1), NEG_INF)
+
+
+def select_topk(total_scores, topk_ids, beam_width, offset):
+    """Pick up the top-K hypotheses among beam * beam candidates per utterance.
+
+    Args:
+        total_scores (FloatTensor): `[B * beam, beam]`
+        topk_ids (LongTensor): `[B * beam, beam]`
+        beam_width (int):
+        offset (LongTensor): `[B, 1]`, index of the first hypothesis of each utterance
+    Returns:
+        hyp_scores (FloatTensor): `[B * beam]`
+        best_ids (LongTensor): `[B, beam]`, indices of candidates in each utterance
+        parent_ids (LongTensor): `[B * beam]`
+        tokens (LongTensor): `[B * beam]`
+
+    """
+    bs = offset.size(0)
+    best_scores, best_ids = torch.topk(
+        total_scores.view(bs, -1), k=beam_width, dim=1, largest=True, sorted=True)
+    parent_ids = (best_ids // beam_width + offset).view(-1)
+    tokens = topk_ids.view(bs, -1).gather(1, best_ids).view(-1)
+    return best_scores.view(-1), best_ids, parent_ids, tokens
+
+
+def select_lmstate(lmstate, ids):
+    """Select LM states of the given hypotheses.
+
+    Args:
+        lmstate:
+            - RNNLM: dict
+                hxs (FloatTensor): `[n_layers, B, n_units]`
+                cxs (FloatTensor): `[n_layers, B, n_units]`
+            - TransformerLM: dict
+                key (FloatTensor): `[n_layers, B, n_heads, L, d_k]`
+                value (FloatTensor): `[n_layers, B, n_heads, L, d_k]`
+            - GatedConvLM: list of FloatTensor `[B, in_ch, kernel_size - 1, 1]`
+        ids (LongTensor): `[B']`
+    Returns:
+        lmstate: same type as the input
+
+    """
+    if lmstate is None:
+        return None
+    if isinstance(lmstate, dict):
+        return {k: v.index_select(1, ids) if v is not None else None for k, v in lmstate.items()}
+    if isinstance(lmstate, list):
+        return [select_lmstate(s, ids) for s in lmstate]
+    return lmstate.index_select(0, ids)
+
+
+def concat_lmstates(lmstates):
+    """Concatenate LM states of several hypotheses in the batch dimension.
+
+    Args:
+        lmstates (list): A list of LM states (see select_lmstate)
+    Returns:
+        lmstate: same type as the elements
+
+    """
+    if lmstates[0] is None:
+        return None
+    if isinstance(lmstates[0], dict):
+        return {k: torch.cat([s[k] for s in lmstates], dim=1) if lmstates[0][k] is not None else None
+                for k in lmstates[0].keys()}
+    if isinstance(lmstates[0], list):
+        return [concat_lmstates([s[i] for s in lmstates]) for i in range(len(lmstates[0]))]
+    return torch.cat(lmstates, dim=0)
+
+
+def _lmstate_bytes(lmstate):
+    if lmstate is None:
+        return 0
+    if isinstance(lmstate, dict):
+        return sum([_lmstate_bytes(v) for v in lmstate.values()])
+    if isinstance(lmstate, list):
+        return sum([_lmstate_bytes(v) for v in lmstate])
+    return lmstate.numel() * lmstate.element_size()
+
+
+class _TrieNode(object):
+    __slots__ = ['token', 'parent', 'children', 'lmstate', 'log_probs', 'n_bytes']
+
+    def __init__(self, token, parent):
+        self.token = token
+        self.parent = parent
+        self.children = {}
+        self.lmstate = None
+        self.log_probs = None
+        self.n_bytes = 0
+
+
+class LMScoreCache(object):
+    """Cache of LM output distributions and states keyed by token prefixes.
+
+    Entries are stored in a prefix trie, and the least recently used entries
+    are evicted when the total size of the cached tensors exceeds the limit.
+    The cache can be shared across hypotheses, decoding passes and utterances
+    because LM scores depend only on the prefix.
+
+    Args:
+        lm (RNNLM or GatedConvLM or TransformerLM):
+        max_mb (float): maximum size of cached tensors in megabytes (None means no limit)
+
+    """
+
+    def __init__(self, lm, max_mb):
+        self.lm = lm
+        self.max_bytes = int(max_mb * 1024 * 1024) if max_mb is not None else None
+        self.reset()
+
+    def reset(self):
+        self.root = _TrieNode(None, None)
+        self.lru = OrderedDict()  # nodes with cached entries in the LRU order
+        self.n_bytes = 0
+        self.n_queries = 0
+        self.n_hits = 0
+
+    def __len__(self):
+        return len(self.lru)
+
+    @property
+    def hit_rate(self):
+        return self.n_hits / self.n_queries if self.n_queries > 0 else 0.
+
+    def stats(self):
+        """Return a summary of the cache for logging."""
+        return 'LM cache: hit rate %.3f (%d/%d), %d entries, %.1f MB' % (
+            self.hit_rate, self.n_hits, self.n_queries, len(self), self.n_bytes / 1024 / 1024)
+
+    def _find(self, prefix):
+        node = self.root
+        for token in prefix:
+            node = node.children.get(token)
+            if node is None:
+                return None
+        return node
+
+    def _insert(self, prefix):
+        node = self.root
+        for token in prefix:
+            if token not in node.children:
+                node.children[token] = _TrieNode(token, node)
+            node = node.children[token]
+        return node
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self.n_bytes > self.max_bytes and len(self.lru) > 0:
+            node, _ = self.lru.popitem(last=False)
+            self.n_bytes -= node.n_bytes
+            node.lmstate = None
+            node.log_probs = None
+            node.n_bytes = 0
+            # Remove empty branches
+            while node.parent is not None and len(node.children) == 0 and node.log_probs is None:
+                del node.parent.children[node.token]
+                node = node.parent
+
+    def predict(self, prefixes):
+        """Compute LM log probabilities of the next token following each prefix.
+
+        Prefixes not in the cache are computed by a batched call of `lm.predict`
+        from the cached states of their parents, or from scratch if the parents
+        have been evicted.
+
+        Args:
+            prefixes (list): A list of length `[B]`, which contains tuples of token ids
+                including <sos>
+        Returns:
+            log_probs (FloatTensor): `[B, vocab]`
+
+        """
+        log_probs = [None] * len(prefixes)
+        misses = OrderedDict()  # prefix -> indices
+        for i, prefix in enumerate(prefixes):
+            self.n_queries += 1
+            node = self._find(prefix)
+            if node is not None and node.log_probs is not None:
+                self.n_hits += 1
+                self.lru.move_to_end(node)
+                log_probs[i] = node.log_probs
+            else:
+                misses.setdefault(prefix, []).append(i)
+
+        # Group prefixes so that each group is computed by a single call
+        groups = OrderedDict()
+        for prefix in misses.keys():
+            parent = self._find(prefix[:-1]) if len(prefix) > 1 else None
+            if parent is not None and parent.log_probs is not None:
+                groups.setdefault(('step', len(prefix)), []).append((prefix, parent))
+            else:
+                groups.setdefault(('full', len(prefix)), []).append((prefix, None))
+
+        device_id = self.lm.device_id
+        for (mode, _), group in groups.items():
+            if mode == 'step':
+                ys = torch.LongTensor([[prefix[-1]] for prefix, _ in group])
+                lmstate = concat_lmstates([parent.lmstate for _, parent in group])
+            else:
+                ys = torch.LongTensor([list(prefix) for prefix, _ in group])
+                lmstate = None
+            if device_id >= 0:
+                ys = ys.cuda(device_id)
+            _, lmstate, lm_log_probs = self.lm.predict(ys, lmstate)
+            lm_log_probs = lm_log_probs[:, -1]
+
+            for j, (prefix, _) in enumerate(group):
+                ids = ys.new_tensor([j])
+                node = self._insert(prefix)
+                node.lmstate = select_lmstate(lmstate, ids)
+                node.log_probs = lm_log_probs[j].clone()
+                node.n_bytes = _lmstate_bytes(node.lmstate) + _lmstate_bytes(node.log_probs)
+                self.n_bytes += node.n_bytes
+                self.lru[node] = True
+                for i in misses[prefix]:
+                    log_probs[i] = node.log_probs
+        self._evict()
+
+        return torch.stack(log_probs, dim=0)
+
+
+def get_lm_score_cache(lm, params):
+    """Return the LM score cache attached to the LM, creating it if necessary.
+
+    Args:
+        lm (RNNLM or GatedConvLM or TransformerLM):
+        params (dict):
+            recog_lm_cache_size (float): maximum size of the cache in megabytes (0 disables the cache)
+            recog_lm_state_carry_over (bool): LM states depend on the previous utterance
+    Returns:
+        cache (LMScoreCache): None if disabled
+
+    """
+    if lm is None or params['recog_lm_cache_size'] <= 0 or params['recog_lm_state_carry_over']:
+        return None
+    cache = getattr(lm, 'score_cache', None)
+    if cache is None or cache.max_bytes != int(params['recog_lm_cache_size'] * 1024 * 1024):
+        cache = LMScoreCache(lm, params['recog_lm_cache_size'])
+        lm.score_cache = cache
+    return cache
+
+
+def predict_lm_cache(lm_cache, prefixes, hyp_scores):
+    """Look up LM scores of alive hypotheses in the LM score cache.
+
+    Args:
+        lm_cache (LMScoreCache):
+        prefixes (list): A list of length `[B * beam]`, which contains tuples of token ids
+        hyp_scores (FloatTensor): `[B * beam]`, NEG_INF for dead hypotheses
+    Returns:
+        lm_log_probs (FloatTensor): `[B * beam, 1, vocab]` (zeros for dead hypotheses)
+
+    """
+    alive_ids = [i for i, alive in enumerate(tensor2np(hyp_scores > NEG_INF)) if alive]
+    lm_log_probs = hyp_scores.new_zeros(len(prefixes), 1, lm_cache.lm.vocab)
+    if len(alive_ids) > 0:
+        lm_log_probs[alive_ids, 0] = lm_cache.predict([prefixes[i] for i in alive_ids])
+    return lm_log_probs
+
+
+def extend_prefixes(prefixes, parent_ids, tokens):
+    """Extend token prefixes of the parent hypotheses with the selected tokens.
+
+    Args:
+        prefixes (list): A list of length `[B * beam]`, which contains tuples of token ids
+        parent_ids (LongTensor): `[B * beam]`
+        tokens (LongTensor): `[B * beam]`
+    Returns:
+        prefixes (list): A list of length `[B * beam]`
+
+    """
+    tokens_np = tensor2np(tokens)
+    return [prefixes[p] + (int(tokens_np[i]),) for i, p in enumerate(tensor2np(parent_ids))]
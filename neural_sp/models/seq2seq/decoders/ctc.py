@@ -20,6 +20,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.criterion import kldiv_lsm_ctc
+from neural_sp.models.seq2seq.decoders.beam_search import get_lm_score_cache
 from neural_sp.models.modules.linear import LinearND
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.torch_utils import np2tensor
@@ -44,6 +45,7 @@ class CTC(DecoderBase):
         lsm_prob (float): label smoothing probability
         fc_list (list):
         param_init (float):
+        loss_impl (str): implementation of CTC loss (warpctc or pytorch)
 
     """
 
@@ -55,7 +57,8 @@ class CTC(DecoderBase):
                  dropout=0.0,
                  lsm_prob=0.0,
                  fc_list=[],
-                 param_init=0.1):
+                 param_init=0.1,
+                 loss_impl='warpctc'):
 
         super(CTC, self).__init__()
         logger = logging.getLogger('training')
@@ -64,6 +67,8 @@ class CTC(DecoderBase):
         self.blank = blank
         self.vocab = vocab
         self.lsm_prob = lsm_prob
+        self.loss_impl = loss_impl
+        assert loss_impl in ['warpctc', 'pytorch']
 
         self.space = -1
         # TODO(hirofumi): fix layer
@@ -79,8 +84,9 @@ class CTC(DecoderBase):
         else:
             self.output = LinearND(enc_n_units, vocab)
 
-        import warpctc_pytorch
-        self.warpctc_loss = warpctc_pytorch.CTCLoss(size_average=True)
+        if loss_impl == 'warpctc':
+            import warpctc_pytorch
+            self.warpctc_loss = warpctc_pytorch.CTCLoss(size_average=True)
 
     def reset_parameters(self, param_init):
         """Initialize parameters with uniform distribution."""
@@ -114,12 +120,15 @@ class CTC(DecoderBase):
 
         # Compute CTC loss
         logits = self.output(eouts)
-        loss = self.warpctc_loss(logits.transpose(1, 0).cpu(),  # time-major
-                                 ys_ctc, elens.cpu(), ylens)
-        # NOTE: ctc loss has already been normalized by bs
-        # NOTE: index 0 is reserved for blank in warpctc_pytorch
-        if self.device_id >= 0:
-            loss = loss.cuda(self.device_id)
+        if self.loss_impl == 'pytorch':
+            loss = self.forward_pytorch(logits, elens, ys_ctc, ylens)
+        else:
+            loss = self.warpctc_loss(logits.transpose(1, 0).cpu(),  # time-major
+                                     ys_ctc, elens.cpu(), ylens)
+            # NOTE: ctc loss has already been normalized by bs
+            # NOTE: index 0 is reserved for blank in warpctc_pytorch
+            if self.device_id >= 0:
+                loss = loss.cuda(self.device_id)
 
         # Label smoothing for CTC
         if self.lsm_prob > 0:
@@ -129,6 +138,26 @@ class CTC(DecoderBase):
 
         return loss
 
+    def forward_pytorch(self, logits, elens, ys_ctc, ylens):
+        """Compute CTC loss with the built-in implementation on the device of logits.
+
+        Args:
+            logits (FloatTensor): `[B, T, vocab]`
+            elens (IntTensor): `[B]`
+            ys_ctc (IntTensor): `[sum(ylens)]`
+            ylens (IntTensor): `[B]`
+        Returns:
+            loss (FloatTensor): `[1]`
+
+        """
+        bs = logits.size(0)
+        log_probs = F.log_softmax(logits.transpose(1, 0), dim=-1)  # time-major
+        # NOTE: only the concatenated labels are copied to the device
+        loss = F.ctc_loss(log_probs, ys_ctc.long().to(logits.device), elens.long(), ylens.long(),
+                          blank=self.blank, reduction='sum')
+        # NOTE: normalized by bs as in warpctc_pytorch
+        return loss.unsqueeze(0) / bs
+
     def greedy(self, eouts, elens):
         """Greedy decoding.
 
@@ -139,31 +168,33 @@ class CTC(DecoderBase):
             best_hyps (np.ndarray): Best path hypothesis. `[B, labels_max_seq_len]`
 
         """
-        bs = eouts.size(0)
-        best_hyps = []
+        bs, xmax = eouts.size()[:2]
 
-        log_probs = F.log_softmax(self.output(eouts), dim=-1)
+        # Pickup argmax class (log_softmax is not necessary)
+        best_paths = self.output(eouts).argmax(-1)  # `[B, T]`
 
-        # Pickup argmax class
-        for b in range(bs):
-            indices = []
-            time = elens[b]
-            for t in range(time):
-                argmax = log_probs[b, t].argmax(0).item()
-                indices.append(argmax)
+        # Step 1. Collapse repeated labels
+        not_repeated = torch.ones_like(best_paths)
+        not_repeated[:, 1:] = best_paths[:, 1:] != best_paths[:, :-1]
 
-            # Step 1. Collapse repeated labels
-            collapsed_indices = [x[0] for x in groupby(indices)]
+        # Step 2. Remove all blank labels and padded frames
+        frames = torch.arange(0, xmax, dtype=torch.int64).to(best_paths.device)
+        xlens = best_paths.new_tensor([int(elens[b]) for b in range(bs)])
+        keep = not_repeated & (best_paths != self.blank).long() & (frames.unsqueeze(0) < xlens.unsqueeze(1)).long()
 
-            # Step 2. Remove all blank labels
-            best_hyp = [x for x in filter(lambda x: x != self.blank, collapsed_indices)]
-            best_hyps.append(np.array(best_hyp))
+        # NOTE: copy to the host only once
+        best_paths, keep = tensor2np(torch.stack([best_paths, keep], dim=0))
+        best_hyps = [best_paths[b][keep[b] == 1] for b in range(bs)]
 
         return np.array(best_hyps)
 
     def beam_search(self, eouts, elens, params, idx2token, lm=None,
                     nbest=1, refs_id=None, utt_ids=None, speakers=None):
-        """Beam search decoding.
+        """Prefix beam search decoding.
+
+        Hypotheses reaching the same prefix through different CTC paths are
+        merged. Prefixes are kept in a trie, and blank and non-blank
+        probabilities of all live prefixes are updated at once per frame.
 
         Args:
             eouts (FloatTensor): `[B, T, enc_n_units]`
@@ -173,6 +204,8 @@ class CTC(DecoderBase):
                 recog_length_penalty (float): length penalty
                 recog_lm_weight (float): weight of LM score
                 recog_lm_usage (str): rescoring or shallow_fusion
+                recog_ctc_prune_mass (float): cumulative probability mass of
+                    labels considered for extension at each frame
             idx2token (): converter from index to token
             lm (RNNLM or GatedConvLM or TransformerLM):
             nbest (int):
@@ -191,94 +224,115 @@ class CTC(DecoderBase):
         lp_weight = params['recog_length_penalty']
         lm_weight = params['recog_lm_weight']
         lm_usage = params['recog_lm_usage']
+        prune_mass = params['recog_ctc_prune_mass']
+        shallow_fusion = lm_weight > 0 and lm is not None and lm_usage == 'shallow_fusion'
+        lm_cache = get_lm_score_cache(lm, params) if shallow_fusion else None
 
         best_hyps = []
-        log_probs = F.log_softmax(self.output(eouts), dim=-1)
+        n_topk = min(beam_width + 1, self.vocab)  # +1 for blank
+        # NOTE: copy posteriors to the host only once
+        log_probs = tensor2np(F.log_softmax(self.output(eouts), dim=-1))
 
         for b in range(bs):
-            # Elements in the beam are (prefix, (p_b, p_no_blank))
-            # Initialize the beam with the empty sequence, a probability of
-            # 1 for ending in blank and zero for ending in non-blank (in log space).
-            beam = [{'hyp_id': [self.eos],  # <eos> is used for LM
-                     'p_b': LOG_1,
-                     'p_nb': LOG_0,
-                     'score_lm': LOG_1,
-                     'lmstate': None,
-                     }]
+            # Prefix trie. The root is the empty sequence (<eos> is used for LM).
+            tokens, parents, lengths = [self.eos], [-1], [0]
+            children = {}  # (node, token) -> node
+            lmstates, lm_log_probs, scores_lm = [None], [None], [LOG_1]
+
+            def get_child(node, c):
+                key = (node, c)
+                if key not in children:
+                    children[key] = len(tokens)
+                    tokens.append(c)
+                    parents.append(node)
+                    lengths.append(lengths[node] + 1)
+                    lmstates.append(None)
+                    lm_log_probs.append(None)
+                    scores_lm.append(scores_lm[node] + lm_weight * lm_log_probs[node][c]
+                                     if shallow_fusion else LOG_1)
+                return children[key]
+
+            def get_prefix(node):
+                prefix = []
+                while node > 0:
+                    prefix.append(int(tokens[node]))
+                    node = parents[node]
+                return prefix[::-1]
+
+            # Live prefixes and their log probabilities ending in blank and non-blank
+            nodes = np.array([0], dtype=np.int64)
+            p_b = np.array([LOG_1], dtype=np.float32)
+            p_nb = np.array([LOG_0], dtype=np.float32)
 
             for t in range(elens[b]):
-                new_beam = []
-
-                # Pick up the top-k scores
-                log_probs_topk, topk_ids = torch.topk(
-                    log_probs[b:b + 1, t], k=min(beam_width, self.vocab), dim=-1, largest=True, sorted=True)
-
-                for i_beam in range(len(beam)):
-                    hyp_id = beam[i_beam]['hyp_id'][:]
-                    p_b = beam[i_beam]['p_b']
-                    p_nb = beam[i_beam]['p_nb']
-                    score_lm = beam[i_beam]['score_lm']
-
-                    # case 1. hyp is not extended
-                    new_p_b = np.logaddexp(p_b + log_probs[b, t, self.blank].item(),
-                                           p_nb + log_probs[b, t, self.blank].item())
-                    if len(hyp_id) > 1:
-                        new_p_nb = p_nb + log_probs[b, t, hyp_id[-1]].item()
-                    else:
-                        new_p_nb = LOG_0
-                    score_ctc = np.logaddexp(new_p_b, new_p_nb)
-                    score_lp = len(hyp_id[1:]) * lp_weight
-                    new_beam.append({'hyp_id': hyp_id,
-                                     'score': score_ctc + score_lm + score_lp,
-                                     'p_b': new_p_b,
-                                     'p_nb': new_p_nb,
-                                     'score_ctc': score_ctc,
-                                     'score_lm': score_lm,
-                                     'score_lp': score_lp,
-                                     'lmstate': beam[i_beam]['lmstate'],
-                                     })
-
-                    # Update LM states for shallow fusion
-                    if lm_weight > 0 and lm is not None and lm_usage == 'shallow_fusion':
-                        _, lmstate, lm_log_probs = lm.predict(
-                            eouts.new_zeros(1, 1).fill_(hyp_id[-1]), beam[i_beam]['lmstate'])
-
-                    # case 2. hyp is extended
-                    new_p_b = LOG_0
-                    for c in tensor2np(topk_ids)[0]:
-                        p_t = log_probs[b, t, c].item()
-
-                        if c == self.blank:
-                            continue
-
-                        c_prev = hyp_id[-1] if len(hyp_id) > 1 else None
-                        if c == c_prev:
-                            new_p_nb = p_b + p_t
-                            # TODO(hirofumi): apply character LM here
-                        else:
-                            new_p_nb = np.logaddexp(p_b + p_t, p_nb + p_t)
-                            # TODO(hirofumi): apply character LM here
-                            if c == self.space:
-                                pass
-                                # TODO(hirofumi): apply word LM here
-
-                        score_ctc = np.logaddexp(new_p_b, new_p_nb)
-                        score_lp = (len(hyp_id[1:]) + 1) * lp_weight
-                        if lm_weight > 0 and lm is not None and lm_usage == 'shallow_fusion':
-                            local_score_lm = lm_log_probs[0, 0, c].item() * lm_weight
-                            score_lm += local_score_lm
-                        new_beam.append({'hyp_id': hyp_id + [c],
-                                         'score': score_ctc + score_lm + score_lp,
-                                         'p_b': new_p_b,
-                                         'p_nb': new_p_nb,
-                                         'score_ctc': score_ctc,
-                                         'score_lm': score_lm,
-                                         'score_lp': score_lp,
-                                         'lmstate': lmstate,
-                                         })
+                lp_t = log_probs[b, t]
+
+                # Prune candidate labels by the cumulative probability mass
+                topk_ids = np.argpartition(-lp_t, n_topk - 1)[:n_topk]
+                topk_ids = topk_ids[np.argsort(-lp_t[topk_ids])]
+                n_cands = min(int(np.searchsorted(np.cumsum(np.exp(lp_t[topk_ids])), prune_mass)) + 1,
+                              len(topk_ids))
+                cands = np.array([c for c in topk_ids[:n_cands] if c != self.blank][:beam_width],
+                                 dtype=np.int64)
+
+                # case 1. prefixes are not extended
+                last = np.array([tokens[n] if n > 0 else self.blank for n in nodes], dtype=np.int64)
+                p_total = np.logaddexp(p_b, p_nb)
+                new_p_b = p_total + lp_t[self.blank]
+                new_p_nb = np.where(nodes > 0, p_nb + lp_t[last], LOG_0).astype(np.float32)
+
+                # case 2. prefixes are extended
+                if len(cands) > 0:
+                    if shallow_fusion and lm_cache is not None:
+                        # Look up LM scores of prefixes to be extended for the first time
+                        new_nodes = [n for n in nodes if lm_log_probs[n] is None]
+                        if len(new_nodes) > 0:
+                            lm_lp = tensor2np(lm_cache.predict([tuple([self.eos] + get_prefix(n))
+                                                                for n in new_nodes]))
+                            for j, n in enumerate(new_nodes):
+                                lm_log_probs[n] = lm_lp[j]
+                    elif shallow_fusion:
+                        # Update LM states of prefixes to be extended for the first time
+                        for n in nodes:
+                            if lm_log_probs[n] is None:
+                                y = eouts.new_zeros(1, 1, dtype=torch.int64).fill_(tokens[n])
+                                _, lmstates[n], lm_lp = lm.predict(y, lmstates[parents[n]] if n > 0 else None)
+                                lm_log_probs[n] = tensor2np(lm_lp[0, -1])
+                    # repeated labels must be separated by blank
+                    p_ext = np.where(cands[None, :] == last[:, None], p_b[:, None], p_total[:, None]) + \
+                        lp_t[cands][None, :]  # `[n_nodes, n_cands]`
+                    ext_nodes = np.array([get_child(n, c) for n in nodes for c in cands], dtype=np.int64)
+                    all_nodes = np.concatenate([nodes, ext_nodes])
+                    all_p_b = np.concatenate([new_p_b, np.full(len(ext_nodes), LOG_0, dtype=np.float32)])
+                    all_p_nb = np.concatenate([new_p_nb, p_ext.reshape(-1)])
+                else:
+                    all_nodes, all_p_b, all_p_nb = nodes, new_p_b, new_p_nb
+
+                # Merge hypotheses reaching the same prefix
+                nodes, inv = np.unique(all_nodes, return_inverse=True)
+                p_b = np.full(len(nodes), LOG_0, dtype=np.float32)
+                p_nb = np.full(len(nodes), LOG_0, dtype=np.float32)
+                np.logaddexp.at(p_b, inv, all_p_b)
+                np.logaddexp.at(p_nb, inv, all_p_nb)
 
                 # Pruning
-                beam = sorted(new_beam, key=lambda x: x['score'], reverse=True)[:beam_width]
+                scores = np.logaddexp(p_b, p_nb) + \
+                    np.array([scores_lm[n] + lengths[n] * lp_weight for n in nodes], dtype=np.float32)
+                if len(nodes) > beam_width:
+                    keep = np.argsort(-scores, kind='stable')[:beam_width]
+                    nodes, p_b, p_nb = nodes[keep], p_b[keep], p_nb[keep]
+
+            beam = []
+            for i in range(len(nodes)):
+                n = nodes[i]
+                score_ctc = float(np.logaddexp(p_b[i], p_nb[i]))
+                score_lp = lengths[n] * lp_weight
+                beam.append({'hyp_id': [self.eos] + get_prefix(n),
+                             'score': score_ctc + scores_lm[n] + score_lp,
+                             'score_ctc': score_ctc,
+                             'score_lm': scores_lm[n],
+                             'score_lp': score_lp})
+            beam = sorted(beam, key=lambda x: x['score'], reverse=True)
 
             # Rescoing lattice
             if lm_weight > 0 and lm is not None and lm_usage == 'rescoring':
@@ -287,7 +341,7 @@ class CTC(DecoderBase):
                     ys = [np2tensor(np.fromiter(beam[i_beam]['hyp_id'], dtype=np.int64), self.device_id)]
                     ys_pad = pad_list(ys, lm.pad)
                     _, _, lm_log_probs = lm.predict(ys_pad, None)
-                    score_ctc = np.logaddexp(beam[i_beam]['p_b'], beam[i_beam]['p_nb'])
+                    score_ctc = beam[i_beam]['score_ctc']
                     score_lm = lm_log_probs.sum() * lm_weight
                     score_lp = len(beam[i_beam]['hyp_id'][1:]) * lp_weight
                     new_beam.append({'hyp_id': beam[i_beam]['hyp_id'],
@@ -310,6 +364,9 @@ class CTC(DecoderBase):
             if lm_weight > 0 and lm is not None:
                 logger.info('log prob (hyp, lm): %.7f' % (beam[0]['score_lm']))
 
+        if lm_cache is not None:
+            logger.info(lm_cache.stats())
+
         return np.array(best_hyps)
 
 
@@ -405,3 +462,205 @@ class CTCPrefixScore(object):
         # return the log prefix probability and CTC states, where the label axis
         # of the CTC states is moved to the first axis to slice it easily
         return log_psi, np.rollaxis(r, 2)
+
+
+class CTCPrefixScoreTH(object):
+    """Compute CTC label sequence scores of all hypotheses in a batch at once.
+
+    This is a batched version of CTCPrefixScore in PyTorch. Prefix scores of
+    all hypotheses and candidate labels of all utterances are computed in a
+    single loop over frames on the same device as the CTC posteriors.
+    All hypotheses must have the same prefix length, which holds in
+    synchronous beam search.
+
+    When `window` is positive, forward probabilities of each hypothesis are
+    computed only inside the frames within `window` from its peak (e.g., the
+    attention peak) or its previous CTC frontier, which is the most likely frame
+    where the last label of the prefix is emitted, and before the end of its
+    utterance. States after the window are carried forward with <blank> only.
+    This is an approximation. The loop over frames runs over the union of the
+    windows of alive hypotheses.
+
+    Args:
+        log_probs (FloatTensor): `[B, T, vocab]`
+        xlens (list): A list of length `[B]`
+        blank (int): index of <blank>
+        eos (int): index of <eos>
+        beam_width (int): number of hypotheses per utterance
+        window (int): number of frames on each side of the peaks (0 means no restriction)
+
+    """
+
+    def __init__(self, log_probs, xlens, blank, eos, beam_width=1, window=0):
+        self.blank = blank
+        self.eos = eos
+        self.logzero = -10000000000.0
+        self.beam_width = beam_width
+        self.window = window
+
+        bs, xmax, vocab = log_probs.size()
+        self.xmax = xmax
+        self.vocab = vocab
+        self.n_hyps = bs * beam_width
+
+        # NOTE: no label is emitted after the end of each utterance, and <blank> is
+        # emitted with probability 1 there so that CTC states are carried over to the
+        # last frame without change
+        frames = torch.arange(0, xmax, dtype=torch.int64).to(log_probs.device)
+        pad = frames.unsqueeze(1) >= log_probs.new_tensor(xlens, dtype=torch.int64).unsqueeze(0)  # `[T, B]`
+        log_probs = log_probs.transpose(0, 1).masked_fill(pad.unsqueeze(2), self.logzero)  # `[T, B, vocab]`
+        self.log_probs = log_probs.contiguous().view(xmax, -1)  # `[T, B * vocab]`
+
+        # `[B * beam]`: index of the utterance which each hypothesis belongs to
+        self.utt_ids = log_probs.new_tensor([i // beam_width for i in range(self.n_hyps)],
+                                            dtype=torch.int64)
+        self.last_frames = log_probs.new_tensor([xlens[i // beam_width] - 1 for i in range(self.n_hyps)],
+                                                dtype=torch.int64)
+        x_blank = self.log_probs.index_select(1, self.utt_ids * vocab + blank)  # `[T, B * beam]`
+        self.x_blank = x_blank.masked_fill(pad.index_select(1, self.utt_ids), 0)
+        self.cum_blank = torch.cumsum(self.x_blank, dim=0)  # `[T, B * beam]`
+
+    def initial_state(self):
+        """Obtain initial CTC states.
+
+        Returns:
+            r (FloatTensor): `[T, 2, B * beam]`
+
+        """
+        # initial CTC state is made of a frame x 2 tensor that corresponds to
+        # r_t^n(<sos>) and r_t^b(<sos>), where 0 and 1 of axis=1 represent
+        # superscripts n and b (non-blank and blank), respectively.
+        r = self.x_blank.new_zeros(self.xmax, 2, self.n_hyps).fill_(self.logzero)
+        r[:, 1] = self.cum_blank
+        return r
+
+    def __call__(self, ylen, last, cs, r_prev, peaks=None, alive=None):
+        """Compute CTC prefix scores for next labels.
+
+        Args:
+            ylen (int): length of prefixes except for <sos>
+            last (LongTensor): `[B * beam]`, the last labels of prefixes
+            cs (LongTensor): `[B * beam, n_cands]`, next labels
+            r_prev (FloatTensor): `[T, 2, B * beam]`, previous CTC states
+            peaks (LongTensor): `[B * beam]`, centers of the window.
+                The previous CTC frontier is used if not given.
+            alive (ByteTensor): `[B * beam]`, hypotheses to be scored.
+                Windows of the others (e.g., pruned hypotheses and those of
+                finished utterances) are not computed, and their scores are invalid.
+        Returns:
+            log_psi (FloatTensor): `[B * beam, n_cands]`
+            r (FloatTensor): `[T, 2, B * beam, n_cands]`
+
+        """
+        n_hyps, n_cands = cs.size()
+        assert n_hyps == self.n_hyps
+
+        # new CTC states are prepared as a frame x (n or b) x hyps x n_labels tensor
+        # that corresponds to r_t^n(h) and r_t^b(h).
+        xs = self.log_probs.index_select(
+            1, (self.utt_ids.unsqueeze(1) * self.vocab + cs).view(-1)).view(self.xmax, n_hyps, n_cands)
+        r = xs.new_zeros(self.xmax, 2, n_hyps, n_cands).fill_(self.logzero)
+        if ylen == 0:
+            r[0, 0] = xs[0]
+
+        # prepare forward probabilities for the last label
+        r_sum = torch.logsumexp(r_prev, dim=1)  # `[T, B * beam]`, log(r_t^n(g) + r_t^b(g))
+        log_phi = r_sum.unsqueeze(2).repeat(1, 1, n_cands)
+        if ylen > 0:
+            same = (cs == last.unsqueeze(1)).unsqueeze(0).expand_as(log_phi)
+            log_phi = torch.where(same, r_prev[:, 1].unsqueeze(2).expand_as(log_phi), log_phi)
+
+        # compute forward probabilities log(r_t^n(h)), log(r_t^b(h))
+        start, end = max(ylen, 1), self.xmax
+        if self.window > 0 and start < end:
+            log_psi = self._forward_window(r, xs, log_phi, start, r_prev, peaks, alive)
+        else:
+            x_blank = self.x_blank.unsqueeze(2).expand(self.xmax, n_hyps, n_cands)
+            for t in range(start, end):
+                # non-blank
+                r[t, 0] = torch.logsumexp(torch.stack([r[t - 1, 0], log_phi[t - 1]], dim=0), dim=0) + xs[t]
+                # blank
+                r[t, 1] = torch.logsumexp(r[t - 1], dim=0) + x_blank[t]
+
+            # compute log prefix probabilites log(psi) over all frames at once
+            if start < end:
+                log_psi = torch.logsumexp(torch.cat([r[start - 1, 0].unsqueeze(0),
+                                                     log_phi[start - 1:-1] + xs[start:]], dim=0), dim=0)
+            else:
+                log_psi = r[min(start, self.xmax) - 1, 0]
+
+        # get P(...eos|X) that ends with the prefix itself
+        r_sum_last = r_sum.gather(0, self.last_frames.unsqueeze(0)).squeeze(0)  # `[B * beam]`
+        log_psi = torch.where(cs == self.eos, r_sum_last.unsqueeze(1).expand_as(log_psi), log_psi)
+
+        return log_psi, r
+
+    def _forward_window(self, r, xs, log_phi, start, r_prev, peaks, alive):
+        """Compute forward probabilities inside the window of each hypothesis.
+
+        Args:
+            r (FloatTensor): `[T, 2, B * beam, n_cands]`, filled in place
+            xs (FloatTensor): `[T, B * beam, n_cands]`
+            log_phi (FloatTensor): `[T, B * beam, n_cands]`
+            start (int): the first frame where the next labels can be emitted
+            r_prev (FloatTensor): `[T, 2, B * beam]`
+            peaks (LongTensor): `[B * beam]`
+            alive (ByteTensor): `[B * beam]`
+        Returns:
+            log_psi (FloatTensor): `[B * beam, n_cands]`
+
+        """
+        n_hyps, n_cands = xs.size()[1:]
+        if peaks is None:
+            peaks = r_prev[:, 0].max(0)[1]
+        # `[B * beam]`: window of each hypothesis [starts, ends), which ends at the last frame of the utterance
+        starts = torch.min((peaks - self.window).clamp(min=start), self.last_frames.clamp(min=start))
+        ends = torch.max(torch.min(peaks + self.window + 1, self.last_frames + 1), starts + 1)
+
+        # loop over frames in the union of windows of alive hypotheses
+        if alive is not None and int(alive.sum()) > 0:
+            t_begin = int(starts.masked_select(alive).min())
+            t_end = int(ends.masked_select(alive).max())
+        elif alive is not None:
+            t_begin, t_end = start, start + 1
+        else:
+            t_begin, t_end = int(starts.min()), int(ends.max())
+        starts = starts.view(1, n_hyps, 1)
+        ends = ends.view(1, n_hyps, 1)
+        frames = torch.arange(t_begin, t_end, dtype=torch.int64).to(xs.device).view(-1, 1, 1)
+        is_inside = (frames >= starts) & (frames < ends)  # `[T', B * beam, 1]`
+        is_started = frames >= starts
+        logzero = xs.new_zeros(n_hyps, n_cands).fill_(self.logzero)
+        x_blank = self.x_blank.unsqueeze(2).expand(self.xmax, n_hyps, n_cands)
+        for i, t in enumerate(range(t_begin, t_end)):
+            # non-blank (only inside the window)
+            r_t = torch.logsumexp(torch.stack([r[t - 1, 0], log_phi[t - 1]], dim=0), dim=0) + xs[t]
+            r[t, 0] = torch.where(is_inside[i].expand_as(r_t), r_t, logzero)
+            # blank (carried forward after the window)
+            r_t = torch.logsumexp(r[t - 1], dim=0) + x_blank[t]
+            r[t, 1] = torch.where(is_started[i].expand_as(r_t), r_t, logzero)
+
+        # carry forward states after the union of windows with <blank>
+        if t_end < self.xmax:
+            r[t_end:, 1] = torch.logsumexp(r[t_end - 1], dim=0).unsqueeze(0) + \
+                (self.cum_blank[t_end:] - self.cum_blank[t_end - 1]).unsqueeze(2)
+
+        # compute log prefix probabilites log(psi) over frames in each window at once
+        r_init = r[:, 0].gather(0, (starts - 1).expand(1, n_hyps, n_cands))  # `[1, B * beam, n_cands]`
+        log_psi_t = log_phi[t_begin - 1:t_end - 1] + xs[t_begin:t_end]
+        log_psi_t = torch.where(is_inside.expand_as(log_psi_t), log_psi_t, logzero.unsqueeze(0).expand_as(log_psi_t))
+        return torch.logsumexp(torch.cat([r_init, log_psi_t], dim=0), dim=0)
+
+    def select_state(self, r, parent_ids, cand_ids):
+        """Select CTC states of the chosen candidates.
+
+        Args:
+            r (FloatTensor): `[T, 2, B * beam, n_cands]`
+            parent_ids (LongTensor): `[B * beam]`
+            cand_ids (LongTensor): `[B * beam]`
+        Returns:
+            r (FloatTensor): `[T, 2, B * beam]`
+
+        """
+        n_cands = r.size(3)
+        return r.view(self.xmax, 2, -1).index_select(2, parent_ids * n_cands + cand_ids)
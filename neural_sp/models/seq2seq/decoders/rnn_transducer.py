@@ -17,15 +17,20 @@ import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from neural_sp.models.criterion import kldiv_lsm_ctc
+from neural_sp.models.criterion import transducer_loss
 from neural_sp.models.modules.embedding import Embedding
 from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.seq2seq.decoders.beam_search import get_lm_score_cache
+from neural_sp.models.seq2seq.decoders.beam_search import LMScoreCache
 from neural_sp.models.seq2seq.decoders.ctc import CTC
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.torch_utils import compute_accuracy
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
+from neural_sp.models.torch_utils import tensor2np
 
 random.seed(1)
 
@@ -57,6 +62,7 @@ class RNNTransducer(DecoderBase):
         ctc_weight (float):
         ctc_lsm_prob (float): label smoothing probability for CTC
         ctc_fc_list (list):
+        ctc_loss_impl (str): implementation of CTC loss (warpctc or pytorch)
         lm_init (RNNLM):
         lmobj_weight (float):
         share_lm_softmax (bool):
@@ -65,6 +71,9 @@ class RNNTransducer(DecoderBase):
         param_init (float):
         start_pointing (bool):
         end_pointing (bool):
+        loss_impl (str): implementation of Transducer loss (warprnnt or pytorch)
+        loss_chunk_size (int): number of frames per chunk of the joint network
+            for the pytorch implementation (0 means all frames)
 
     """
 
@@ -89,6 +98,7 @@ class RNNTransducer(DecoderBase):
                  ctc_weight=0.0,
                  ctc_lsm_prob=0.0,
                  ctc_fc_list=[],
+                 ctc_loss_impl='warpctc',
                  lm_init=None,
                  lmobj_weight=0.0,
                  share_lm_softmax=False,
@@ -96,7 +106,9 @@ class RNNTransducer(DecoderBase):
                  mtl_per_batch=False,
                  param_init=0.1,
                  start_pointing=False,
-                 end_pointing=True):
+                 end_pointing=True,
+                 loss_impl='warprnnt',
+                 loss_chunk_size=16):
 
         super(RNNTransducer, self).__init__()
         logger = logging.getLogger('training')
@@ -119,6 +131,9 @@ class RNNTransducer(DecoderBase):
         self.share_lm_softmax = share_lm_softmax
         self.global_weight = global_weight
         self.mtl_per_batch = mtl_per_batch
+        self.loss_impl = loss_impl
+        assert loss_impl in ['warprnnt', 'pytorch']
+        self.loss_chunk_size = loss_chunk_size
 
         # VAD
         self.start_pointing = start_pointing
@@ -137,11 +152,13 @@ class RNNTransducer(DecoderBase):
                            dropout=dropout,
                            lsm_prob=ctc_lsm_prob,
                            fc_list=ctc_fc_list,
+                           loss_impl=ctc_loss_impl,
                            param_init=param_init)
 
         if ctc_weight < global_weight:
-            import warprnnt_pytorch
-            self.warprnnt_loss = warprnnt_pytorch.RNNTLoss()
+            if loss_impl == 'warprnnt':
+                import warprnnt_pytorch
+                self.warprnnt_loss = warprnnt_pytorch.RNNTLoss()
 
             # for MTL with LM objective
             if lmobj_weight > 0:
@@ -340,6 +357,9 @@ class RNNTransducer(DecoderBase):
         # Update prediction network
         dout, _ = self.recurrency(self.embed(ys_in_pad), None)
 
+        if self.loss_impl == 'pytorch':
+            return self.forward_rnnt_chunked(eouts, elens, dout, ys_out_pad.long(), ylens)
+
         # Compute output distribution
         logits = self.joint(eouts, dout)
 
@@ -365,6 +385,60 @@ class RNNTransducer(DecoderBase):
 
         return loss
 
+    def forward_rnnt_chunked(self, eouts, elens, dout, ys_out_pad, ylens):
+        """Compute Transducer loss without extensions or the full output distribution.
+
+        The joint network is evaluated in chunks of frames, and only log probabilities
+        of blank and the reference labels are kept. Each chunk is recomputed in the
+        backward pass by checkpointing, so memory usage does not depend on the
+        number of frames in the mini-batch.
+
+        Args:
+            eouts (FloatTensor): `[B, T, dec_n_units]`
+            elens (IntTensor): `[B]`
+            dout (FloatTensor): `[B, L + 1, dec_n_units]`
+            ys_out_pad (LongTensor): `[B, L]`
+            ylens (IntTensor): `[B]`
+        Returns:
+            loss (FloatTensor): `[1]`
+
+        """
+        xmax = eouts.size(1)
+        chunk_size = self.loss_chunk_size if self.loss_chunk_size > 0 else xmax
+        log_probs_blank, log_probs_label = [], []
+        for t in range(0, xmax, chunk_size):
+            if torch.is_grad_enabled():
+                lp_blank, lp_label = checkpoint(self._joint_ref_log_probs,
+                                                eouts[:, t:t + chunk_size], dout, ys_out_pad)
+            else:
+                lp_blank, lp_label = self._joint_ref_log_probs(eouts[:, t:t + chunk_size], dout, ys_out_pad)
+            log_probs_blank.append(lp_blank)
+            log_probs_label.append(lp_label)
+        log_probs_blank = torch.cat(log_probs_blank, dim=1)
+        log_probs_label = torch.cat(log_probs_label, dim=1)
+
+        # NOTE: normalized by bs as in warprnnt_pytorch
+        return transducer_loss(log_probs_blank, log_probs_label, elens, ylens, size_average=True)
+
+    def _joint_ref_log_probs(self, eouts, dout, ys):
+        """Compute log probabilities of blank and the reference labels.
+
+        Args:
+            eouts (FloatTensor): `[B, T, dec_n_units]`
+            dout (FloatTensor): `[B, L + 1, dec_n_units]`
+            ys (LongTensor): `[B, L]`
+        Returns:
+            log_probs_blank (FloatTensor): `[B, T, L + 1]`
+            log_probs_label (FloatTensor): `[B, T, L]`
+
+        """
+        bs, xmax = eouts.size()[:2]
+        log_probs = F.log_softmax(self.joint(eouts, dout), dim=-1)
+        log_probs_blank = log_probs[:, :, :, self.blank]
+        ys = ys.unsqueeze(1).unsqueeze(3).expand(bs, xmax, ys.size(1), 1)
+        log_probs_label = torch.gather(log_probs[:, :, :-1], 3, ys).squeeze(3)
+        return log_probs_blank, log_probs_label
+
     def joint(self, eout, dout):
         """
         Args:
@@ -459,88 +533,159 @@ class RNNTransducer(DecoderBase):
                 zero_state['cxs'] = torch.cat(cxs, dim=0)  # `[n_layers, B, dec_n_units]`
         return zero_state
 
-    def greedy(self, eouts, elens, max_len_ratio,
-               exclude_eos=False, idx2token=None, refs_id=None,
-               speakers=None, oracle=False):
-        """Greedy decoding in the inference stage.
+    def greedy(self, eouts, elens, max_len_ratio, idx2token,
+               exclude_eos=False, refs_id=None,
+               speakers=None, oracle=False, max_symbols_per_frame=1):
+        """Greedy decoding in the batch mode.
+
+        All utterances advance over encoder frames in lockstep. At each frame,
+        utterances keep emitting labels until they emit a blank or reach the
+        per-frame limit, and the prediction network is updated only for the
+        utterances that emitted a label.
 
         Args:
             eouts (FloatTensor): `[B, T, enc_units]`
             elens (IntTensor): `[B]`
-            max_len_ratio (int): maximum sequence length of tokens
-            exclude_eos (bool):
+            max_len_ratio (int): not used
             idx2token ():
+            exclude_eos (bool):
             refs_id (list):
             speakers (list):
             oracle (bool):
+            max_symbols_per_frame (int): maximum number of labels emitted per frame
         Returns:
             best_hyps (list): A list of length `[B]`, which contains arrays of size `[L]`
             aw: dummy
 
         """
         bs = eouts.size(0)
+        elens = [int(elens[b]) for b in range(bs)]
 
-        best_hyps = []
-        for b in range(bs):
-            best_hyp_b = []
-            # Initialization
-            y = eouts.new_zeros(bs, 1).fill_(self.eos)
-            dout, dstate = self.recurrency(self.embed(y), None)
-
-            for t in range(elens[b]):
-                # Pick up 1-best per frame
-                out = self.joint(eouts[b:b + 1, t:t + 1], dout.squeeze(1))
-                y = F.log_softmax(out.squeeze(2), dim=-1).argmax(-1)
-                idx = y[0].item()
-
-                # Update prediction network only when predicting non-blank labels
-                if idx != self.blank:
+        best_hyps = [[] for _ in range(bs)]
+        is_finished = [False] * bs
+
+        # Initialization
+        y = eouts.new_zeros(bs, 1).fill_(self.eos).long()
+        dout, dstate = self.recurrency(self.embed(y), None)
+
+        for t in range(max(elens)):
+            ids = [b for b in range(bs) if t < elens[b] and not is_finished[b]]
+            for _ in range(max_symbols_per_frame):
+                if len(ids) == 0:
+                    break
+                ids_t = torch.LongTensor(ids).to(eouts.device)
+
+                # Pick up 1-best of utterances staying at the current frame
+                out = self.joint(eouts[ids_t, t:t + 1], dout[ids_t])
+                y = tensor2np(out.view(len(ids), self.vocab).argmax(-1))
+
+                ids_emit, ys_in = [], []
+                for i, b in enumerate(ids):
+                    idx = int(y[i])
+                    if idx == self.blank:
+                        continue
                     # early stop
                     if self.end_pointing and idx == self.eos:
                         if not exclude_eos:
-                            best_hyp_b += [idx]
-                        break
-
-                    best_hyp_b += [idx]
+                            best_hyps[b] += [idx]
+                        is_finished[b] = True
+                        continue
+                    best_hyps[b] += [idx]
+                    ids_emit.append(b)
                     if oracle:
-                        y = eouts.new_zeros(1, 1).fill_(refs_id[b, len(best_hyp_b) - 1])
-                    dout, dstate = self.recurrency(self.embed(y), dstate)
+                        refs_b = list(refs_id[b]) + [self.eos]
+                        ys_in.append(refs_b[min(len(best_hyps[b]), len(refs_b)) - 1])
+                    else:
+                        ys_in.append(idx)
+                if len(ids_emit) == 0:
+                    break
 
-            best_hyps += [best_hyp_b]
+                # Update prediction network only for utterances emitting labels
+                ids_t = torch.LongTensor(ids_emit).to(eouts.device)
+                ys_in = torch.LongTensor(ys_in).to(eouts.device).unsqueeze(1)
+                dstate_emit = {k: v.index_select(1, ids_t) if v is not None else None for k, v in dstate.items()}
+                dout_emit, dstate_emit = self.recurrency(self.embed(ys_in), dstate_emit)
+                dout = dout.index_copy(0, ids_t, dout_emit)
+                dstate = {k: v.index_copy(1, ids_t, dstate_emit[k]) if v is not None else None
+                          for k, v in dstate.items()}
+                ids = ids_emit
 
-        return best_hyps, None
+        return [np.array(hyp, dtype=np.int64) for hyp in best_hyps], None
+
+    def cached_recurrency(self, prefixes):
+        """Update prediction network for label prefixes with the state cache.
+
+        Outputs of the prediction network depend only on the label prefix, so
+        they are shared by all hypotheses (and utterances) with the same prefix.
+        Prefixes not in the cache are computed by a single call per length
+        from the cached states of their parents.
+
+        Args:
+            prefixes (list): A list of length `[N]`, which contains tuples of token ids
+                including <sos>
+        Returns:
+            dout (FloatTensor): `[N, dec_n_units]`
+
+        """
+        misses = [p for p in OrderedDict.fromkeys(prefixes) if p not in self.state_cache]
+        for length in sorted(set([len(p) for p in misses])):
+            group = [p for p in misses if len(p) == length]
+            ys = torch.LongTensor([[p[-1]] for p in group])
+            if self.device_id >= 0:
+                ys = ys.cuda(self.device_id)
+            if length == 1:
+                dstate = None
+            else:
+                dstates = [self.state_cache[p[:-1]]['dstate'] for p in group]
+                dstate = {'hxs': torch.cat([s['hxs'] for s in dstates], dim=1), 'cxs': None}
+                if self.rnn_type == 'lstm_transducer':
+                    dstate['cxs'] = torch.cat([s['cxs'] for s in dstates], dim=1)
+            dout, dstate = self.recurrency(self.embed(ys), dstate)
+            for j, p in enumerate(group):
+                self.state_cache[p] = {
+                    'dout': dout[j, 0],
+                    'dstate': {'hxs': dstate['hxs'][:, j:j + 1],
+                               'cxs': dstate['cxs'][:, j:j + 1] if dstate['cxs'] is not None else None},
+                }
+        return torch.stack([self.state_cache[p]['dout'] for p in prefixes], dim=0)
 
     def beam_search(self, eouts, elens, params, idx2token,
                     lm=None, lm_rev=None, ctc_log_probs=None,
                     nbest=1, exclude_eos=False,
                     refs_id=None, utt_ids=None, speakers=None,
                     ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[]):
-        """Beam search decoding.
+        """Time-synchronous beam search decoding in the batch mode.
+
+        At each frame, hypotheses are expanded by up to `recog_max_symbols_per_frame`
+        labels followed by a blank. Each expansion evaluates the joint network for
+        all live hypotheses of all utterances in a single call, and hypotheses
+        reaching the same label sequence through different alignments are merged.
+
+        NOTE: a frame is always closed by a blank, also after labels (standard
+        RNN-T topology). The previous search emitted either a blank or a single
+        label per frame without merging, so hypotheses and their scores differ
+        from it even with `recog_max_symbols_per_frame=1`.
 
         Args:
             eouts (FloatTensor): `[B, T, dec_n_units]`
             elens (IntTensor): `[B]`
             params (dict):
                 recog_beam_width (int): size of hyp
-                recog_max_len_ratio (int): maximum sequence length of tokens
-                recog_min_len_ratio (float): minimum sequence length of tokens
-                recog_length_penalty (float): length penalty
-                recog_coverage_penalty (float): coverage penalty
-                recog_coverage_threshold (float): threshold for coverage penalty
+                recog_max_symbols_per_frame (int): maximum number of labels emitted per frame
                 recog_lm_weight (float): weight of LM score
-                recog_n_caches (int):
+                recog_lm_usage (str): shallow_fusion or rescoring
             idx2token (): converter from index to token
             lm (RNNLM or GatedConvLM or TransformerLM):
-            lm_rev (RNNLM or GatedConvLM or TransformerLM):
-            ctc_log_probs (FloatTensor):
+            lm_rev: not supported
+            ctc_log_probs (FloatTensor): not used
             nbest (int):
             exclude_eos (bool):
             refs_id (list):
             utt_ids (list):
             speakers (list):
-            ensmbl_eouts (list): list of FloatTensor
-            ensmbl_elens (list) list of list
-            ensmbl_decs (list): list of torch.nn.Module
+            ensmbl_eouts: not supported
+            ensmbl_elens: not supported
+            ensmbl_decs: not supported
         Returns:
             nbest_hyps_idx (list): A list of length `[B]`, which contains list of N hypotheses
             aws: dummy
@@ -550,162 +695,163 @@ class RNNTransducer(DecoderBase):
         """
         logger = logging.getLogger("decoding")
 
+        if lm_rev is not None or len(ensmbl_decs) > 0:
+            raise NotImplementedError
+
         bs = eouts.size(0)
-        best_hyps = []
+        elens = [int(elens[b]) for b in range(bs)]
 
         oracle = params['recog_oracle']
         beam_width = params['recog_beam_width']
-        ctc_weight = params['recog_ctc_weight']
+        max_sym_exp = params['recog_max_symbols_per_frame'] + 1
         lm_weight = params['recog_lm_weight']
-        asr_state_carry_over = params['recog_asr_state_carry_over']
-        lm_state_carry_over = params['recog_lm_state_carry_over']
         lm_usage = params['recog_lm_usage']
 
         if lm is not None:
             lm.eval()
-
-        for b in range(bs):
-            # Initialization
-            y = eouts.new_zeros(bs, 1).fill_(self.eos)
-            dout, dstate = self.recurrency(self.embed(y), None)
-            lmstate = None
-
-            if lm_state_carry_over:
-                lmstate = self.lmstate_final
-            self.prev_spk = speakers[b]
-
-            end_hyps = []
-            hyps = [{'hyp': [self.eos],
-                     'lattice': [],
-                     'ref_id': [self.eos],
-                     'score': 0.0,
-                     'score_lm': 0.0,
-                     'score_ctc': 0.0,
-                     'dout': dout,
-                     'dstate': dstate,
-                     'lmstate': lmstate,
-                     }]
-            for t in range(elens[b]):
-                new_hyps = []
-                for hyp in hyps:
-                    prev_idx = ([self.eos] + refs_id[b])[t] if oracle else hyp['hyp'][-1]
-                    score = hyp['score']
-                    score_lm = hyp['score_lm']
-                    dout = hyp['dout']
-                    dstate = hyp['dstate']
-                    lmstate = hyp['lmstate']
-
-                    # Pick up the top-k scores
-                    out = self.joint(eouts[b:b + 1, t:t + 1], dout.squeeze(1))
-                    log_probs = F.log_softmax(out.squeeze(2), dim=-1)
-                    log_probs_topk, topk_ids = torch.topk(
-                        log_probs[0, 0], k=min(beam_width, self.vocab), dim=-1, largest=True, sorted=True)
-
-                    for k in range(beam_width):
-                        idx = topk_ids[k].item()
-                        score += log_probs_topk[k].item()
-
-                        # Update prediction network only when predicting non-blank labels
-                        lattice = hyp['lattice'] + [idx]
-                        if idx == self.blank:
-                            hyp_id = hyp['hyp']
-                        else:
-                            hyp_id = hyp['hyp'] + [idx]
-                            hyp_str = ' '.join(list(map(str, hyp_id[1:])))
-                            if hyp_str in self.state_cache.keys():
-                                # from cache
-                                dout = self.state_cache[hyp_str]['dout']
-                                new_dstate = self.state_cache[hyp_str]['dstate']
-                            else:
-                                if oracle:
-                                    y = eouts.new_zeros(1, 1).fill_(refs_id[b, len(hyp_id) - 1])
-                                else:
-                                    y = eouts.new_zeros(1, 1).fill_(idx)
-                                dout, new_dstate = self.recurrency(self.embed(y), dstate)
-
-                                # Update LM states for shallow fusion
-                                if lm_weight > 0 and lm is not None:
-                                    _, lmstate, lm_log_probs = lm.predict(
-                                        eouts.new_zeros(1, 1).fill_(prev_idx), hyp['lmstate'])
-                                    local_score_lm = lm_log_probs[0, idx].item()
-                                    score_lm += local_score_lm * lm_weight
-                                    score += local_score_lm * lm_weight
-
-                                # to cache
-                                self.state_cache[hyp_str] = {
-                                    'lattice': lattice,
-                                    'dout': dout,
-                                    'dstate': new_dstate,
-                                    'lmstate': lmstate,
-                                }
-
-                        new_hyps.append({'hyp': hyp_id,
-                                         'lattice': lattice,
-                                         'score': score,
-                                         'score_lm': score_lm,
-                                         'score_ctc': 0,  # TODO
-                                         'dout': dout,
-                                         'dstate': dstate if idx == self.blank else new_dstate,
-                                         'lmstate': lmstate,
-                                         })
-
-                # Local pruning
-                new_hyps_tmp = sorted(new_hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
-
-                # Remove complete hypotheses
-                new_hyps = []
-                for hyp in new_hyps_tmp:
-                    if oracle:
-                        if t == len(refs_id[b]):
-                            end_hyps += [hyp]
-                        else:
-                            new_hyps += [hyp]
+        lm_cache = None
+        if lm_weight > 0 and lm is not None and lm_usage == 'shallow_fusion':
+            # NOTE: LM scores of merged hypotheses are looked up by label prefixes
+            lm_cache = get_lm_score_cache(lm, params)
+            if lm_cache is None:
+                lm_cache = LMScoreCache(lm, max_mb=None)
+
+        if oracle:
+            refs = [list(refs_id[b]) + ([self.eos] if self.end_pointing else []) for b in range(bs)]
+
+        # A hypothesis is a tuple of (label prefix including <sos>, score, score_lm)
+        beams = [[((self.eos,), 0., 0.)] for _ in range(bs)]
+        end_hyps = [[] for _ in range(bs)]
+        is_finished = [False] * bs
+        for t in range(max(elens)):
+            active = [b for b in range(bs) if t < elens[b] and not is_finished[b] and len(beams[b]) > 0]
+            if len(active) == 0:
+                break
+            merged = [OrderedDict() for _ in range(bs)]  # prefix -> (score, score_lm), ending with blank
+            expands = [beams[b] for b in active]
+            for v in range(max_sym_exp):
+                # Flatten hypotheses to be expanded into `[n_active * beam_width]` slots
+                rows, slots = [], []
+                for a, hyps_a in enumerate(expands):
+                    for j, hyp in enumerate(hyps_a):
+                        rows.append((active[a], hyp))
+                        slots.append(a * beam_width + j)
+                if len(rows) == 0:
+                    break
+                prefixes = [hyp[0] for _, hyp in rows]
+                b_ids = torch.LongTensor([b for b, _ in rows])
+                if self.device_id >= 0:
+                    b_ids = b_ids.cuda(self.device_id)
+
+                # Compute output distributions of all hypotheses at once
+                dout = self.cached_recurrency(prefixes)
+                out = self.joint(eouts[b_ids, t].unsqueeze(1), dout.unsqueeze(1))
+                log_probs = F.log_softmax(out.view(len(rows), self.vocab), dim=-1)
+                scores = eouts.new_tensor([hyp[1] for _, hyp in rows])
+
+                # Emit blank and move to the next frame (merge hypotheses with the same labels)
+                scores_blank = tensor2np(scores + log_probs[:, self.blank])
+                for i, (b, hyp) in enumerate(rows):
+                    if hyp[0] in merged[b]:
+                        score, score_lm = merged[b][hyp[0]]
+                        merged[b][hyp[0]] = (float(np.logaddexp(score, scores_blank[i])), score_lm)
                     else:
-                        if self.end_pointing and hyp['hyp'][-1] == self.eos:
-                            end_hyps += [hyp]
-                        else:
-                            new_hyps += [hyp]
-                if len(end_hyps) >= beam_width:
-                    end_hyps = end_hyps[:beam_width]
-                    logger.info('End-pointed at %d / %d frames' % (t, elens[b]))
+                        merged[b][hyp[0]] = (float(scores_blank[i]), hyp[2])
+                if v == max_sym_exp - 1:
                     break
-                hyps = new_hyps[:]
 
-            # Rescoing lattice
-            if lm_weight > 0 and lm is not None and lm_usage == 'rescoring':
-                new_hyps = []
-                for hyp in hyps:
-                    ys = [np2tensor(np.fromiter(hyp['hyp'], dtype=np.int64), self.device_id)]
+                # Emit labels and stay at the current frame
+                if lm_cache is not None:
+                    scores_lm = lm_cache.predict(prefixes) * lm_weight
+                else:
+                    scores_lm = log_probs.new_zeros(len(rows), self.vocab)
+                cands = scores.unsqueeze(1) + log_probs + scores_lm
+                cands[:, self.blank] = LOG_0
+                if oracle:
+                    ids = [(i, refs[b][len(hyp[0]) - 1]) for i, (b, hyp) in enumerate(rows)
+                           if len(hyp[0]) - 1 < len(refs[b])]
+                    cands_oracle = cands.new_full(cands.size(), LOG_0)
+                    if len(ids) > 0:
+                        i_ids, k_ids = [torch.LongTensor(x).to(cands.device) for x in zip(*ids)]
+                        cands_oracle[i_ids, k_ids] = cands[i_ids, k_ids]
+                    cands = cands_oracle
+                if self.end_pointing:
+                    scores_eos = tensor2np(cands[:, self.eos])
+                    scores_lm_eos = tensor2np(scores_lm[:, self.eos])
+                    for i, (b, hyp) in enumerate(rows):
+                        if scores_eos[i] > LOG_0:
+                            end_hyps[b].append((hyp[0] + (self.eos,), float(scores_eos[i]),
+                                                hyp[2] + float(scores_lm_eos[i])))
+                    cands[:, self.eos] = LOG_0
+
+                # Pick up the top-k labels per utterance
+                slots = torch.LongTensor(slots).to(cands.device)
+                cands_pad = cands.new_full((len(active) * beam_width, self.vocab), LOG_0)
+                cands_pad[slots] = cands
+                topk_scores, topk_ids = torch.topk(cands_pad.view(len(active), -1), k=beam_width, dim=1)
+                topk_scores = tensor2np(topk_scores)
+                topk_ids = tensor2np(topk_ids)
+                row_ids = [-1] * (len(active) * beam_width)
+                for i, slot in enumerate(tensor2np(slots)):
+                    row_ids[slot] = i
+                selected = [(a, row_ids[a * beam_width + topk_ids[a, k] // self.vocab], topk_ids[a, k] % self.vocab,
+                             topk_scores[a, k])
+                            for a in range(len(active)) for k in range(beam_width) if topk_scores[a, k] > LOG_0]
+                expands = [[] for _ in active]
+                if len(selected) > 0:
+                    i_ids = torch.LongTensor([s[1] for s in selected]).to(cands.device)
+                    k_ids = torch.LongTensor([s[2] for s in selected]).to(cands.device)
+                    selected_lm = tensor2np(scores_lm[i_ids, k_ids])
+                    for (a, i, k, score), score_lm in zip(selected, selected_lm):
+                        hyp = rows[i][1]
+                        expands[a].append((hyp[0] + (int(k),), float(score), hyp[2] + float(score_lm)))
+
+            # Local pruning
+            for b in active:
+                beams[b] = sorted([(p, s[0], s[1]) for p, s in merged[b].items()],
+                                  key=lambda x: x[1], reverse=True)[:beam_width]
+                end_hyps[b] = sorted(end_hyps[b], key=lambda x: x[1], reverse=True)[:max(beam_width, nbest)]
+
+                # NOTE: scores never increase, so active hypotheses cannot outperform the ended ones
+                if len(end_hyps[b]) >= nbest and (len(beams[b]) == 0 or end_hyps[b][nbest - 1][1] > beams[b][0][1]):
+                    is_finished[b] = True
+                    logger.info('End-pointed at %d / %d frames' % (t, elens[b]))
+
+        nbest_hyps_idx = []
+        for b in range(bs):
+            hyps = sorted(end_hyps[b] + beams[b], key=lambda x: x[1], reverse=True)
+            if oracle and any([len(hyp[0]) - 1 == len(refs[b]) for hyp in hyps]):
+                hyps = [hyp for hyp in hyps if len(hyp[0]) - 1 == len(refs[b])]
+
+            # Rescoring lattice
+            if lm_weight > 0 and lm is not None and lm_usage == 'rescoring' and len(hyps) > 0:
+                ys = [np2tensor(np.fromiter(hyp[0], dtype=np.int64), self.device_id) for hyp in hyps]
+                ylens = [len(hyp[0]) - 1 for hyp in hyps]
+                scores_lm = [0.] * len(hyps)
+                if max(ylens) > 0:
                     ys_pad = pad_list(ys, lm.pad)
-                    _, _, lm_log_probs = lm.predict(ys_pad, None)
-                    score_ctc = 0  # TODO:
-                    score_lm = lm_log_probs.sum() * lm_weight
-                    new_hyps.append({'hyp': hyp['hyp'],
-                                     'score': hyp['score'] + score_lm,
-                                     'score_ctc': score_ctc,
-                                     'score_lm': score_lm
-                                     })
-                hyps = sorted(new_hyps, key=lambda x: x['score'], reverse=True)
-
-            # Exclude <eos>
-            if False and exclude_eos and self.end_pointing and hyps[0]['hyp'][-1] == self.eos:
-                best_hyps.append([hyps[0]['hyp'][1:-1]])
-            else:
-                best_hyps.append([hyps[0]['hyp'][1:]])
+                    _, _, lm_log_probs = lm.predict(ys_pad[:, :-1], None)
+                    lm_log_probs = torch.gather(lm_log_probs, 2, ys_pad[:, 1:].unsqueeze(2)).squeeze(2)
+                    scores_lm = [float(lm_log_probs[i, :ylens[i]].sum()) * lm_weight for i in range(len(hyps))]
+                hyps = sorted([(hyp[0], hyp[1] + s, s) for hyp, s in zip(hyps, scores_lm)],
+                              key=lambda x: x[1], reverse=True)
 
-            # Reset state cache
-            self.state_cache = OrderedDict()
+            nbest_hyps_idx += [[np.array(hyp[0][1:], dtype=np.int64) for hyp in hyps[:nbest]]]
 
             if utt_ids is not None:
                 logger.info('Utt-id: %s' % utt_ids[b])
             if refs_id is not None and self.vocab == idx2token.vocab:
                 logger.info('Ref: %s' % idx2token(refs_id[b]))
-            logger.info('Hyp: %s' % idx2token(hyps[0]['hyp'][1:]))
-            logger.info('log prob (hyp): %.7f' % hyps[0]['score'])
-            if ctc_weight > 0 and ctc_log_probs is not None:
-                logger.info('log prob (hyp, ctc): %.7f' % (hyps[0]['score_ctc']))
-            # logger.info('log prob (lp): %.7f' % hyps[0]['score_lp'])
-            if lm_weight > 0 and lm is not None:
-                logger.info('log prob (hyp, lm): %.7f' % (hyps[0]['score_lm']))
-
-        return np.array(best_hyps), None, None, None
+            if len(hyps) > 0:
+                logger.info('Hyp: %s' % idx2token(list(hyps[0][0][1:])))
+                logger.info('log prob (hyp): %.7f' % hyps[0][1])
+                if lm_weight > 0 and lm is not None:
+                    logger.info('log prob (hyp, lm): %.7f' % hyps[0][2])
+
+        # Reset state cache
+        self.state_cache = OrderedDict()
+
+        if lm_cache is not None:
+            logger.info(lm_cache.stats())
+
+        return nbest_hyps_idx, None, None, None
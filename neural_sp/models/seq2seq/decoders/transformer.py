@@ -11,6 +11,7 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import math
 import numpy as np
 import os
 import random
@@ -25,8 +26,20 @@ from neural_sp.models.modules.embedding import Embedding
 from neural_sp.models.modules.linear import LinearND
 from neural_sp.models.modules.transformer import PositionalEncoding
 from neural_sp.models.modules.transformer import TransformerDecoderBlock
+from neural_sp.models.seq2seq.decoders.beam_search import add_coverage_penalty
+from neural_sp.models.seq2seq.decoders.beam_search import add_ctc_scores
+from neural_sp.models.seq2seq.decoders.beam_search import add_length_penalty
+from neural_sp.models.seq2seq.decoders.beam_search import BeamHistory
+from neural_sp.models.seq2seq.decoders.beam_search import EndedHypotheses
+from neural_sp.models.seq2seq.decoders.beam_search import extend_prefixes
+from neural_sp.models.seq2seq.decoders.beam_search import get_lm_score_cache
+from neural_sp.models.seq2seq.decoders.beam_search import log_hyps
+from neural_sp.models.seq2seq.decoders.beam_search import mask_candidates
+from neural_sp.models.seq2seq.decoders.beam_search import predict_lm_cache
+from neural_sp.models.seq2seq.decoders.beam_search import select_lmstate
+from neural_sp.models.seq2seq.decoders.beam_search import select_topk
 from neural_sp.models.seq2seq.decoders.ctc import CTC
-# from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScore
+from neural_sp.models.seq2seq.decoders.ctc import CTCPrefixScoreTH
 from neural_sp.models.seq2seq.decoders.decoder_base import DecoderBase
 from neural_sp.models.torch_utils import compute_accuracy
 from neural_sp.models.torch_utils import np2tensor
@@ -40,6 +53,8 @@ matplotlib.use('Agg')
 
 random.seed(1)
 
+NEG_INF = float(np.finfo(np.float32).min)
+
 
 class TransformerDecoder(DecoderBase):
     """Transformer decoder.
@@ -68,6 +83,7 @@ class TransformerDecoder(DecoderBase):
         ctc_weight (float):
         ctc_lsm_prob (float): label smoothing probability for CTC
         ctc_fc_list (list):
+        ctc_loss_impl (str): implementation of CTC loss (warpctc or pytorch)
         backward (bool): decode in the backward order
         global_weight (float):
         mtl_per_batch (bool):
@@ -99,6 +115,7 @@ class TransformerDecoder(DecoderBase):
                  ctc_weight=0.0,
                  ctc_lsm_prob=0.0,
                  ctc_fc_list=[],
+                 ctc_loss_impl='warpctc',
                  backward=False,
                  global_weight=1.0,
                  mtl_per_batch=False,
@@ -111,6 +128,7 @@ class TransformerDecoder(DecoderBase):
         self.unk = unk
         self.pad = pad
         self.blank = blank
+        self.vocab = vocab
         self.enc_n_units = enc_n_units
         self.d_model = d_model
         self.n_layers = n_layers
@@ -132,6 +150,7 @@ class TransformerDecoder(DecoderBase):
                            dropout=dropout,
                            lsm_prob=ctc_lsm_prob,
                            fc_list=ctc_fc_list,
+                           loss_impl=ctc_loss_impl,
                            param_init=0.1)
 
         if ctc_weight < global_weight:
@@ -332,9 +351,15 @@ class TransformerDecoder(DecoderBase):
         bs, xmax = eouts.size()[:2]
 
         # Start from <sos> (<eos> in case of the backward decoder)
-        ys_all = eouts.new_zeros(bs, 1).fill_(self.eos).long()
+        y = eouts.new_zeros(bs, 1).fill_(self.eos).long()
+
+        # Create the source-target mask for batch decoding
+        xy_mask = make_pad_mask(elens, self.device_id).unsqueeze(1).unsqueeze(2)  # `[B, 1, 1, T]`
 
-        # TODO(hirofumi): Create the source-target mask for batch decoding
+        # NOTE: keys and values of the previous tokens are cached in each layer
+        for l in range(self.n_layers):
+            self.layers[l].reset()
+        caches = [{} for _ in range(self.n_layers)]
 
         best_hyps_batch = []
         ylens = torch.zeros(bs).int()
@@ -342,9 +367,9 @@ class TransformerDecoder(DecoderBase):
         xy_aws_tmp = [None] * bs
         eos_flags = [False] * bs
         for t in range(int(np.floor(xmax * max_len_ratio)) + 1):
-            out = self.pos_enc(self.embed(ys_all))
+            out = self.pos_enc(self.embed(y), offset=t)
             for l in range(self.n_layers):
-                out, yy_aws, xy_aws = self.layers[l](out, None, eouts, None)
+                out, yy_aws, xy_aws = self.layers[l](out, None, eouts, xy_mask, cache=caches[l])
             out = self.norm_out(out)
 
             # Pick up 1-best
@@ -365,8 +390,6 @@ class TransformerDecoder(DecoderBase):
             if sum(eos_flags) == bs:
                 break
 
-            ys_all = torch.cat([ys_all, y], dim=-1)
-
         # Concatenate in L dimension
         best_hyps_batch = torch.cat(best_hyps_batch, dim=1)
         # xy_aws_tmp = torch.stack(xy_aws_tmp, dim=0)
@@ -398,6 +421,224 @@ class TransformerDecoder(DecoderBase):
         # return best_hyps, aws
         return best_hyps, None
 
+    def beam_search(self, eouts, elens, params, idx2token,
+                    lm=None, lm_rev=None, ctc_log_probs=None,
+                    nbest=1, exclude_eos=False,
+                    refs_id=None, utt_ids=None, speakers=None,
+                    ensmbl_eouts=None, ensmbl_elens=None, ensmbl_decs=[]):
+        """Batched beam search decoding.
+
+        All hypotheses in the mini-batch are stacked as `[B * beam]`, and only the
+        last token of each hypothesis is fed at each step by caching keys and values
+        of self-attention of the previous tokens in each layer.
+
+        Args:
+            eouts (FloatTensor): `[B, T, d_model]`
+            elens (IntTensor): `[B]`
+            params (dict):
+                recog_beam_width (int): size of beam
+                recog_max_len_ratio (int): maximum sequence length of tokens
+                recog_min_len_ratio (float): minimum sequence length of tokens
+                recog_length_penalty (float): length penalty
+                recog_lm_weight (float): weight of LM score
+                recog_ctc_weight (float): weight of CTC score
+                recog_coverage_penalty (float): coverage penalty
+                recog_coverage_threshold (float): threshold for coverage penalty
+                recog_lm_cache_size (float): size of the LM score cache [MB]
+            idx2token (): converter from index to token
+            lm (RNNLM or GatedConvLM or TransformerLM):
+            lm_rev (RNNLM or GatedConvLM or TransformerLM): not supported
+            ctc_log_probs (FloatTensor): `[B, T, vocab]`
+            nbest (int):
+            exclude_eos (bool):
+            refs_id (list):
+            utt_ids (list):
+            speakers (list):
+            ensmbl_eouts (list): not supported
+            ensmbl_elens (list): not supported
+            ensmbl_decs (list): not supported
+        Returns:
+            nbest_hyps_idx (list): A list of length `[B]`, which contains list of N hypotheses
+            aws (list): A list of length `[B]`, which contains arrays of size `[L, n_heads, 1, T]`
+                (source-target attention in the last layer)
+            scores (list):
+            cache_info (tuple): dummy
+
+        """
+        logger = logging.getLogger("decoding")
+
+        if lm_rev is not None or len(ensmbl_decs) > 0:
+            raise NotImplementedError
+
+        bs = eouts.size(0)
+        elens = [int(elens[b]) for b in range(bs)]
+        xmax = max(elens)
+
+        beam_width = params['recog_beam_width']
+        ctc_weight = params['recog_ctc_weight']
+        max_len_ratio = params['recog_max_len_ratio']
+        min_len_ratio = params['recog_min_len_ratio']
+        lp_weight = params['recog_length_penalty']
+        lm_weight = params['recog_lm_weight']
+        gnmt_decoding = params['recog_gnmt_decoding']
+        eos_threshold = params['recog_eos_threshold']
+        cp_weight = params['recog_coverage_penalty']
+        cp_threshold = params['recog_coverage_threshold']
+
+        if lm is not None:
+            lm.eval()
+        lm_cache = get_lm_score_cache(lm, params) if lm_weight > 0 else None
+
+        # Expand encoder outputs for all hypotheses
+        n_hyps = bs * beam_width
+        eouts = eouts[:, :xmax].unsqueeze(1).expand(
+            bs, beam_width, xmax, eouts.size(2)).contiguous().view(n_hyps, xmax, -1)
+        elens_hyp = torch.IntTensor([elens[i // beam_width] for i in range(n_hyps)])
+        xmask = make_pad_mask(elens_hyp, self.device_id)  # `[B * beam, T]`
+        xy_mask = xmask.unsqueeze(1).unsqueeze(2)  # `[B * beam, 1, 1, T]`
+
+        # For joint CTC-Attention decoding
+        ctc_prefix_score = None
+        ctc_state = None
+        if ctc_weight > 0 and ctc_log_probs is not None:
+            ctc_log_probs = ctc_log_probs[:, :xmax]
+            if self.bwd:
+                ctc_log_probs = ctc_log_probs.clone()
+                for b in range(bs):
+                    ctc_log_probs[b, :elens[b]] = ctc_log_probs[b, :elens[b]].flip(0)
+            ctc_prefix_score = CTCPrefixScoreTH(ctc_log_probs, elens, self.blank, self.eos, beam_width,
+                                                window=params['recog_ctc_window'])
+            ctc_state = ctc_prefix_score.initial_state()
+
+        # Initialization
+        for l in range(self.n_layers):
+            self.layers[l].reset()
+        caches = [{} for _ in range(self.n_layers)]
+        lmstate = None
+        y = eouts.new_zeros(n_hyps, 1, dtype=torch.int64).fill_(self.eos)
+        prefixes = [(self.eos,)] * n_hyps  # for LM score cache
+
+        # NOTE: only the first hypothesis of each utterance is alive at the first step
+        hyp_scores = eouts.new_zeros(bs, beam_width)
+        hyp_scores[:, 1:] = NEG_INF
+        hyp_scores = hyp_scores.view(-1)
+        scores_attn = eouts.new_zeros(n_hyps)
+        scores_lm = eouts.new_zeros(n_hyps)
+        scores_ctc = eouts.new_zeros(n_hyps)
+        cps = eouts.new_zeros(n_hyps)
+        aw_sum = eouts.new_zeros(n_hyps, xmax)  # accumulated attention weights for coverage penalty
+        offset = torch.arange(0, n_hyps, beam_width, dtype=torch.int64).unsqueeze(1)
+        if self.device_id >= 0:
+            offset = offset.cuda(self.device_id)
+        min_lens = eouts.new_tensor([elens[i // beam_width] * min_len_ratio for i in range(n_hyps)])
+
+        ymax = [int(math.floor(elens[b] * max_len_ratio)) + 1 for b in range(bs)]
+        ended = EndedHypotheses(bs, beam_width, self.eos, ymax)
+        keep_aws = params['recog_keep_attention'] or params['recog_fwd_bwd_attention']
+        history = BeamHistory(n_hyps, max(ymax), self.device_id, keep_aws)
+        for t in range(max(ymax)):
+            if lm_weight > 0 and lm is not None and lm_cache is not None:
+                # Look up LM scores of alive hypotheses for shallow fusion
+                lm_log_probs = predict_lm_cache(lm_cache, prefixes, hyp_scores)
+            elif lm_weight > 0 and lm is not None:
+                # Update LM states for shallow fusion
+                _, lmstate, lm_log_probs = lm.predict(y, lmstate)
+
+            # Feed only the last token
+            out = self.pos_enc(self.embed(y), offset=t)
+            for l in range(self.n_layers):
+                out, _, xy_aws = self.layers[l](out, None, eouts, xy_mask, cache=caches[l])
+            out = self.norm_out(out)
+            if self.adaptive_softmax is None:
+                local_scores_attn = F.log_softmax(self.output(out).squeeze(1), dim=-1)
+            else:
+                local_scores_attn = self.adaptive_softmax.log_prob(out.view(-1, out.size(2)))
+
+            # Attention scores
+            scores_attn_all = scores_attn.unsqueeze(1) + local_scores_attn  # `[B * beam, vocab]`
+            total_scores, topk_ids = torch.topk(
+                scores_attn_all * (1 - ctc_weight), k=beam_width, dim=1, largest=True, sorted=True)
+
+            # Add LM score <after> top-K selection
+            if lm_weight > 0 and lm is not None:
+                total_scores_lm = scores_lm.unsqueeze(1) + lm_log_probs[:, -1].gather(1, topk_ids)
+                total_scores += total_scores_lm * lm_weight
+            else:
+                total_scores_lm = total_scores.new_zeros(total_scores.size())
+
+            # Add length penalty
+            total_scores = add_length_penalty(total_scores, t, lp_weight, gnmt_decoding)
+
+            # Add coverage penalty
+            aw_mean = xy_aws[:, :, 0].mean(1)  # `[B * beam, T]` (average over heads in the last layer)
+            total_scores, cp, aw_sum = add_coverage_penalty(total_scores, aw_mean, aw_sum, xmask,
+                                                            cp_weight, cp_threshold, gnmt_decoding)
+
+            # CTC score
+            peaks = None
+            if ctc_prefix_score is not None and params['recog_ctc_window'] > 0 and \
+                    params['recog_ctc_window_center'] == 'attention':
+                peaks = aw_mean.max(1)[1]
+                if self.bwd:
+                    peaks = ctc_prefix_score.last_frames - peaks
+            total_scores, topk_ids, total_scores_lm, total_scores_ctc, ctc_states_all, joint_ids_topk = add_ctc_scores(
+                ctc_prefix_score, total_scores, topk_ids, total_scores_lm,
+                t, y[:, 0], ctc_state, hyp_scores, ctc_weight, beam_width, peaks)
+
+            # Exclude short hypotheses, apply the EOS threshold and exclude completed hypotheses
+            total_scores = mask_candidates(total_scores, topk_ids, local_scores_attn, hyp_scores,
+                                           self.eos, eos_threshold, min_lens, t)
+
+            # Pick up the top-K hypotheses among beam * beam candidates per utterance
+            hyp_scores, best_ids, parent_ids, tokens = select_topk(total_scores, topk_ids, beam_width, offset)
+            scores_attn = scores_attn_all[parent_ids, tokens]
+            scores_lm = total_scores_lm.view(bs, -1).gather(1, best_ids).view(-1)
+            scores_ctc = total_scores_ctc.view(bs, -1).gather(1, best_ids).view(-1)
+            cps = cp.index_select(0, parent_ids)
+            if ctc_prefix_score is not None:
+                cand_ids = joint_ids_topk.view(bs, -1).gather(1, best_ids).view(-1)
+                ctc_state = ctc_prefix_score.select_state(ctc_states_all, parent_ids, cand_ids)
+
+            # Reorder states by the parent hypotheses
+            for cache in caches:
+                cache['key'] = cache['key'].index_select(0, parent_ids)
+                cache['value'] = cache['value'].index_select(0, parent_ids)
+            if cp_weight > 0:
+                aw_sum = aw_sum.index_select(0, parent_ids)
+            lmstate = select_lmstate(lmstate, parent_ids)
+            history.append(tokens, parent_ids, hyp_scores, xy_aws.index_select(0, parent_ids))
+            y = tokens.unsqueeze(1)
+            if lm_cache is not None:
+                prefixes = extend_prefixes(prefixes, parent_ids, tokens)
+
+            # Remove complete hypotheses
+            hyp_scores = ended.update(t, tokens, hyp_scores, {'score': hyp_scores,
+                                                              'score_attn': scores_attn,
+                                                              'score_cp': cps,
+                                                              'score_ctc': scores_ctc,
+                                                              'score_lm': scores_lm})
+            if ended.all_finished:
+                break
+
+        nbest_hyps_idx, aws, scores, sorted_hyps = ended.nbest(history, nbest, elens, self.bwd, exclude_eos)
+
+        weights = [('att', 'score_attn', 1 - ctc_weight)]
+        if cp_weight > 0:
+            weights.append(('cp', 'score_cp', cp_weight))
+        if ctc_weight > 0 and ctc_log_probs is not None:
+            weights.append(('ctc', 'score_ctc', ctc_weight))
+        if lm_weight > 0 and lm is not None:
+            weights.append(('lm', 'score_lm', lm_weight))
+        for b in range(bs):
+            log_hyps(sorted_hyps[b], idx2token, weights, self.bwd,
+                     utt_id=utt_ids[b] if utt_ids is not None else None,
+                     ref=refs_id[b] if refs_id is not None and self.vocab == idx2token.vocab else None)
+
+        if lm_cache is not None:
+            logger.info(lm_cache.stats())
+
+        return nbest_hyps_idx, aws, scores, (None, None)
+
     def _plot_attention(self, save_path, n_cols=2):
         """Plot attention for each head in all layers."""
         from matplotlib import pyplot as plt
@@ -11,6 +11,7 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import torch
 
 
 def stack_frame(feat, n_stacks, n_skips, dtype=np.float32):
@@ -39,39 +40,46 @@ def stack_frame(feat, n_stacks, n_skips, dtype=np.float32):
     n_frames, input_dim = feat.shape
     n_frames_new = (n_frames + 1) // n_skips
 
-    stacked_feat = np.zeros((n_frames_new, input_dim * n_stacks), dtype=dtype)
-    stack_count = 0
-    stack = []
-    for t, frame_t in enumerate(feat):
-        if t == len(feat) - 1:  # final frame
-            # Stack the final frame
-            stack.append(frame_t)
-
-            while stack_count != int(n_frames_new):
-                # Concatenate stacked frames
-                for i in range(len(stack)):
-                    stacked_feat[stack_count][input_dim
-                                              * i:input_dim * (i + 1)] = stack[i]
-                stack_count += 1
-
-                # Delete some frames to skip
-                for _ in range(n_skips):
-                    if len(stack) != 0:
-                        stack.pop(0)
-
-        elif len(stack) < n_stacks:  # first & middle frames
-            # Stack some frames until stack is filled
-            stack.append(frame_t)
-
-        if len(stack) == n_stacks:
-            # Concatenate stacked frames
-            for i in range(n_stacks):
-                stacked_feat[stack_count][input_dim
-                                          * i:input_dim * (i + 1)] = stack[i]
-            stack_count += 1
-
-            # Delete some frames to skip
-            for _ in range(n_skips):
-                stack.pop(0)
-
-    return stacked_feat
+    # The k-th stacked frame consists of frames [k * n_skips, k * n_skips + n_stacks),
+    # where frames after the last one are filled with zeros
+    feat_pad = np.zeros((max(n_frames, (n_frames_new - 1) * n_skips + n_stacks), input_dim), dtype=dtype)
+    feat_pad[:n_frames] = feat
+    stacked_feat = np.lib.stride_tricks.as_strided(
+        feat_pad, shape=(n_frames_new, input_dim * n_stacks),
+        strides=(feat_pad.strides[0] * n_skips, feat_pad.strides[1]))
+    return stacked_feat.copy()
+
+
+def stack_frame_tensor(xs, xlens, n_stacks, n_skips):
+    """Stack & skip frames of padded features in a mini-batch (same as stack_frame).
+
+    Args:
+        xs (FloatTensor): `[B, T, input_dim]`
+        xlens (IntTensor): `[B]`
+        n_stacks (int): the number of frames to stack
+        n_skips (int): the number of frames to skip
+    Returns:
+        xs (FloatTensor): `[B, floor((T + 1) / n_skips), input_dim * n_stacks]`
+        xlens (IntTensor): `[B]`
+
+    """
+    if n_stacks == 1 and n_skips == 1:
+        return xs, xlens
+
+    if n_stacks < n_skips:
+        raise ValueError('n_skips must be less than n_stacks.')
+
+    bs, xmax, input_dim = xs.size()
+    xlens_new = (xlens + 1) // n_skips
+    xmax_new = int(xlens_new.max())
+
+    # Zero out padded frames and frames after the last window
+    mask = (torch.arange(xmax).unsqueeze(0) < xlens.long().unsqueeze(1)).to(xs.device).unsqueeze(2)
+    n_pad = max(0, (xmax_new - 1) * n_skips + n_stacks - xmax)
+    xs = torch.cat([xs * mask.float(), xs.new_zeros(bs, n_pad, input_dim)], dim=1)
+
+    # `[B, T', input_dim, n_stacks]` -> `[B, T', n_stacks * input_dim]`
+    xs = xs.unfold(1, n_stacks, n_skips)[:, :xmax_new]
+    xs = xs.transpose(2, 3).contiguous().view(bs, xmax_new, n_stacks * input_dim)
+    mask = (torch.arange(xmax_new).unsqueeze(0) < xlens_new.long().unsqueeze(1)).to(xs.device).unsqueeze(2)
+    return xs * mask.float(), xlens_new
@@ -4,25 +4,35 @@
 # Copyright 2019 Kyoto University (Hirofumi Inaguma)
 #  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
 
-"""Sequence summayr network."""
+"""SpecAugment."""
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
+import torch
 
 
 class SpecAugment(object):
-    """SpecAugment calss.
+    """SpecAugment calss. This implementation is based on
+
+       https://arxiv.org/abs/1904.08779.
+           Park, Daniel S., et al.
+           "SpecAugment: A simple data augmentation method for automatic speech recognition."
+           arXiv preprint arXiv:1904.08779 (2019).
+
+    All parameters are drawn per utterance as tensors on the device of the input,
+    and applied to the padded mini-batch at once.
 
     Args:
-        W (int): parameter for time warping
+        W (int): parameter for time warping (0 means no time warping)
         F (int): parameter for frequency masking
         T (int): parameter for time masking
         n_freq_masks (int): number of frequency masks
         n_time_masks (int): number of time masks
         p (float): parameter for upperbound of the time mask
+        policy (str): librispeech_basic or librispeech_double or switchboard_mild or switchboard_strong
+            (overrides the above parameters)
 
     """
 
@@ -32,7 +42,8 @@ class SpecAugment(object):
                  T=70,
                  n_freq_masks=2,
                  n_time_masks=2,
-                 p=0.2):
+                 p=0.2,
+                 policy=None):
 
         super(SpecAugment, self).__init__()
 
@@ -43,68 +54,134 @@ class SpecAugment(object):
         self.n_time_masks = n_time_masks
         self.p = p
 
+        if policy:
+            for k, v in getattr(self, policy).items():
+                setattr(self, k, v)
+
         self._freq_mask = None
         self._time_mask = None
 
     @property
     def librispeech_basic(self):
-        raise NotImplementedError
+        return {'W': 80, 'F': 27, 'n_freq_masks': 1, 'T': 100, 'p': 1.0, 'n_time_masks': 1}
 
     @property
     def librispeech_double(self):
-        raise NotImplementedError
+        return {'W': 80, 'F': 27, 'n_freq_masks': 2, 'T': 100, 'p': 1.0, 'n_time_masks': 2}
 
     @property
     def switchboard_mild(self):
-        raise NotImplementedError
+        return {'W': 40, 'F': 15, 'n_freq_masks': 2, 'T': 70, 'p': 0.2, 'n_time_masks': 2}
 
     @property
     def switchboard_strong(self):
-        raise NotImplementedError
+        return {'W': 40, 'F': 27, 'n_freq_masks': 2, 'T': 70, 'p': 0.2, 'n_time_masks': 2}
 
     @property
     def freq_mask(self):
+        """ByteTensor of size `[B, 1, F]` applied last (1 for masked bins)."""
         return self._freq_mask
 
     @property
     def time_mask(self):
+        """ByteTensor of size `[B, T, 1]` applied last (1 for masked frames)."""
         return self._time_mask
 
-    def __call__(self, xs):
+    def __call__(self, xs, xlens=None):
         """
         Args:
             xs (FloatTensor): `[B, T, F]`
+            xlens (IntTensor): `[B]` (all frames are valid if None)
         Returns:
             xs (FloatTensor): `[B, T, F]`
 
         """
-        # xs = self.time_warp(xs)
-        xs = self.mask_freq_dim(xs)
-        xs = self.mask_time_dim(xs)
+        if xlens is None:
+            xlens = torch.IntTensor([xs.size(1)] * xs.size(0))
+        xlens = xlens.long().to(xs.device)
+        if self.W > 0:
+            xs = self.time_warp(xs, xlens)
+        if self.n_freq_masks > 0:
+            xs = self.mask_freq_dim(xs)
+        if self.n_time_masks > 0:
+            xs = self.mask_time_dim(xs, xlens)
         return xs
 
-    def time_warp(xs, W=40):
-        raise NotImplementedError
+    def time_warp(self, xs, xlens):
+        """Warp frames before a random center to the left or right.
+
+        Frames in [0, c) are stretched to [0, c + w) and those in [c, xlen) to [c + w, xlen)
+        by linear interpolation, where c is drawn from [W, xlen - W) and w from (-W, W).
+        Utterances shorter than 2 * W + 1 frames are not warped.
+
+        Args:
+            xs (FloatTensor): `[B, T, F]`
+            xlens (LongTensor): `[B]`
+        Returns:
+            xs (FloatTensor): `[B, T, F]`
+
+        """
+        bs, xmax, n_bins = xs.size()
+        W = self.W
+        xlens_f = xlens.float()
+        is_warped = xlens > 2 * W
+        center = (W + torch.rand(bs, device=xs.device) * (xlens_f - 2 * W).clamp(min=0)).floor()
+        warp = (torch.rand(bs, device=xs.device) * (2 * W - 1)).floor() - (W - 1)
+        warp = warp * is_warped.float()
+        center = center * is_warped.float() + (xlens_f - 1) * (1 - is_warped.float())  # identity
+
+        # Source position of each output frame
+        t = torch.arange(xmax, device=xs.device).float().unsqueeze(0)  # `[1, T]`
+        c = center.unsqueeze(1)
+        w = warp.unsqueeze(1)
+        last = (xlens_f - 1).unsqueeze(1)
+        src_left = t * c / (c + w).clamp(min=1)
+        src_right = c + (t - c - w) * (last - c) / (last - c - w).clamp(min=1)
+        src = torch.where(t < c + w, src_left, src_right)
+        src = torch.where(t <= last, torch.min(src, last), t)  # keep padded frames
+        src = src.clamp(min=0, max=xmax - 1)
+
+        # Linear interpolation
+        src_floor = src.floor()
+        weight = (src - src_floor).unsqueeze(2)
+        idx_left = src_floor.long().unsqueeze(2).expand(bs, xmax, n_bins)
+        idx_right = (src_floor.long() + 1).clamp(max=xmax - 1).unsqueeze(2).expand(bs, xmax, n_bins)
+        return xs.gather(1, idx_left) * (1 - weight) + xs.gather(1, idx_right) * weight
 
     def mask_freq_dim(self, xs, replace_with_zero=False):
-        n_bins = xs.size(-1)
-
-        for i in range(0, self.n_freq_masks):
-            f = int(np.random.uniform(low=0, high=self.F))
-            f_0 = int(np.random.uniform(low=0, high=n_bins - f))
-            xs[:, :, f_0:f_0 + f] = 0
-            assert f_0 <= f_0 + f
-            self._freq_mask = (f_0, f_0 + f)
-        return xs
+        """
+        Args:
+            xs (FloatTensor): `[B, T, F]`
+        Returns:
+            xs (FloatTensor): `[B, T, F]`
 
-    def mask_time_dim(self, xs, replace_with_zero=False):
-        n_frames = xs.size(1)
+        """
+        bs, _, n_bins = xs.size()
+        f = (torch.rand(bs, self.n_freq_masks, device=xs.device) * self.F).floor()
+        f = f.clamp(max=n_bins)
+        f_0 = (torch.rand(bs, self.n_freq_masks, device=xs.device) * (n_bins - f)).floor()
+        bins = torch.arange(n_bins, device=xs.device).float().view(1, 1, n_bins)
+        mask = (bins >= f_0.unsqueeze(2)) & (bins < (f_0 + f).unsqueeze(2))  # `[B, n_freq_masks, F]`
+        mask = mask.sum(1, keepdim=True) > 0
+        self._freq_mask = mask
+        return xs.masked_fill(mask, 0)
+
+    def mask_time_dim(self, xs, xlens, replace_with_zero=False):
+        """
+        Args:
+            xs (FloatTensor): `[B, T, F]`
+            xlens (LongTensor): `[B]`
+        Returns:
+            xs (FloatTensor): `[B, T, F]`
 
-        for i in range(self.n_time_masks):
-            t = int(np.random.uniform(low=0, high=self.T))
-            t = min(t, int(n_frames * self.p))
-            t_0 = int(np.random.uniform(low=0, high=n_frames - t))
-            xs[:, t_0:t_0 + t] = 0
-            assert t_0 <= t_0 + t
-            self._time_mask = (t_0, t_0 + t)
-        return xs
+        """
+        bs, xmax, _ = xs.size()
+        xlens_f = xlens.float().unsqueeze(1)
+        t = (torch.rand(bs, self.n_time_masks, device=xs.device) * self.T).floor()
+        t = torch.min(t, (xlens_f * self.p).floor())
+        t_0 = (torch.rand(bs, self.n_time_masks, device=xs.device) * (xlens_f - t)).floor()
+        frames = torch.arange(xmax, device=xs.device).float().view(1, 1, xmax)
+        mask = (frames >= t_0.unsqueeze(2)) & (frames < (t_0 + t).unsqueeze(2))  # `[B, n_time_masks, T]`
+        mask = (mask.sum(1) > 0).unsqueeze(2)
+        self._time_mask = mask
+        return xs.masked_fill(mask, 0)
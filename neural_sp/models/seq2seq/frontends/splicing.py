@@ -11,6 +11,7 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import torch
 
 
 def splice(feat, n_splices=1, n_stacks=1, dtype=np.float32):
@@ -38,31 +39,61 @@ def splice(feat, n_splices=1, n_stacks=1, dtype=np.float32):
 
     max_xlen, input_dim = feat.shape
     freq = (input_dim // 3) // n_stacks
-    feat_splice = np.zeros((max_xlen, freq * (n_splices * n_stacks) * 3), dtype=dtype)
+    src = np.maximum(np.arange(max_xlen)[:, None] + np.arange(n_splices)[None, :] - n_splices, 0)
+    # NOTE: frames [t - n_splices, t - 1] are spliced, where the first frame is copied to the left side
+    feat_splice = _splice_frames(feat[src].reshape((max_xlen, n_splices, freq, 3, n_stacks)),
+                                 n_splices, n_stacks, np.zeros)
+    return feat_splice.reshape((max_xlen, freq * (n_splices * n_stacks) * 3)).astype(dtype)
 
-    for i_time in range(max_xlen):
-        spliced_frames = np.zeros((n_splices * n_stacks, freq, 3))
-        for i_splice in range(0, n_splices, 1):
-            if i_time <= n_splices - 1 and i_splice < n_splices - i_time:
-                # copy the first frame to left side (padding left frames)
-                copy_frame = feat[0]
-            elif max_xlen - n_splices <= i_time and i_time + (i_splice - n_splices) > max_xlen - 1:
-                # copy the last frame to right side (padding right frames)
-                copy_frame = feat[-1]
-            else:
-                copy_frame = feat[i_time + (i_splice - n_splices)]
 
-            # `[freq * 3 * n_stacks]` -> `[freq, 3, n_stacks]`
-            copy_frame = copy_frame.reshape((freq, 3, n_stacks))
+def _splice_frames(frames, n_splices, n_stacks, zeros):
+    """Arrange spliced frames.
 
-            # `[freq, 3, n_stacks]` -> `[n_stacks, freq, 3]`
-            copy_frame = np.transpose(copy_frame, (2, 0, 1))
+    Args:
+        frames (np.ndarray or FloatTensor): `[N, n_splices, freq, 3, n_stacks]`
+        n_splices (int):
+        n_stacks (int):
+        zeros (): np.zeros or a function making zeros like frames
+    Returns:
+        spliced (np.ndarray or FloatTensor): `[N, freq, n_splices * n_stacks, 3]`
+
+    """
+    # NOTE: stacked frames of the i-th spliced frame are written from the i-th position
+    # and overwritten by the next one, so the r-th position holds the (r - min(r, n_splices - 1))-th
+    # stacked frame of the min(r, n_splices - 1)-th spliced frame, and the rest is zero
+    n = frames.shape[0]
+    freq = frames.shape[2]
+    spliced = zeros((n, freq, n_splices * n_stacks, 3))
+    for r in range(n_splices - 1 + n_stacks):
+        i = min(r, n_splices - 1)
+        spliced[:, :, r] = frames[:, i, :, :, r - i]
+    return spliced
+
+
+def splice_tensor(xs, n_splices=1, n_stacks=1, xlens=None):
+    """Splice padded features in a mini-batch (same as splice).
 
-            spliced_frames[i_splice: i_splice + n_stacks] = copy_frame
+    Args:
+        xs (FloatTensor): `[B, T, input_dim (freq * 3 * n_stacks)]`
+        n_splices (int): frames to n_splices
+        n_stacks (int): the number of frames to stack
+        xlens (IntTensor): `[B]` (padded frames are filled with zeros if given)
+    Returns:
+        xs (FloatTensor): `[B, T, freq * (n_splices * n_stacks) * 3 (static + Δ + ΔΔ)]`
 
-        # `[n_splices * n_stacks, freq, 3] -> `[freq, n_splices * n_stacks, 3]`
-        spliced_frames = np.transpose(spliced_frames, (1, 0, 2))
+    """
+    assert xs.size(-1) % 3 == 0
 
-        feat_splice[i_time] = spliced_frames.reshape((freq * (n_splices * n_stacks) * 3))
+    if n_splices == 1:
+        return xs
 
-    return feat_splice
+    bs, xmax, input_dim = xs.size()
+    freq = (input_dim // 3) // n_stacks
+    src = (torch.arange(xmax).unsqueeze(1) + torch.arange(n_splices).unsqueeze(0) - n_splices).clamp(min=0)
+    frames = xs[:, src.view(-1).to(xs.device)].view(bs * xmax, n_splices, freq, 3, n_stacks)
+    xs = _splice_frames(frames, n_splices, n_stacks, frames.new_zeros)
+    xs = xs.view(bs, xmax, freq * (n_splices * n_stacks) * 3)
+    if xlens is not None:
+        mask = (torch.arange(xmax).unsqueeze(0) < xlens.long().unsqueeze(1)).to(xs.device).unsqueeze(2)
+        xs = xs * mask.float()
+    return xs
@@ -25,8 +25,8 @@ from neural_sp.models.seq2seq.decoders.transformer import TransformerDecoder
 from neural_sp.models.seq2seq.encoders.select import select_encoder
 from neural_sp.models.seq2seq.frontends.gaussian_noise import add_gaussian_noise
 from neural_sp.models.seq2seq.frontends.sequence_summary import SequenceSummaryNetwork
-from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame
-from neural_sp.models.seq2seq.frontends.splicing import splice
+from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame_tensor
+from neural_sp.models.seq2seq.frontends.splicing import splice_tensor
 from neural_sp.models.seq2seq.frontends.spec_augment import SpecAugment
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
@@ -91,16 +91,19 @@ class Speech2Text(ModelBase):
         self.n_stacks = args.n_stacks
         self.n_skips = args.n_skips
         self.n_splices = args.n_splices
-        self.is_specaug = args.n_freq_masks > 0 or args.n_time_masks > 0
+        self.is_specaug = args.n_freq_masks > 0 or args.n_time_masks > 0 or \
+            args.time_warp_width > 0 or args.specaug_policy
         self.specaug = None
         if self.is_specaug:
             assert args.n_stacks == 1 and args.n_skips == 1
             assert args.n_splices == 1
-            self.specaug = SpecAugment(F=args.freq_width,
+            self.specaug = SpecAugment(W=args.time_warp_width,
+                                       F=args.freq_width,
                                        T=args.time_width,
                                        n_freq_masks=args.n_freq_masks,
                                        n_time_masks=args.n_time_masks,
-                                       p=args.time_width_upper)
+                                       p=args.time_width_upper,
+                                       policy=args.specaug_policy)
 
         # Frontend
         self.ssn = None
@@ -169,6 +172,7 @@ class Speech2Text(ModelBase):
                     ctc_lsm_prob=args.ctc_lsm_prob,
                     ctc_fc_list=[int(fc) for fc in args.ctc_fc_list.split(
                         '_')] if args.ctc_fc_list is not None and len(args.ctc_fc_list) > 0 else [],
+                    ctc_loss_impl=args.ctc_loss_impl,
                     backward=(dir == 'bwd'),
                     global_weight=self.main_weight - self.bwd_weight if dir == 'fwd' else self.bwd_weight,
                     mtl_per_batch=args.mtl_per_batch)
@@ -194,12 +198,15 @@ class Speech2Text(ModelBase):
                     ctc_lsm_prob=args.ctc_lsm_prob,
                     ctc_fc_list=[int(fc) for fc in args.ctc_fc_list.split(
                         '_')] if args.ctc_fc_list is not None and len(args.ctc_fc_list) > 0 else [],
+                    ctc_loss_impl=args.ctc_loss_impl,
                     lm_init=lm_init,
                     lmobj_weight=args.lmobj_weight,
                     share_lm_softmax=args.share_lm_softmax,
                     global_weight=self.main_weight - self.bwd_weight if dir == 'fwd' else self.bwd_weight,
                     mtl_per_batch=args.mtl_per_batch,
-                    param_init=args.param_init)
+                    param_init=args.param_init,
+                    loss_impl=args.transducer_loss_impl,
+                    loss_chunk_size=args.transducer_chunk_size)
             else:
                 dec = RNNDecoder(
                     eos=self.eos,
@@ -237,6 +244,7 @@ class Speech2Text(ModelBase):
                     ctc_lsm_prob=args.ctc_lsm_prob,
                     ctc_fc_list=[int(fc) for fc in args.ctc_fc_list.split(
                         '_')] if args.ctc_fc_list is not None and len(args.ctc_fc_list) > 0 else [],
+                    ctc_loss_impl=args.ctc_loss_impl,
                     input_feeding=args.input_feeding,
                     backward=(dir == 'bwd'),
                     lm_fusion=lm_fusion,
@@ -293,6 +301,7 @@ class Speech2Text(ModelBase):
                         ctc_lsm_prob=args.ctc_lsm_prob,
                         ctc_fc_list=[int(fc) for fc in getattr(args, 'ctc_fc_list_' + sub).split('_')
                                      ] if getattr(args, 'ctc_fc_list_' + sub) is not None and len(getattr(args, 'ctc_fc_list_' + sub)) > 0 else [],
+                        ctc_loss_impl=args.ctc_loss_impl,
                         input_feeding=args.input_feeding,
                         global_weight=getattr(self, sub + '_weight'),
                         mtl_per_batch=args.mtl_per_batch,
@@ -381,7 +390,7 @@ class Speech2Text(ModelBase):
     def generate_probs(self, batch, lm=None, lm_weight=0, temperature=1):
         # Encode input features
         if self.input_type == 'speech':
-            enc_outs = self.encode(batch['xs'], task='ys')
+            enc_outs = self.encode(batch['xs'], task='ys', xlens=batch['xlens'])
         else:
             enc_outs = self.encode(batch['ys_sub1'], task='ys')
 
@@ -409,10 +418,10 @@ class Speech2Text(ModelBase):
         if self.input_type == 'speech':
             if self.mtl_per_batch:
                 flip = True if 'bwd' in task else False
-                enc_outs = self.encode(batch['xs'], task, flip=flip)
+                enc_outs = self.encode(batch['xs'], task, flip=flip, xlens=batch['xlens'])
             else:
                 flip = True if self.bwd_weight == 1 else False
-                enc_outs = self.encode(batch['xs'], 'all', flip=flip)
+                enc_outs = self.encode(batch['xs'], 'all', flip=flip, xlens=batch['xlens'])
         else:
             enc_outs = self.encode(batch['ys_sub1'])
 
@@ -482,13 +491,16 @@ class Speech2Text(ModelBase):
 
         return loss, reporter
 
-    def encode(self, xs, task='all', flip=False):
+    def encode(self, xs, task='all', flip=False, xlens=None):
         """Encode acoustic or text features.
 
         Args:
-            xs (list): A list of length `[B]`, which contains Tensor of size `[T, input_dim]`
+            xs (list): A list of length `[B]`, which contains Tensor of size `[T, input_dim]`,
+                or FloatTensor of size `[B, T, input_dim]` padded by the loader
+                after frame stacking and splicing (collate=True)
             task (str): all or ys* or ys_sub1* or ys_sub2*
             flip (bool): if True, flip acoustic features in the time-dimension
+            xlens (list): lengths of each element in xs (only used for the padded FloatTensor)
         Returns:
             enc_outs (dict):
 
@@ -500,25 +512,32 @@ class Speech2Text(ModelBase):
             return eouts
         else:
             if self.input_type == 'speech':
-                # Frame stacking
-                if self.n_stacks > 1:
-                    xs = [stack_frame(x, self.n_stacks, self.n_skips)for x in xs]
+                if torch.is_tensor(xs):
+                    # NOTE: frame stacking, splicing and padding are done by the loader
+                    xlens = torch.IntTensor(xlens)
+                    if self.device_id >= 0:
+                        xs = xs.cuda(self.device_id, non_blocking=True)
+                else:
+                    # NOTE: frame stacking and splicing are batched on the device after padding
+                    xlens = torch.IntTensor([len(x) for x in xs])
+                    xs = pad_list([np2tensor(x, self.device_id).float() for x in xs], 0.0)
 
-                # Splicing
-                if self.n_splices > 1:
-                    xs = [splice(x, self.n_splices, self.n_stacks) for x in xs]
-                xlens = torch.IntTensor([len(x) for x in xs])
+                    # Frame stacking
+                    if self.n_stacks > 1:
+                        xs, xlens = stack_frame_tensor(xs, xlens, self.n_stacks, self.n_skips)
+
+                    # Splicing
+                    if self.n_splices > 1:
+                        xs = splice_tensor(xs, self.n_splices, self.n_stacks, xlens)
 
                 # Flip acoustic features in the reverse order
                 if flip:
-                    xs = [torch.from_numpy(np.flip(x, axis=0).copy()).float().cuda(self.device_id) for x in xs]
-                else:
-                    xs = [np2tensor(x, self.device_id).float() for x in xs]
-                xs = pad_list(xs, 0.0)
+                    xs = torch.stack([torch.cat([xs[b, :xlens[b]].flip(0), xs[b, xlens[b]:]], dim=0)
+                                      for b in range(xs.size(0))], dim=0)
 
                 # SpecAugment
                 if self.is_specaug and self.training:
-                    xs = self.specaug(xs)
+                    xs = self.specaug(xs, xlens)
 
                 # Gaussian noise injection
                 if self.gaussian_noise:
@@ -637,14 +656,18 @@ class Speech2Text(ModelBase):
             else:
                 cache_info = (None, None)
 
-                if params['recog_beam_width'] == 1 and not params['recog_fwd_bwd_attention']:
+                if params['recog_beam_width'] == 1 and not params['recog_fwd_bwd_attention'] and \
+                        isinstance(getattr(self, 'dec_' + dir), RNNTransducer):
+                    best_hyps_id, aws = getattr(self, 'dec_' + dir).greedy(
+                        enc_outs[task]['xs'], enc_outs[task]['xlens'],
+                        params['recog_max_len_ratio'], idx2token, exclude_eos, refs_id,
+                        speakers, params['recog_oracle'], params['recog_max_symbols_per_frame'])
+                elif params['recog_beam_width'] == 1 and not params['recog_fwd_bwd_attention']:
                     best_hyps_id, aws = getattr(self, 'dec_' + dir).greedy(
                         enc_outs[task]['xs'], enc_outs[task]['xlens'],
                         params['recog_max_len_ratio'], idx2token, exclude_eos, refs_id,
                         speakers, params['recog_oracle'])
                 else:
-                    assert params['recog_batch_size'] == 1
-
                     ctc_log_probs = None
                     if params['recog_ctc_weight'] > 0:
                         ctc_log_probs = self.dec_fwd.ctc_log_probs(enc_outs[task]['xs'])
@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Benchmark implementations of CTC loss (step time and memory)."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import numpy as np
+import time
+import torch
+
+from neural_sp.models.seq2seq.decoders.ctc import CTC
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--impl', type=str, nargs='+', default=['warpctc', 'pytorch'],
+                    choices=['warpctc', 'pytorch'],
+                    help='implementations of CTC loss to compare')
+parser.add_argument('--batch_size', type=int, default=32,
+                    help='size of mini-batch')
+parser.add_argument('--n_frames', type=int, default=500,
+                    help='maximum number of encoder frames')
+parser.add_argument('--n_labels', type=int, default=100,
+                    help='maximum number of labels')
+parser.add_argument('--vocab', type=int, default=5000,
+                    help='vocabulary size')
+parser.add_argument('--enc_n_units', type=int, default=512,
+                    help='number of units in encoder outputs')
+parser.add_argument('--n_steps', type=int, default=20,
+                    help='number of measured steps')
+parser.add_argument('--n_warmup', type=int, default=3,
+                    help='number of warmup steps')
+parser.add_argument('--gpu', type=int, default=-1,
+                    help='GPU id (-1 means CPU)')
+args = parser.parse_args()
+
+
+def synchronize():
+    if args.gpu >= 0:
+        torch.cuda.synchronize(args.gpu)
+
+
+def main():
+
+    np.random.seed(1)
+    torch.manual_seed(1)
+
+    # Create random inputs of various lengths
+    bs = args.batch_size
+    elens = np.random.randint(args.n_frames // 2, args.n_frames + 1, size=bs)
+    elens[0] = args.n_frames
+    elens = torch.IntTensor(np.sort(elens)[::-1].copy())
+    ys = [np.random.randint(1, args.vocab, size=np.random.randint(
+        1, min(args.n_labels, int(elens[b]) // 2) + 1)).tolist() for b in range(bs)]
+    eouts = torch.randn(bs, args.n_frames, args.enc_n_units)
+
+    print('B: %d, T: %d, L: %d, vocab: %d, device: %s' % (
+        bs, args.n_frames, max([len(y) for y in ys]), args.vocab,
+        'gpu%d' % args.gpu if args.gpu >= 0 else 'cpu'))
+    for impl in args.impl:
+        ctc = CTC(eos=2, blank=0, enc_n_units=args.enc_n_units, vocab=args.vocab, loss_impl=impl)
+        eouts_impl = eouts.clone()
+        if args.gpu >= 0:
+            ctc.cuda(args.gpu)
+            eouts_impl = eouts_impl.cuda(args.gpu)
+        eouts_impl.requires_grad = True
+
+        times = []
+        for step in range(args.n_warmup + args.n_steps):
+            if step == args.n_warmup and args.gpu >= 0:
+                torch.cuda.reset_max_memory_allocated(args.gpu)
+            synchronize()
+            tbegin = time.time()
+            loss = ctc(eouts_impl, elens, ys)
+            loss.backward()
+            synchronize()
+            if step >= args.n_warmup:
+                times.append(time.time() - tbegin)
+            ctc.zero_grad()
+            eouts_impl.grad = None
+
+        line = '%-8s loss: %.3f, step time: %.2f ms (std %.2f)' % (
+            impl, loss.item(), np.mean(times) * 1000, np.std(times) * 1000)
+        if args.gpu >= 0:
+            line += ', peak memory: %.1f MB' % (torch.cuda.max_memory_allocated(args.gpu) / 1024 / 1024)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
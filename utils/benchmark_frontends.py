@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Benchmark implementations of frame stacking and splicing (time per mini-batch)."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import numpy as np
+import time
+import torch
+
+from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame
+from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame_tensor
+from neural_sp.models.seq2seq.frontends.splicing import splice
+from neural_sp.models.seq2seq.frontends.splicing import splice_tensor
+from neural_sp.models.torch_utils import np2tensor
+from neural_sp.models.torch_utils import pad_list
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', type=int, default=32,
+                    help='size of mini-batch')
+parser.add_argument('--n_frames', type=int, default=1000,
+                    help='maximum number of input frames')
+parser.add_argument('--input_dim', type=int, default=240,
+                    help='dimension of input features (must be divisible by 3)')
+parser.add_argument('--n_stacks', type=int, default=3,
+                    help='number of frames to stack')
+parser.add_argument('--n_skips', type=int, default=3,
+                    help='number of frames to skip')
+parser.add_argument('--n_splices', type=int, default=1,
+                    help='number of frames to splice')
+parser.add_argument('--n_steps', type=int, default=10,
+                    help='number of measured steps')
+parser.add_argument('--gpu', type=int, default=-1,
+                    help='GPU id (-1 means CPU)')
+args = parser.parse_args()
+
+
+def stack_frame_loop(feat, n_stacks, n_skips, dtype=np.float32):
+    """Frame-by-frame frame stacking before vectorization (for reference)."""
+    n_frames, input_dim = feat.shape
+    n_frames_new = (n_frames + 1) // n_skips
+    stacked_feat = np.zeros((n_frames_new, input_dim * n_stacks), dtype=dtype)
+    stack_count = 0
+    stack = []
+    for t, frame_t in enumerate(feat):
+        if t == len(feat) - 1:
+            stack.append(frame_t)
+            while stack_count != int(n_frames_new):
+                for i in range(len(stack)):
+                    stacked_feat[stack_count][input_dim * i:input_dim * (i + 1)] = stack[i]
+                stack_count += 1
+                for _ in range(n_skips):
+                    if len(stack) != 0:
+                        stack.pop(0)
+        elif len(stack) < n_stacks:
+            stack.append(frame_t)
+        if len(stack) == n_stacks:
+            for i in range(n_stacks):
+                stacked_feat[stack_count][input_dim * i:input_dim * (i + 1)] = stack[i]
+            stack_count += 1
+            for _ in range(n_skips):
+                stack.pop(0)
+    return stacked_feat
+
+
+def splice_loop(feat, n_splices, n_stacks, dtype=np.float32):
+    """Frame-by-frame splicing before vectorization (for reference)."""
+    max_xlen, input_dim = feat.shape
+    freq = (input_dim // 3) // n_stacks
+    feat_splice = np.zeros((max_xlen, freq * (n_splices * n_stacks) * 3), dtype=dtype)
+    for i_time in range(max_xlen):
+        spliced_frames = np.zeros((n_splices * n_stacks, freq, 3))
+        for i_splice in range(n_splices):
+            copy_frame = feat[max(i_time + i_splice - n_splices, 0)]
+            copy_frame = np.transpose(copy_frame.reshape((freq, 3, n_stacks)), (2, 0, 1))
+            spliced_frames[i_splice: i_splice + n_stacks] = copy_frame
+        spliced_frames = np.transpose(spliced_frames, (1, 0, 2))
+        feat_splice[i_time] = spliced_frames.reshape((freq * (n_splices * n_stacks) * 3))
+    return feat_splice
+
+
+def synchronize():
+    if args.gpu >= 0:
+        torch.cuda.synchronize(args.gpu)
+
+
+def run_loop(xs):
+    if args.n_stacks > 1:
+        xs = [stack_frame_loop(x, args.n_stacks, args.n_skips) for x in xs]
+    if args.n_splices > 1:
+        xs = [splice_loop(x, args.n_splices, args.n_stacks) for x in xs]
+    return pad_list([np2tensor(x, args.gpu).float() for x in xs], 0.0)
+
+
+def run_numpy(xs):
+    if args.n_stacks > 1:
+        xs = [stack_frame(x, args.n_stacks, args.n_skips) for x in xs]
+    if args.n_splices > 1:
+        xs = [splice(x, args.n_splices, args.n_stacks) for x in xs]
+    return pad_list([np2tensor(x, args.gpu).float() for x in xs], 0.0)
+
+
+def run_tensor(xs):
+    xlens = torch.IntTensor([len(x) for x in xs])
+    xs = pad_list([np2tensor(x, args.gpu).float() for x in xs], 0.0)
+    if args.n_stacks > 1:
+        xs, xlens = stack_frame_tensor(xs, xlens, args.n_stacks, args.n_skips)
+    if args.n_splices > 1:
+        xs = splice_tensor(xs, args.n_splices, args.n_stacks, xlens)
+    return xs
+
+
+def main():
+
+    np.random.seed(1)
+
+    # Create random inputs of various lengths
+    bs = args.batch_size
+    xlens = np.random.randint(args.n_frames // 2, args.n_frames + 1, size=bs)
+    xlens[0] = args.n_frames
+    xs = [np.random.randn(xlen, args.input_dim).astype(np.float32) for xlen in xlens]
+
+    print('B: %d, T: %d, input_dim: %d, n_stacks: %d, n_skips: %d, n_splices: %d, device: %s' % (
+        bs, args.n_frames, args.input_dim, args.n_stacks, args.n_skips, args.n_splices,
+        'gpu%d' % args.gpu if args.gpu >= 0 else 'cpu'))
+    ref = None
+    for name, fn in [('loop', run_loop), ('numpy', run_numpy), ('tensor', run_tensor)]:
+        times = []
+        for step in range(args.n_steps + 1):
+            synchronize()
+            tbegin = time.time()
+            out = fn(xs)
+            synchronize()
+            if step > 0:
+                times.append(time.time() - tbegin)
+        if ref is None:
+            ref = out
+        assert out.size() == ref.size() and torch.equal(out, ref), 'Mismatch in %s' % name
+        print('%-8s time: %.2f ms (std %.2f)' % (name, np.mean(times) * 1000, np.std(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Compile a dataset tsv file into a memory-mapped manifest directory.
+   The directory can be passed to the ASR and LM loaders instead of the tsv file.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+from neural_sp.datasets.manifest import compile_manifest
+
+parser = argparse.ArgumentParser()
+parser.add_argument('tsv', type=str,
+                    help='dataset tsv file')
+parser.add_argument('manifest_dir', type=str, nargs='?', default=None,
+                    help='output directory (<tsv>.manifest by default)')
+args = parser.parse_args()
+
+
+def main():
+
+    manifest_dir = args.manifest_dir
+    if manifest_dir is None:
+        manifest_dir = args.tsv + '.manifest'
+
+    tbegin = time.time()
+    n_utts = compile_manifest(args.tsv, manifest_dir)
+    print('Compiled %d utterances into %s (%.2f sec)' % (n_utts, manifest_dir, time.time() - tbegin))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Pack features of a dataset into a single memory-mapped feature store.
+   The ASR loader reads it with --feat_store true (--recog_feat_store true for decoding).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import pandas as pd
+import time
+
+from neural_sp.datasets.feature_store import feature_store_path
+from neural_sp.datasets.feature_store import pack_features
+from neural_sp.datasets.manifest import is_manifest
+from neural_sp.datasets.manifest import Manifest
+
+parser = argparse.ArgumentParser()
+parser.add_argument('tsv', type=str,
+                    help='dataset tsv file (or the manifest directory compiled from it)')
+parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                    help='data type of stored features (float16 halves I/O)')
+args = parser.parse_args()
+
+
+def main():
+
+    if is_manifest(args.tsv):
+        manifest = Manifest(args.tsv)
+        feat_paths = [manifest.get('feat_path', i) for i in range(len(manifest))]
+    else:
+        feat_paths = pd.read_csv(args.tsv, encoding='utf-8', delimiter='\t')['feat_path'].tolist()
+
+    store_dir = feature_store_path(args.tsv)
+    tbegin = time.time()
+    n_frames = pack_features(feat_paths, store_dir, dtype=args.dtype)
+    size = os.path.getsize(os.path.join(store_dir, 'feats.bin'))
+    print('Packed %d utterances (%d frames, %.1f MB) into %s (%.2f sec)' % (
+        len(feat_paths), n_frames, size / 1024 / 1024, store_dir, time.time() - tbegin))
+
+
+if __name__ == '__main__':
+    main()